@@ -1,99 +1,363 @@
 from ortools.sat.python import cp_model
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
 from collections import defaultdict
-import copy
+import hashlib
+import json
+import os
+import time
 
-from simulation import Simulator
-from simulation.tcg import TimingConflictGraph, EdgeType
+from simulation import Simulator, SimulatorStatus, Intersection, Vehicle, VehicleState
+from simulation.tcg import TimingConflictGraph, Vertex, VertexState, Edge, EdgeType
 from utility import read_intersection_from_json
 
-def calculate_passing_time_sum_upper_bound(sim: Simulator) -> int:
+def calculate_passing_time_sum_upper_bound(
+    sim: Simulator,
+    tcg: Optional[TimingConflictGraph] = None,
+    vehicles: Optional[Iterable[Vehicle]] = None
+) -> int:
+    tcg = sim.TCG if tcg is None else tcg
+    vehicles = sim.vehicles if vehicles is None else vehicles
     last_leaving_time = 0
-    max_edge_waiting_time = max([edge.waiting_time for edge in sim.TCG.E]) if len(sim.TCG.E) > 0 else 1
-    for vehicle in sorted(sim.vehicles, key=lambda vehicle: vehicle.earliest_arrival_time):
+    max_edge_waiting_time = max([edge.waiting_time for edge in tcg.E]) if len(tcg.E) > 0 else 1
+    for vehicle in sorted(vehicles, key=lambda vehicle: vehicle.earliest_arrival_time):
         entering_time = max(vehicle.earliest_arrival_time, last_leaving_time)
         leaving_time = entering_time + vehicle.vertex_passing_time * len(vehicle.trajectory)
         leaving_time += max_edge_waiting_time * len(vehicle.trajectory)
         last_leaving_time = leaving_time
     return last_leaving_time
 
-def solve_by_CP(sim: Simulator):
-    if len(sim.vehicles) == 0:
+# bump this when the CP model changes so that cached solutions are invalidated
+CP_CACHE_VERSION = 4
+DEFAULT_CP_CACHE_DIR = ".cache/CP"
+
+
+@dataclass
+class CPSolution:
+    objective: float    # average delay per vehicle in seconds
+    # vehicle id -> entering time of each CZ on the trajectory, followed by the leaving time
+    schedule: Dict[str, List[int]] = field(default_factory=dict)
+    status: str = "OPTIMAL"
+    bound: Optional[float] = None    # lower bound of the objective proven by the solver
+    gap: Optional[float] = None      # relative gap between the objective and the bound
+
+
+def solve_by_CP(sim: Simulator, **solver_params) -> Optional[float]:
+    solution = solve_CP(sim, **solver_params)
+    return None if solution is None else solution.objective
+
+def fcfs_decide(vehicles) -> int:
+    ready = [i for i, vehicle in enumerate(vehicles) if vehicle.state == VehicleState.READY]
+    if len(ready) == 0:
         return 0
+    return min(ready, key=lambda i: (vehicles[i].earliest_arrival_time, vehicles[i].id)) + 1
+
+def get_hint_policy_factory(hint: str) -> Callable[[Simulator], Callable]:
+    '''
+    Return a function which builds the decide function of the FCFS or IGreedy policy on a simulator
+    '''
+    if hint == "fcfs":
+        return lambda sim: fcfs_decide
+    if hint == "igreedy":
+        # imported here so that solving with the FCFS hint does not load TensorFlow
+        from environment import RawStateSimulatorEnv
+        from policy import IGreedyPolicy
+        return lambda sim: IGreedyPolicy(RawStateSimulatorEnv(sim, snapshot=False)).decide
+    raise Exception(f"[get_hint_policy_factory] unknown hint: {hint}")
+
+def rollout_schedule(
+    sim: Simulator,
+    policy_factory: Callable[[Simulator], Callable]
+) -> Optional[Dict[Tuple[str, str], int]]:
+    '''
+    Run the policy on a new simulator with the vehicles of sim and return the entering
+    time of each (vehicle id, CZ id) pair, or None if the rollout deadlocks. The rollout
+    starts from the arrivals, a deep copy of the linked TCG exceeds the recursion limit
+    on large traffic.
+    '''
+    vehicles = list(sim.vehicles)
+    rollout_sim = Simulator(sim.intersection)
+    rollout_sim.add_vehicles(
+        [vehicle.id for vehicle in vehicles],
+        [vehicle.earliest_arrival_time for vehicle in vehicles],
+        [vehicle.trajectory for vehicle in vehicles],
+        [vehicle.src_lane_id for vehicle in vehicles],
+        [vehicle.dst_lane_id for vehicle in vehicles],
+        [vehicle.vertex_passing_time for vehicle in vehicles]
+    )
+    rollout_sim.start()
+    decide = policy_factory(rollout_sim)
+
+    while rollout_sim.status == SimulatorStatus.RUNNING:
+        observed_vehicles = rollout_sim.observe()["vehicles"]
+        action = decide(observed_vehicles)
+        rollout_sim.step(observed_vehicles[action - 1].id if action > 0 else None)
+
+    if rollout_sim.status != SimulatorStatus.TERMINATED:
+        return None
+    return {(vertex.vehicle.id, vertex.cz_id): vertex.entering_time for vertex in rollout_sim.TCG.V}
+
+def add_rollout_hint(
+    model: cp_model.CpModel,
+    solver: cp_model.CpSolver,
+    sim: Simulator,
+    tcg: TimingConflictGraph,
+    horizon: int,
+    entering_time_vars: Dict[int, cp_model.IntVar],
+    order_literals: Dict[Tuple[int, int], cp_model.IntVar],
+    policy_factory: Callable[[Simulator], Callable]
+) -> Optional[Dict[int, int]]:
+    '''
+    Warm start the model with the orders of the vehicles in a policy rollout. The simulator
+    times the vehicles differently from the model, so the rollout is re-timed by solving
+    the model with the orders fixed before it is given as a hint. Return the re-timed
+    entering time of each vertex (by vertex id), or None if there is no hint.
+    '''
+    rollout = rollout_schedule(sim, policy_factory)
+    if rollout is None:
+        return None
+    entering_times = {vertex.id: rollout[vertex.vehicle.id, vertex.cz_id] for vertex in tcg.V}
+
+    retimed_model = cp_model.CpModel()
+    retimed_order_literals = {}
+    retimed_vars = build_CP_model(retimed_model, tcg, horizon, timestamp=sim.timestamp,
+                                  order_literals=retimed_order_literals)
+    for (from_id, to_id), literal in retimed_order_literals.items():
+        retimed_model.Add(literal == int(entering_times[from_id] < entering_times[to_id]))
+    retimed_model.Minimize(sum(
+        retimed_vars[tcg.get_vertex_by_vehicle_cz_pair(vehicle, f"${vehicle.id}").id] for vehicle in sim.vehicles))
+
+    status = solver.Solve(retimed_model)
+    if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+        return None
+    retimed_entering_times = {vertex_id: solver.Value(var) for vertex_id, var in retimed_vars.items()}
+    # executed vertices are constants, which CP-SAT may share between vertices, so they get no hint
+    for vertex in tcg.V:
+        if vertex.state == VertexState.NON_EXECUTED:
+            model.AddHint(entering_time_vars[vertex.id], retimed_entering_times[vertex.id])
+    for key, literal in order_literals.items():
+        model.AddHint(literal, solver.BooleanValue(retimed_order_literals[key]))
+    return retimed_entering_times
+
+def solve_CP(
+    sim: Simulator,
+    num_workers: int = 0,
+    time_limit: Optional[float] = None,
+    hint: Optional[str] = None
+) -> Optional[CPSolution]:
+    '''
+    num_workers: number of search workers, 0 lets CP-SAT use all the cores
+    time_limit: in seconds, the best feasible solution found so far is returned when it is reached
+    hint: "fcfs" or "igreedy", warm start the search with the schedule of the policy, which is
+          also returned if the solver finds no solution within time_limit
+    Return None if no solution is found.
+    '''
+    if len(sim.vehicles) == 0:
+        return CPSolution(0)
+
+    tcg: TimingConflictGraph = sim.TCG
+    if len(tcg.V) == 0:
+        # the TCG is built when the simulator starts; the model only reads it
+        tcg = TimingConflictGraph(set(sim.vehicles), sim.intersection)
+    horizon = calculate_passing_time_sum_upper_bound(sim, tcg) + max(sim.timestamp, 0)
 
     model = cp_model.CpModel()
-    tcg: TimingConflictGraph = copy.deepcopy(sim.TCG)
-    tcg.add_unsure_type3_edges()
-    passing_time_sum_upper_bound = calculate_passing_time_sum_upper_bound(sim)
+    order_literals = {}
+    entering_time_vars = build_CP_model(model, tcg, horizon, timestamp=sim.timestamp,
+                                        order_literals=order_literals)
+    last_vertices = {vehicle.id: tcg.get_vertex_by_vehicle_cz_pair(vehicle, f"${vehicle.id}")
+                     for vehicle in sim.vehicles}
+    model.Minimize(sum(entering_time_vars[last_vertices[vehicle.id].id] - vehicle.earliest_arrival_time
+                       for vehicle in sim.vehicles))
+
+    solver = cp_model.CpSolver()
+    if num_workers > 0:
+        solver.parameters.num_workers = num_workers
+    if time_limit is not None:
+        solver.parameters.max_time_in_seconds = time_limit
+    hint_entering_times = None
+    if hint is not None:
+        # the policy modules are loaded before the clock starts
+        policy_factory = get_hint_policy_factory(hint)
+        start_time = time.perf_counter()
+        hint_entering_times = add_rollout_hint(model, solver, sim, tcg, horizon, entering_time_vars,
+                                               order_literals, policy_factory)
+        if time_limit is not None:
+            # the warm start is part of the time budget
+            solver.parameters.max_time_in_seconds = max(time_limit - (time.perf_counter() - start_time), 0)
+    status = solver.Solve(model)
+    if status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+        entering_times = {vertex_id: solver.Value(var) for vertex_id, var in entering_time_vars.items()}
+        status_name = solver.StatusName(status)
+        bound = solver.BestObjectiveBound()
+    elif hint_entering_times is not None:
+        # the re-timed rollout satisfies the model, it is the incumbent when the search finds nothing
+        entering_times = hint_entering_times
+        status_name = "FEASIBLE"
+        bound = None
+    else:
+        return None
+
+    tot = 0
+    schedule = {}
+    for vehicle in sim.vehicles:
+        schedule[vehicle.id] = [
+            entering_times[tcg.get_vertex_by_vehicle_cz_pair(vehicle, cz_id).id]
+            for cz_id in vehicle.trajectory + (f"${vehicle.id}",)
+        ]
+        tot += schedule[vehicle.id][-1] - vehicle.earliest_arrival_time \
+               - vehicle.vertex_passing_time * len(vehicle.trajectory)
+    objective = tot / len(sim.vehicles) / 10
+    if bound is None:
+        return CPSolution(objective, schedule, status_name)
 
-    vertex_to_vars = {}
+    # the model objective also counts the passing time, which is a constant
+    passing_time_sum = sum(vehicle.vertex_passing_time * len(vehicle.trajectory) for vehicle in sim.vehicles)
+    bound = (bound - passing_time_sum) / len(sim.vehicles) / 10
+    gap = (objective - bound) / objective if objective > 0 else 0.0
+    return CPSolution(objective, schedule, status_name, bound, max(gap, 0.0))
+
+def build_CP_model(
+    model: cp_model.CpModel,
+    tcg: TimingConflictGraph,
+    horizon: int,
+    timestamp: int = 0,
+    order_literals: Optional[Dict[Tuple[int, int], cp_model.IntVar]] = None
+) -> Dict[int, cp_model.IntVar]:
+    '''
+    Add the timing constraints of the TCG to the model and return the entering time
+    variable of each vertex (by vertex id). A vehicle leaves a CZ when it enters the
+    next vertex on its trajectory, so no separate leaving time variables are needed.
+    Each undecided pair of Type-3 edges becomes a single ordering literal.
+    Executed vertices keep their entering times and the others start no earlier than timestamp.
+    If order_literals is given, it is filled with the literal of each pair, keyed by the vertex
+    ids (from, to) of the edge the literal enforces.
+    '''
+    entering_time_vars: Dict[int, cp_model.IntVar] = {}
     for vertex in tcg.V:
-        suffix = f"{vertex.vehicle.id}_{vertex.cz_id}"
-        entering_time_var = model.NewIntVar(0, passing_time_sum_upper_bound, f"entering_time_{suffix}")
-        leaving_time_var = model.NewIntVar(0, passing_time_sum_upper_bound, f"leaving_time_{suffix}")
-        vertex_to_vars[vertex.vehicle.id, vertex.cz_id] = (entering_time_var, leaving_time_var)
-    
-    edge_to_vars = {}
-    for edge in tcg.E:
-        if edge.type != EdgeType.TYPE_3:
-            continue
-        selected_var = model.NewBoolVar(f"edge_selected_{edge.id}")
-        edge_to_vars[edge.id] = selected_var
+        if vertex.state != VertexState.NON_EXECUTED:
+            var = model.NewConstant(vertex.entering_time)
+        else:
+            var = model.NewIntVar(max(timestamp, 0), horizon, f"entering_time_{vertex.vehicle.id}_{vertex.cz_id}")
+        if vertex.cz_id == vertex.vehicle.trajectory[0]:
+            model.Add(var >= vertex.vehicle.earliest_arrival_time)
+        entering_time_vars[vertex.id] = var
 
-    processed_edge_ids = set()
+    edges: Dict[Tuple[int, int], Edge] = {}
+    next_vertex: Dict[int, Vertex] = {}
     for edge in tcg.E:
-        if edge.type != EdgeType.TYPE_3 or edge.id in processed_edge_ids:
+        edges[edge.v_from.id, edge.v_to.id] = edge
+        if edge.type == EdgeType.TYPE_1:
+            next_vertex[edge.v_from.id] = edge.v_to
+
+    def leaving_time(vertex: Vertex):
+        return entering_time_vars[next_vertex[vertex.id].id]
+
+    def is_fixed(vertex: Vertex) -> bool:
+        return vertex.state != VertexState.NON_EXECUTED
+
+    # constraints between already executed vertices are history and skipped
+    for vertex in tcg.V:
+        if vertex.id in next_vertex and not is_fixed(next_vertex[vertex.id]):
+            model.Add(leaving_time(vertex) >= entering_time_vars[vertex.id] + vertex.passing_time)
+
+    cz_min_gap: Dict[str, int] = {}
+    for (from_id, to_id), edge in edges.items():
+        if edge.type not in (EdgeType.TYPE_2, EdgeType.TYPE_3):
             continue
-        selected_var = edge_to_vars[edge.id]
-        alternative_edge = [e for e in tcg.E if e.v_from.id == edge.v_to.id and e.v_to.id == edge.v_from.id][0]
-        disjunctive_var = edge_to_vars[alternative_edge.id]
-        processed_edge_ids.add(alternative_edge.id)
-        model.AddBoolXOr([selected_var, disjunctive_var])
+        v_from, v_to = edge.v_from, edge.v_to
+        cz_min_gap[v_from.cz_id] = min(cz_min_gap.get(v_from.cz_id, edge.waiting_time), edge.waiting_time)
+
+        reverse_edge = edges.get((to_id, from_id), None)
+        if edge.type == EdgeType.TYPE_2 or edge.decided or reverse_edge is None:
+            if is_fixed(v_to) and is_fixed(next_vertex[from_id]):
+                continue
+            model.Add(entering_time_vars[to_id] >= leaving_time(v_from) + edge.waiting_time)
+        elif from_id < to_id:
+            order = model.NewBoolVar(f"order_{v_from.vehicle.id}_{v_to.vehicle.id}_{v_from.cz_id}")
+            model.Add(entering_time_vars[to_id] >= leaving_time(v_from) + edge.waiting_time) \
+                .OnlyEnforceIf(order)
+            model.Add(entering_time_vars[from_id] >= leaving_time(v_to) + reverse_edge.waiting_time) \
+                .OnlyEnforceIf(order.Not())
+            if order_literals is not None:
+                order_literals[from_id, to_id] = order
 
+    # Redundant disjunctions: the occupations of a CZ padded by the smallest gap never
+    # overlap. The gaps depend on whether two vehicles come from the same lane, so the
+    # ordering literals above still carry the exact constraints.
+    cz_intervals = defaultdict(list)
     for vertex in tcg.V:
-        entering_time_var, leaving_time_var = vertex_to_vars[vertex.vehicle.id, vertex.cz_id]
-        model.Add(leaving_time_var >= entering_time_var + vertex.passing_time)
-        for in_e in vertex.in_edges:
-            parent = in_e.v_from
-            p_entering_time_var, p_leaving_time_var = vertex_to_vars[parent.vehicle.id, parent.cz_id]
-            if in_e.type == EdgeType.TYPE_1:
-                model.Add(p_leaving_time_var == entering_time_var)
-            elif in_e.type == EdgeType.TYPE_2:
-                model.Add(entering_time_var >= p_leaving_time_var + in_e.waiting_time)
-            elif in_e.type == EdgeType.TYPE_3:
-                selected_var = edge_to_vars[in_e.id]
-                model.Add(entering_time_var >= p_leaving_time_var + in_e.waiting_time).OnlyEnforceIf(selected_var)
-
-    
-    for vehicle in sim.vehicles:
-        entering_time_var, leaving_time_var = vertex_to_vars[vehicle.id, vehicle.trajectory[0]]
-        model.Add(entering_time_var >= vehicle.earliest_arrival_time)
-    
-    vehicle_passing_time_list = []
-    for vehicle in sim.vehicles:
-        entering_time_var, leaving_time_var = vertex_to_vars[vehicle.id, vehicle.trajectory[-1]]
-        vehicle_passing_time_list.append(leaving_time_var - vehicle.earliest_arrival_time)
+        if vertex.id not in next_vertex or vertex.cz_id not in cz_min_gap \
+            or is_fixed(next_vertex[vertex.id]):
+            continue
+        gap = cz_min_gap[vertex.cz_id]
+        size = model.NewIntVar(vertex.passing_time + gap, horizon + gap,
+                               f"occupation_{vertex.vehicle.id}_{vertex.cz_id}")
+        cz_intervals[vertex.cz_id].append(model.NewIntervalVar(
+            entering_time_vars[vertex.id], size, leaving_time(vertex) + gap,
+            f"interval_{vertex.vehicle.id}_{vertex.cz_id}"
+        ))
+    for intervals in cz_intervals.values():
+        model.AddNoOverlap(intervals)
 
-    model.Minimize(sum(vehicle_passing_time_list))
-            
-    solver = cp_model.CpSolver()
-    status = solver.Solve(model)
-    tot = 0
-    if status == cp_model.OPTIMAL:
-        for vehicle in sim.vehicles:
-            #print(vehicle.id, ": ", end="")
-            leaving_last_cz_time = 0
-            for cz_id in vehicle.trajectory:
-                entering_time_var, leaving_time_var = vertex_to_vars[vehicle.id, cz_id]
-                leaving_last_cz_time = solver.Value(leaving_time_var)
-                #print(solver.Value(entering_time_var), leaving_last_cz_time, end=",")
-            tot += leaving_last_cz_time - vehicle.earliest_arrival_time - vehicle.vertex_passing_time * len(vehicle.trajectory)
-            #print("")
-
-    return tot / len(sim.vehicles) / 10
+    return entering_time_vars
+
+
+def intersection_asdict(intersection: Intersection) -> Dict:
+    return {
+        "conflict_zones": sorted(intersection.conflict_zones),
+        "src_lanes": {lane_id: sorted(czs) for lane_id, czs in intersection.src_lanes.items()},
+        "dst_lanes": {lane_id: sorted(czs) for lane_id, czs in intersection.dst_lanes.items()},
+        "trajectories": sorted(intersection.trajectories)
+    }
+
+def CP_cache_key(sim: Simulator, solver_params: Optional[Dict] = None) -> str:
+    '''
+    canonical hash of the intersection, the traffic and the solver parameters
+    '''
+    content = {
+        "version": CP_CACHE_VERSION,
+        "intersection": intersection_asdict(sim.intersection),
+        "traffic": sorted((vehicle.asdict() for vehicle in sim.vehicles), key=lambda d: d["id"]),
+        "solver_params": solver_params or {}
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+def solve_by_CP_cached(sim: Simulator, cache_dir=DEFAULT_CP_CACHE_DIR, **solver_params) -> Optional[CPSolution]:
+    '''
+    solve_CP with the solutions persisted in cache_dir, so that a traffic is solved only once;
+    a traffic without a solution is not cached and is solved again on the next call
+    '''
+    if any(vertex.state != VertexState.NON_EXECUTED for vertex in sim.TCG.V):
+        # the key only covers the traffic, not a partially executed schedule
+        return solve_CP(sim, **solver_params)
+
+    # the number of workers only affects how fast a solution is found
+    key_params = {k: v for k, v in solver_params.items() if k != "num_workers" and v is not None}
+    cache_dir = Path(cache_dir)
+    cache_file = cache_dir / f"{CP_cache_key(sim, key_params)}.json"
+    if cache_file.exists():
+        with open(cache_file, "rt", encoding="utf-8") as f:
+            solution = CPSolution(**json.load(f))
+        if solution.status in ("OPTIMAL", "FEASIBLE"):
+            return solution
+
+    solution = solve_CP(sim, **solver_params)
+    if solution is None:
+        return None
+
+    # write to a temporary file first so that concurrent readers never see a partial file
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_dir / f"{cache_file.name}.{os.getpid()}.tmp"
+    with open(tmp_file, "wt", encoding="utf-8") as f:
+        json.dump(asdict(solution), f)
+    os.replace(tmp_file, cache_file)
+    return solution
 
 if __name__ == "__main__":
     intersection = read_intersection_from_json("../intersection_configs/2x2.json")
     sim = Simulator(intersection)
     sim.load_traffic("./tmp/0.json")
-    sim.run()
+    sim.start()
     print(f"{solve_by_CP(sim):.4f}")
@@ -0,0 +1,146 @@
+'''
+The vertices of the TCG are numbered in the iteration order of a set of vehicles,
+which depends on the hash of strings, so run the benchmarks with a fixed PYTHONHASHSEED
+to compare results across processes, e.g. PYTHONHASHSEED=0 python -m benchmarks.simulator
+'''
+from typing import Callable, Dict, Iterable, List, Tuple
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+
+from simulation import Simulator, Intersection
+from traffic_gen import random_traffic_generator
+
+INTERSECTION_CONFIGS: Dict[str, str] = {
+    "1x1": "../intersection_configs/1x1.json",
+    "2x2": "../intersection_configs/2x2.json",
+    "2x2-wo-right-turn": "../intersection_configs/2x2-wo-right-turn.json"
+}
+
+
+def fixed_seed_sims(
+    intersection: Intersection,
+    num_sims: int,
+    max_vehicle_num: int,
+    density: float,
+    seed: int = 0,
+    mode: str = "stream"
+) -> List[Simulator]:
+    random.seed(seed)
+    np.random.seed(seed)
+    return list(random_traffic_generator(
+        intersection,
+        num_iter=num_sims,
+        max_vehicle_num=max_vehicle_num,
+        poisson_parameter_list=[density],
+        mode=mode
+    ))
+
+
+class Timer:
+    '''
+    accumulate the durations of the timed blocks, in seconds
+    '''
+    def __init__(self):
+        self.durations: List[float] = []
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.durations.append(time.perf_counter() - self._start)
+
+    @property
+    def total(self) -> float:
+        return sum(self.durations)
+
+    def mean(self) -> float:
+        return self.total / len(self.durations) if len(self.durations) > 0 else 0.0
+
+    def percentile(self, q: float) -> float:
+        return float(np.percentile(self.durations, q)) if len(self.durations) > 0 else 0.0
+
+
+def measure_peak_memory(fn: Callable, *args, **kwargs) -> Tuple[object, int]:
+    '''
+    run fn and return its result and the peak of the memory allocated by Python during the call, in bytes
+    '''
+    tracemalloc.start()
+    try:
+        res = fn(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return res, peak
+
+
+def benchmark_metadata() -> Dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python_hash_seed": os.environ.get("PYTHONHASHSEED", None)
+    }
+
+
+def write_results(output_file: str, name: str, params: Dict, results: List[Dict]) -> None:
+    with open(output_file, "wt", encoding="utf-8") as f:
+        json.dump({
+            "benchmark": name,
+            "metadata": benchmark_metadata(),
+            "params": params,
+            "results": results
+        }, f, indent=2)
+
+
+def compare_results(
+    baseline_file: str,
+    results: List[Dict],
+    key_fields: Iterable[str],
+    metrics: Dict[str, bool],
+    threshold: float = 0.2
+) -> List[Dict]:
+    '''
+    compare results with the results stored in baseline_file, rows are matched by key_fields
+    metrics: metric name -> whether higher is better
+    return the rows whose metrics are worse than the baseline by more than threshold
+    '''
+    with open(baseline_file, "rt", encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    key_fields = list(key_fields)
+    baseline_rows = {tuple(row[k] for k in key_fields): row for row in baseline["results"]}
+    regressions = []
+    for row in results:
+        key = tuple(row[k] for k in key_fields)
+        if key not in baseline_rows:
+            continue
+        base_row = baseline_rows[key]
+        for metric, higher_is_better in metrics.items():
+            old, new = base_row.get(metric, None), row.get(metric, None)
+            if old is None or new is None or old == 0:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > threshold:
+                flag = "  <- regression"
+                regressions.append({**{k: row[k] for k in key_fields}, "metric": metric,
+                                    "baseline": old, "current": new})
+            print(f"{', '.join(str(k) for k in key)} | {metric}: {old:.4g} -> {new:.4g} ({change:+.1%}){flag}")
+    return regressions
@@ -0,0 +1,282 @@
+from typing import Dict, List, Optional, Sequence
+import copy
+import gc
+import random
+import sys
+import tracemalloc
+
+import fire
+import numpy as np
+from tqdm import tqdm
+
+from simulation import Simulator, Vehicle, VehicleState
+from utility import read_intersection_from_json
+from environment import RawStateSimulatorEnv
+from environment.tabular import vehicle_based, position_based
+from environment.func_approx import MinimumEnv
+from policy import IGreedyPolicy
+
+from .common import INTERSECTION_CONFIGS, Timer, fixed_seed_sims, write_results, compare_results
+
+ENV_FAMILIES = ("minimum", "vehicle_based", "position_based", "raw_state")
+
+KEY_FIELDS = ("config", "family", "policy")
+# metric -> whether higher is better
+METRICS = {
+    "step_p50_us": False,
+    "step_p99_us": False,
+    "encode_p50_us": False,
+    "encode_p99_us": False,
+    "snapshot_p50_us": False,
+    "get_snapshots_ms": False,
+    "step_peak_alloc_kib": False,
+    "retained_blocks_per_step": False
+}
+
+
+class EnvAdapter:
+    '''
+    A uniform interface over the environment families, the actions index
+    the vehicles included in the state of the environment
+    '''
+    def __init__(self, family: str, sim: Simulator, max_vehicle_num: int, snapshot: bool):
+        self.family: str = family
+        if family == "minimum":
+            self.env = MinimumEnv(sim, max_vehicle_num)
+            self.env.raw_state_env.snapshot = snapshot
+        elif family == "vehicle_based":
+            self.env = vehicle_based.SimulatorEnv(sim, max_vehicle_num=max_vehicle_num)
+            self.env.raw_state_env.snapshot = snapshot
+        elif family == "position_based":
+            self.env = position_based.SimulatorEnv(sim)
+        elif family == "raw_state":
+            self.env = RawStateSimulatorEnv(sim, snapshot=snapshot)
+        else:
+            raise Exception(f"[EnvAdapter] unknown environment family: {family}")
+
+    @property
+    def sim(self) -> Simulator:
+        return self.env.sim
+
+    def reset(self) -> None:
+        self.env.reset()
+
+    def step(self, action: int) -> bool:
+        '''
+        return whether the episode terminates
+        '''
+        if self.family == "minimum":
+            return self.env.step(np.int32(action)).is_last()
+        return self.env.step(action)[2]
+
+    def raw_vehicles(self) -> List[Vehicle]:
+        if self.family == "raw_state":
+            return self.env.history[-1][1]
+        if self.family == "position_based":
+            return self.env.prev_vehicles
+        return self.env.raw_state_env.history[-1][1]
+
+    def included_vehicles(self) -> List[Vehicle]:
+        if self.family in ("minimum", "vehicle_based"):
+            return self.env.prev_included_vehicles
+        return self.raw_vehicles()
+
+    def can_encode(self) -> bool:
+        return self.family in ("minimum", "vehicle_based")
+
+    def encode(self) -> None:
+        self.env._encode_state_from_vehicles(self.raw_vehicles())
+
+    def takes_snapshots(self) -> bool:
+        if self.family == "raw_state":
+            return self.env.snapshot
+        if self.family in ("minimum", "vehicle_based"):
+            return self.env.raw_state_env.snapshot
+        return False
+
+    def can_get_snapshots(self) -> bool:
+        return self.family in ("minimum", "vehicle_based") and self.takes_snapshots()
+
+
+def choose_action(
+    adapter: EnvAdapter,
+    policy: str,
+    rng: random.Random,
+    igreedy: IGreedyPolicy
+) -> int:
+    included = adapter.included_vehicles()
+    if policy == "igreedy":
+        raw_vehicles = adapter.raw_vehicles()
+        raw_action = igreedy.decide(raw_vehicles)
+        if raw_action == 0:
+            return 0
+        vehicle_id = raw_vehicles[raw_action - 1].id
+        return next((i + 1 for i, vehicle in enumerate(included) if vehicle.id == vehicle_id), 0)
+    if policy == "random":
+        ready = [i + 1 for i, vehicle in enumerate(included) if vehicle.state == VehicleState.READY]
+        return rng.choice(ready) if len(ready) > 0 else 0
+    raise Exception(f"[choose_action] unknown policy: {policy}")
+
+
+def run_episode(
+    adapter: EnvAdapter,
+    policy: str,
+    seed: int,
+    igreedy: IGreedyPolicy,
+    max_steps: int,
+    step_hook=None
+) -> int:
+    '''
+    step_hook(action) -> terminal replaces adapter.step, return the number of steps
+    '''
+    step_hook = adapter.step if step_hook is None else step_hook
+    rng = random.Random(seed)
+    adapter.reset()
+    num_steps = 0
+    terminal = False
+    while not terminal and num_steps < max_steps:
+        terminal = step_hook(choose_action(adapter, policy, rng, igreedy))
+        num_steps += 1
+    return num_steps
+
+
+def benchmark_family(
+    family: str,
+    sims: List[Simulator],
+    max_vehicle_num: int,
+    policy: str,
+    snapshot: bool,
+    seed: int,
+    max_steps: int
+) -> Dict:
+    step_timer, encode_timer, snapshot_timer, get_snapshots_timer = Timer(), Timer(), Timer(), Timer()
+    step_peak_allocs, retained_blocks = [], []
+    num_steps = 0
+    for i, sim in enumerate(sims):
+        igreedy = IGreedyPolicy(RawStateSimulatorEnv(sim, snapshot=False))
+
+        adapter = EnvAdapter(family, copy.deepcopy(sim), max_vehicle_num, snapshot)
+
+        def timed_step(action: int) -> bool:
+            with step_timer:
+                terminal = adapter.step(action)
+            if adapter.can_encode():
+                with encode_timer:
+                    adapter.encode()
+            # the raw state environment copies the simulator after every step to take a snapshot
+            if adapter.takes_snapshots():
+                with snapshot_timer:
+                    copy.deepcopy(adapter.sim)
+            return terminal
+
+        gc.collect()
+        gc.disable()
+        try:
+            num_steps += run_episode(adapter, policy, seed + i, igreedy, max_steps, timed_step)
+            if adapter.can_get_snapshots():
+                with get_snapshots_timer:
+                    adapter.env.get_snapshots()
+        finally:
+            gc.enable()
+
+        # tracemalloc slows down the allocations, so the allocations are measured in a separate run
+        adapter = EnvAdapter(family, copy.deepcopy(sim), max_vehicle_num, snapshot)
+
+        def traced_step(action: int) -> bool:
+            tracemalloc.reset_peak()
+            current_before = tracemalloc.get_traced_memory()[0]
+            blocks_before = sys.getallocatedblocks()
+            terminal = adapter.step(action)
+            step_peak_allocs.append(tracemalloc.get_traced_memory()[1] - current_before)
+            retained_blocks.append(sys.getallocatedblocks() - blocks_before)
+            return terminal
+
+        tracemalloc.start()
+        try:
+            run_episode(adapter, policy, seed + i, igreedy, max_steps, traced_step)
+        finally:
+            tracemalloc.stop()
+
+    return {
+        "num_sims": len(sims),
+        "num_steps": num_steps,
+        "step_p50_us": step_timer.percentile(50) * 1e6,
+        "step_p99_us": step_timer.percentile(99) * 1e6,
+        "encode_p50_us": encode_timer.percentile(50) * 1e6 if len(encode_timer.durations) > 0 else None,
+        "encode_p99_us": encode_timer.percentile(99) * 1e6 if len(encode_timer.durations) > 0 else None,
+        "snapshot_p50_us": snapshot_timer.percentile(50) * 1e6 if len(snapshot_timer.durations) > 0 else None,
+        "get_snapshots_ms": get_snapshots_timer.mean() * 1e3 if len(get_snapshots_timer.durations) > 0 else None,
+        "step_peak_alloc_kib": float(np.median(step_peak_allocs)) / 2**10,
+        "retained_blocks_per_step": float(np.mean(retained_blocks))
+    }
+
+
+def main(
+    output_file: str = "benchmark_environments.json",
+    configs: Sequence[str] = tuple(INTERSECTION_CONFIGS),
+    families: Sequence[str] = ENV_FAMILIES,
+    max_vehicle_num: int = 8,
+    density: float = 1.0,
+    num_sims: int = 5,
+    policy: str = "igreedy",
+    snapshot: bool = True,
+    seed: int = 0,
+    max_steps: int = 10000,
+    baseline_file: Optional[str] = None,
+    threshold: float = 0.2
+):
+    '''
+    drive every environment family with the same fixed-seed traffic and a fixed policy ("igreedy"
+    or "random" valid actions); snapshot_p50_us is the cost of the copy of the simulator the raw
+    state environment takes after every step, None for the families that take no snapshots
+    '''
+    if isinstance(configs, str):
+        configs = (configs,)
+    if isinstance(families, str):
+        families = (families,)
+
+    results = []
+    pbar = tqdm(total=len(configs) * len(families))
+    for config in configs:
+        intersection = read_intersection_from_json(INTERSECTION_CONFIGS[config])
+        sims = fixed_seed_sims(intersection, num_sims, max_vehicle_num, density, seed=seed)
+        for family in families:
+            row = {"config": config, "family": family, "policy": policy}
+            try:
+                row.update(benchmark_family(family, sims, max_vehicle_num, policy, snapshot, seed, max_steps))
+            except Exception as e:
+                row["error"] = f"{type(e).__name__}: {e}"
+            results.append(row)
+            pbar.update(1)
+    pbar.close()
+
+    for row in results:
+        if "error" in row:
+            print(f"{row['config']}, {row['family']}: failed, {row['error']}")
+            continue
+        encode = "-" if row["encode_p50_us"] is None else f"{row['encode_p50_us']:.1f} us"
+        snapshot_cost = "-" if row["snapshot_p50_us"] is None else f"{row['snapshot_p50_us']:.1f} us"
+        print(f"{row['config']}, {row['family']}: step p50 {row['step_p50_us']:.1f} us, "
+              f"p99 {row['step_p99_us']:.1f} us, encode p50 {encode}, "
+              f"snapshot p50 {snapshot_cost}, "
+              f"peak alloc {row['step_peak_alloc_kib']:.1f} KiB/step, "
+              f"retained {row['retained_blocks_per_step']:.1f} blocks/step")
+
+    write_results(output_file, "environments", {
+        "configs": list(configs),
+        "families": list(families),
+        "max_vehicle_num": max_vehicle_num,
+        "density": density,
+        "num_sims": num_sims,
+        "policy": policy,
+        "snapshot": snapshot,
+        "seed": seed
+    }, results)
+
+    if baseline_file is not None:
+        regressions = compare_results(baseline_file, results, KEY_FIELDS, METRICS, threshold=threshold)
+        print(f"{len(regressions)} regressions")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
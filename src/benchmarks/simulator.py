@@ -0,0 +1,174 @@
+from typing import Dict, List, Optional, Sequence
+import copy
+import gc
+
+import fire
+from tqdm import tqdm
+
+from simulation import Simulator, SimulatorStatus
+from simulation.tcg import TimingConflictGraph
+from utility import read_intersection_from_json
+
+from .common import INTERSECTION_CONFIGS, Timer, fixed_seed_sims, measure_peak_memory, \
+    write_results, compare_results
+
+KEY_FIELDS = ("config", "max_vehicle_num", "density")
+# metric -> whether higher is better
+METRICS = {
+    "steps_per_sec": True,
+    "tcg_build_ms": False,
+    "start_ms": False,
+    "delayed_time_us": False,
+    "peak_memory_mib": False
+}
+
+
+def record_decisions(sim: Simulator) -> List[Optional[str]]:
+    '''
+    run IGreedy on a copy of the simulator and return the moved vehicle id of each step,
+    so that the timed runs replay the same episode without the cost of the policy
+    '''
+    # imported here since the environments pull in TensorFlow
+    from environment import RawStateSimulatorEnv
+    from policy import IGreedyPolicy
+
+    sim = copy.deepcopy(sim)
+    policy = IGreedyPolicy(RawStateSimulatorEnv(sim, snapshot=False))
+    sim.start()
+    decisions = []
+    while sim.status == SimulatorStatus.RUNNING:
+        vehicles = sim.observe()["vehicles"]
+        action = policy.decide(vehicles)
+        decisions.append(vehicles[action - 1].id if action > 0 else None)
+        sim.step(decisions[-1])
+    return decisions
+
+
+def replay(
+    sim: Simulator,
+    decisions: List[Optional[str]],
+    step_timer: Optional[Timer] = None,
+    delayed_time_timer: Optional[Timer] = None
+) -> int:
+    '''
+    restart the simulator and replay the decisions, the cumulative delayed time is
+    queried after every step as the environments do; return the number of steps
+    '''
+    step_timer = Timer() if step_timer is None else step_timer
+    delayed_time_timer = Timer() if delayed_time_timer is None else delayed_time_timer
+    sim.start()
+    num_steps = 0
+    for moved_vehicle_id in decisions:
+        if sim.status != SimulatorStatus.RUNNING:
+            break
+        with step_timer:
+            sim.step(moved_vehicle_id)
+        with delayed_time_timer:
+            sim.get_cumulative_delayed_time()
+        num_steps += 1
+    return num_steps
+
+
+def benchmark_sims(sims: List[Simulator], repeat: int = 3) -> Dict:
+    '''
+    every measurement is repeated and the fastest run is kept to reduce the noise
+    '''
+    tcg_build_time, start_time, step_time, delayed_time_time = 0.0, 0.0, 0.0, 0.0
+    num_steps = 0
+    peak_memory = 0
+    for sim in sims:
+        decisions = record_decisions(sim)
+        tcg_build_timer, start_timer = Timer(), Timer()
+        runs = []
+        # like timeit, the garbage collector is disabled while timing
+        gc.collect()
+        gc.disable()
+        try:
+            for _ in range(repeat):
+                with tcg_build_timer:
+                    TimingConflictGraph(set(sim.vehicles), sim.intersection)
+                with start_timer:
+                    sim.start()
+            for _ in range(repeat):
+                step_timer, delayed_time_timer = Timer(), Timer()
+                sim_steps = replay(sim, decisions, step_timer, delayed_time_timer)
+                runs.append((step_timer.total, delayed_time_timer.total))
+        finally:
+            gc.enable()
+        tcg_build_time += min(tcg_build_timer.durations)
+        start_time += min(start_timer.durations)
+        num_steps += sim_steps
+        step_time += min(run[0] for run in runs)
+        delayed_time_time += min(run[1] for run in runs)
+
+        # tracemalloc slows down the allocations, so the memory is measured in a separate run
+        _, peak = measure_peak_memory(replay, sim, decisions)
+        peak_memory = max(peak_memory, peak)
+
+    return {
+        "num_sims": len(sims),
+        "avg_vehicle_num": sum(len(sim.vehicles) for sim in sims) / len(sims),
+        "num_steps": num_steps,
+        "steps_per_sec": num_steps / step_time if step_time > 0 else 0.0,
+        "tcg_build_ms": tcg_build_time / len(sims) * 1e3,
+        "start_ms": start_time / len(sims) * 1e3,
+        "delayed_time_us": delayed_time_time / num_steps * 1e6 if num_steps > 0 else 0.0,
+        "peak_memory_mib": peak_memory / 2**20
+    }
+
+
+def main(
+    output_file: str = "benchmark_simulator.json",
+    configs: Sequence[str] = tuple(INTERSECTION_CONFIGS),
+    vehicle_nums: Sequence[int] = (8, 16, 32),
+    densities: Sequence[float] = (0.5, 1.0, 2.0),
+    num_sims: int = 5,
+    seed: int = 0,
+    repeat: int = 3,
+    baseline_file: Optional[str] = None,
+    threshold: float = 0.2
+):
+    '''
+    benchmark Simulator.start, step, get_cumulative_delayed_time and the TCG construction
+    on fixed-seed traffic; densities are the Poisson parameters of random_traffic_generator
+    '''
+    if isinstance(configs, str):
+        configs = (configs,)
+    results = []
+    pbar = tqdm(total=len(configs) * len(vehicle_nums) * len(densities))
+    for config in configs:
+        intersection = read_intersection_from_json(INTERSECTION_CONFIGS[config])
+        for max_vehicle_num in vehicle_nums:
+            for density in densities:
+                sims = fixed_seed_sims(intersection, num_sims, max_vehicle_num, density, seed=seed)
+                results.append({
+                    "config": config,
+                    "max_vehicle_num": max_vehicle_num,
+                    "density": density,
+                    **benchmark_sims(sims, repeat=repeat)
+                })
+                pbar.update(1)
+    pbar.close()
+
+    for res in results:
+        print(f"{res['config']}, n = {res['max_vehicle_num']}, density = {res['density']}: "
+              f"{res['steps_per_sec']:.0f} steps/s, TCG {res['tcg_build_ms']:.2f} ms, "
+              f"start {res['start_ms']:.2f} ms, delayed time {res['delayed_time_us']:.1f} us, "
+              f"peak {res['peak_memory_mib']:.2f} MiB")
+
+    write_results(output_file, "simulator", {
+        "configs": list(configs),
+        "vehicle_nums": list(vehicle_nums),
+        "densities": list(densities),
+        "num_sims": num_sims,
+        "seed": seed,
+        "repeat": repeat
+    }, results)
+
+    if baseline_file is not None:
+        regressions = compare_results(baseline_file, results, KEY_FIELDS, METRICS, threshold=threshold)
+        print(f"{len(regressions)} regressions")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
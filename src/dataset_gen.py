@@ -0,0 +1,137 @@
+from typing import Dict, List, Optional, Sequence
+from pathlib import Path
+import hashlib
+import json
+import multiprocessing as mp
+import time
+
+import fire
+import numpy as np
+from tqdm import tqdm
+
+from simulation import Intersection
+from utility import read_intersection_from_json
+from traffic_gen import sample_random_traffic, dump_traffic_npz, check_arrival_process, MANIFEST_FILE, TRAFFIC_NPZ_VERSION
+
+# scenarios sampled together, bounds the size of the arrival arrays
+CHUNK_SIZE = 256
+
+
+def shard_rng(seed: int, shard_idx: int) -> np.random.Generator:
+    '''
+    the traffic of a shard only depends on the seed and its index, not on the number of workers
+    '''
+    return np.random.default_rng([seed, shard_idx])
+
+
+def generate_shard(task) -> Dict:
+    '''
+    task: (shard index, number of scenarios, output file, generation params)
+    '''
+    shard_idx, num_scenarios, output_file, params = task
+    intersection: Intersection = read_intersection_from_json(params["intersection_file_path"])
+    rng = shard_rng(params["seed"], shard_idx)
+
+    sims = []
+    while len(sims) < num_scenarios:
+        chunk_size = min(CHUNK_SIZE, num_scenarios - len(sims))
+        p = rng.choice(params["poisson_parameter_list"], size=chunk_size) / 10
+        sims.extend(sample_random_traffic(
+            intersection,
+            chunk_size,
+            max_vehicle_num=params["max_vehicle_num"],
+            max_time=params["max_time"],
+            p=p,
+            arrival_process=params["arrival_process"],
+            rate_profile=params["rate_profile"],
+            mean_burst_size=params["mean_burst_size"],
+            rng=rng
+        ))
+
+    first_idx = shard_idx * params["shard_size"]
+    dump_traffic_npz(sims, output_file, names=[str(first_idx + i) for i in range(num_scenarios)])
+    with open(output_file, "rb") as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
+    return {
+        "index": shard_idx,
+        "file": Path(output_file).name,
+        "num_scenarios": num_scenarios,
+        "num_vehicles": sum(len(sim.vehicles) for sim in sims),
+        "sha256": sha256
+    }
+
+
+def main(
+    intersection_file_path: str,
+    output_dir: str,
+    num: int = 10000,
+    shard_size: int = 1000,
+    num_workers: int = 0,
+    seed: int = 0,
+    max_vehicle_num: int = 8,
+    max_time: int = 300,
+    poisson_parameter_list: Sequence[float] = (0.5,),
+    arrival_process: str = "bernoulli",
+    rate_profile: Optional[Sequence[float]] = None,
+    mean_burst_size: float = 3.0
+):
+    '''
+    generate num random scenarios into .npz shards of shard_size scenarios and a manifest,
+    the output directory can be passed wherever a traffic data directory is expected
+    poisson_parameter_list: the expected arrivals per source lane per 10 timestamps, one is
+                            picked for every scenario as in traffic_gen
+    arrival_process, rate_profile, mean_burst_size: see traffic_gen.sample_random_traffic
+    '''
+    if isinstance(poisson_parameter_list, (int, float)):
+        poisson_parameter_list = (poisson_parameter_list,)
+    check_arrival_process(arrival_process, mean_burst_size)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if (output_dir / MANIFEST_FILE).exists():
+        raise Exception(f"[dataset_gen] {output_dir} already contains a dataset")
+
+    params = {
+        "intersection_file_path": intersection_file_path,
+        "num": num,
+        "shard_size": shard_size,
+        "seed": seed,
+        "max_vehicle_num": max_vehicle_num,
+        "max_time": max_time,
+        "poisson_parameter_list": list(poisson_parameter_list),
+        "arrival_process": arrival_process,
+        "rate_profile": None if rate_profile is None else list(rate_profile),
+        "mean_burst_size": mean_burst_size
+    }
+    num_shards = (num + shard_size - 1) // shard_size
+    tasks = [
+        (i, min(shard_size, num - i * shard_size), str(output_dir / f"shard-{i:05d}.npz"), params)
+        for i in range(num_shards)
+    ]
+
+    shards: List[Dict] = []
+    start_time = time.perf_counter()
+    if num_workers > 0:
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(num_workers) as pool:
+            for shard in tqdm(pool.imap_unordered(generate_shard, tasks), total=num_shards):
+                shards.append(shard)
+    else:
+        for task in tqdm(tasks):
+            shards.append(generate_shard(task))
+    shards.sort(key=lambda shard: shard["index"])
+
+    # the manifest is written last, a directory without one is an interrupted run
+    with open(output_dir / MANIFEST_FILE, "wt", encoding="utf-8") as f:
+        json.dump({
+            "format": "npz",
+            "format_version": TRAFFIC_NPZ_VERSION,
+            "params": params,
+            "num_scenarios": sum(shard["num_scenarios"] for shard in shards),
+            "num_vehicles": sum(shard["num_vehicles"] for shard in shards),
+            "shards": shards
+        }, f, indent=2)
+    print(f"generated {num} scenarios in {num_shards} shards in {time.perf_counter() - start_time:.1f} s")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
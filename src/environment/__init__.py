@@ -1,3 +1,7 @@
+# CP-SAT crashes when TensorFlow (pulled in by the environments) is loaded before OR-tools,
+# so load OR-tools here, ahead of every environment
+from ortools.sat.python import cp_model  # noqa: F401
+
 from . import tabular
 from . import func_approx
 from .raw_state import RawStateSimulatorEnv
@@ -1,21 +1,87 @@
 import random
+import queue
+import traceback
+import multiprocessing as mp
+from typing import Dict, Optional
 
 from tf_agents.environments import py_environment
 
 from traffic_gen import random_traffic_generator
 
 
+def generate_snapshot_envs(origin_env, traffic_generator):
+    '''
+    roll out the generated traffic with a random policy and yield the snapshot environments
+    '''
+    for new_sim in traffic_generator:
+        time_step = origin_env._reset(new_sim=new_sim)
+        while not time_step.is_last():
+            valid_action_mask = time_step.observation["valid_actions"]
+            valid_actions = [a for a, valid in enumerate(valid_action_mask) if valid]
+            action = random.choice(valid_actions)
+            time_step = origin_env._step(action)
+
+        for _, env in origin_env.get_snapshots():
+            yield env
+
+# seconds to wait for a snapshot before checking that the workers are still alive
+WORKER_POLL_INTERVAL = 10
+
+
+class SnapshotWorkerError:
+    '''
+    put on the queue by a worker which failed, carries the formatted traceback
+    '''
+    def __init__(self, message: str):
+        self.message: str = message
+
+def snapshot_env_worker(origin_env, seed: int, env_queue, generator_kwargs: Dict) -> None:
+    random.seed(seed)
+    try:
+        traffic_generator = random_traffic_generator(origin_env.sim.intersection, **generator_kwargs)
+        for env in generate_snapshot_envs(origin_env, traffic_generator):
+            env_queue.put(env)
+    except BaseException:
+        env_queue.put(SnapshotWorkerError(traceback.format_exc()))
+        raise
+
+
 class AutoGenTrafficWrapperEnv(py_environment.PyEnvironment):
-    def __init__(self, env):
+    '''
+    Serve snapshot environments of randomly generated traffic. With num_workers > 0,
+    the traffic generation and rollouts run in background processes which keep a
+    bounded queue of snapshot environments filled.
+    '''
+    def __init__(
+        self,
+        env,
+        num_workers: int = 0,
+        queue_size: int = 256,
+        seed: Optional[int] = None
+    ):
         self.env_buffer = []
         self.origin_env = env
         self.current_env = None
-        self.traffic_generator = random_traffic_generator(
-            env.sim.intersection,
-            num_iter = -1,
-            max_vehicle_num = 20,
-            mode = "stream"
-        )
+        self.generator_kwargs = {"num_iter": -1, "max_vehicle_num": 20, "mode": "stream"}
+        # the workers generate the traffic themselves
+        self.traffic_generator = None if num_workers > 0 \
+            else random_traffic_generator(env.sim.intersection, **self.generator_kwargs)
+
+        self.env_queue = None
+        self.workers = []
+        if num_workers > 0:
+            if seed is None:
+                seed = random.randrange(1 << 30)
+            ctx = mp.get_context("spawn")
+            self.env_queue = ctx.Queue(maxsize=queue_size)
+            for i in range(num_workers):
+                worker = ctx.Process(
+                    target=snapshot_env_worker,
+                    args=(env, seed + i, self.env_queue, self.generator_kwargs),
+                    daemon=True
+                )
+                worker.start()
+                self.workers.append(worker)
 
     @property
     def max_vehicle_num(self):
@@ -53,18 +119,32 @@ class AutoGenTrafficWrapperEnv(py_environment.PyEnvironment):
         return time_step
 
     def get_new_env(self):
-        if self.env_buffer:
-            return self.env_buffer.pop(0)
+        if self.env_queue is not None:
+            while True:
+                try:
+                    env = self.env_queue.get(timeout=WORKER_POLL_INTERVAL)
+                except queue.Empty:
+                    # a worker killed by a signal (e.g. OOM) cannot report its failure
+                    for worker in self.workers:
+                        if not worker.is_alive():
+                            raise Exception(f"[AutoGenTrafficWrapperEnv.get_new_env] snapshot worker "
+                                            f"{worker.pid} exited with code {worker.exitcode}")
+                    continue
+                if isinstance(env, SnapshotWorkerError):
+                    raise Exception(f"[AutoGenTrafficWrapperEnv.get_new_env] snapshot worker failed:\n{env.message}")
+                return env
 
-        new_sim = next(self.traffic_generator)
-        time_step = self.origin_env._reset(new_sim=new_sim)
-        while not time_step.is_last():
-            valid_action_mask = self.origin_env.get_valid_action_mask(time_step.observation["observation"])
-            valid_actions = [a for a, valid in enumerate(valid_action_mask) if valid]
-            action = random.choice(valid_actions)
-            time_step = self.origin_env._step(action)
+        while not self.env_buffer:
+            new_sim = next(self.traffic_generator)
+            self.env_buffer.extend(generate_snapshot_envs(self.origin_env, iter([new_sim])))
 
-        for _, env in self.origin_env.get_snapshots():
-            self.env_buffer.append(env)
+        return self.env_buffer.pop(0)
 
-        return self.get_new_env()
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
+            worker.join()
+        self.workers = []
+        if self.env_queue is not None:
+            self.env_queue.close()
+            self.env_queue = None
@@ -1,4 +1,4 @@
-from typing import Iterable, Tuple
+from typing import Iterable, Tuple, Dict
 from copy import deepcopy
 
 from tf_agents.environments import py_environment
@@ -7,6 +7,7 @@ from tf_agents.trajectories import time_step as ts
 import numpy as np
 
 from simulation import Simulator, Vehicle, VehicleState
+from profiling import profiler, profiled
 from environment.raw_state import RawStateSimulatorEnv
 
 
@@ -46,8 +47,19 @@ class MinimumEnv(py_environment.PyEnvironment):
         }
 
         self._state = np.zeros(self.state_size, dtype=np.int32)
+        self._valid_action_mask = np.ones(self.max_vehicle_num + 1, dtype=np.bool_)
         self._episode_ended = False
 
+        # lookup tables and buffers for building observations with array operations
+        self.cz_index: Dict[str, int] = {cz_id: i + 1 for i, cz_id in enumerate(self.sorted_cz_ids)}
+        self.src_lane_index: Dict[str, int] = {
+            src_lane_id: i for i, src_lane_id in enumerate(sorted(self.sim.intersection.src_lanes))}
+        self.trajectory_index: Dict[Tuple[str], int] = {}
+        self._trajectory_table = np.zeros((0, 2 * self.field_sizes[0]), dtype=np.int32)
+        for traj in sorted(self.sim.intersection.trajectories):
+            self._get_trajectory_id(traj)
+        self._vehicle_buffer = np.zeros((max_vehicle_num, sum(self.field_sizes)), dtype=np.int32)
+
     def action_spec(self):
         return self._action_spec
 
@@ -78,50 +90,64 @@ class MinimumEnv(py_environment.PyEnvironment):
         return vehicles
 
     def get_valid_action_mask(self, state):
-        vehicles = self.decode_state(state)
-        action_mask = [False for _ in range(self.max_vehicle_num+1)]
-        occupied_cz = set()
-        waiting_src_lane = set()
-        for trajectory, position, state in vehicles:
-            if position >= 0:
-                occupied_cz.add(trajectory[position])
-            elif state:
-                waiting_src_lane.add(trajectory[0])
-        
-        someone_waiting = False
-        for i, (trajectory, position, state) in enumerate(vehicles):
-            if state:
-                action_mask[i + 1] = True
-                someone_waiting = True
-            if not state and not (position == -1 and trajectory[0] in waiting_src_lane):
-                if position != len(trajectory) - 1:
-                    next_cz = trajectory[position + 1]
-                    if next_cz not in occupied_cz:
-                        action_mask[0] = True
-                else:
-                    action_mask[0] = True
-
-        if not someone_waiting:
-            action_mask[0] = True
-
-        return np.array(action_mask, dtype=np.bool_)
-
-    def make_observation(self, state):
+        return self.get_batch_valid_action_mask(np.asarray(state)[None])[0]
+
+    def get_batch_valid_action_mask(self, states):
+        states = np.asarray(states)
+        return self._get_valid_action_masks(
+            states.reshape(states.shape[0], self.max_vehicle_num, sum(self.field_sizes)))
+
+    def _get_valid_action_masks(self, vehicle_states: np.ndarray) -> np.ndarray:
+        '''
+        vehicle_states: [B, n, sum(field_sizes)] array of encoded vehicles, n <= max_vehicle_num
+        '''
+        batch_size, vehicle_num = vehicle_states.shape[:2]
+        trajectories = vehicle_states[:, :, :self.field_sizes[0]]
+        position = vehicle_states[:, :, self.field_sizes[0]] - 2
+        is_ready = vehicle_states[:, :, self.field_sizes[0] + 1] != 0
+        included = np.cumprod(vehicle_states[:, :, self.field_sizes[0]] != 0, axis=1).astype(np.bool_)
+        traj_len = np.cumprod(trajectories != 0, axis=2).sum(axis=2)
+        batch_idx = np.broadcast_to(np.arange(batch_size)[:, None], position.shape)
+        first_cz = trajectories[:, :, 0]
+
+        in_cz = included & (position >= 0)
+        occupied_cz = np.zeros((batch_size, len(self.sorted_cz_ids) + 1), dtype=np.bool_)
+        occupied_cz[batch_idx[in_cz], first_cz[in_cz]] = True
+        waiting = included & (position < 0) & is_ready
+        waiting_src_lane = np.zeros_like(occupied_cz)
+        waiting_src_lane[batch_idx[waiting], first_cz[waiting]] = True
+
+        next_cz = np.take_along_axis(
+            trajectories, np.minimum(position + 1, self.field_sizes[0] - 1)[:, :, None], axis=2)[:, :, 0]
+        blocked_by_queue = (position == -1) & waiting_src_lane[batch_idx, first_cz]
+        can_move = (position == traj_len - 1) | ~occupied_cz[batch_idx, next_cz]
+
+        action_mask = np.zeros((batch_size, self.max_vehicle_num + 1), dtype=np.bool_)
+        action_mask[:, 1:vehicle_num + 1] = included & is_ready
+        action_mask[:, 0] = (included & ~is_ready & ~blocked_by_queue & can_move).any(axis=1) \
+                            | ~action_mask[:, 1:].any(axis=1)
+
+        return action_mask
+
+    def make_observation(self, state, valid_action_mask=None):
+        if valid_action_mask is None:
+            valid_action_mask = self.get_valid_action_mask(state)
         ret = {
             "observation": state,
-            "valid_actions": self.get_valid_action_mask(state)
+            "valid_actions": valid_action_mask
         }
         return ret
 
     def _reset(self, new_sim=None):
         if self.is_snapshot:
             self.is_snapshot = False
-            return ts.restart(self.make_observation(self._state))
+            return ts.restart(self.make_observation(self._state, self._valid_action_mask))
         self.raw_state_env.reset(new_sim=new_sim)
         _, vehicles, _ = self.raw_state_env.history[-1]
-        self._state, self.prev_included_vehicles = self._encode_state_from_vehicles(vehicles)
+        self._state, self.prev_included_vehicles, self._valid_action_mask \
+            = self._encode_state_from_vehicles(vehicles)
         self._episode_ended = False
-        return ts.restart(self.make_observation(self._state))
+        return ts.restart(self.make_observation(self._state, self._valid_action_mask))
 
     def _step(self, action: int):
         if self._episode_ended:
@@ -142,20 +168,23 @@ class MinimumEnv(py_environment.PyEnvironment):
         _, delayed_time, self._episode_ended, _ = self.raw_state_env.step(raw_action)
 
         cur_vehicles: Iterable[Vehicle] = self.raw_state_env.history[-1][1]
-        next_state, self.prev_included_vehicles = self._encode_state_from_vehicles(cur_vehicles)
+        next_state, self.prev_included_vehicles, self._valid_action_mask \
+            = self._encode_state_from_vehicles(cur_vehicles)
 
         reward = -delayed_time
 
         if self._episode_ended:
-            return ts.termination(self.make_observation(next_state), reward)
+            return ts.termination(self.make_observation(next_state, self._valid_action_mask), reward)
 
-        return ts.transition(self.make_observation(next_state), reward=reward, discount=1.0)
+        return ts.transition(
+            self.make_observation(next_state, self._valid_action_mask), reward=reward, discount=1.0)
 
+    @profiled("MinimumEnv.get_snapshots")
     def get_snapshots(self):
         res = []
         vehicle_ids_prev = set()
         for i, (t_0, raw_vehicles_0, _) in enumerate(self.raw_state_env.history[:-1]):
-            S_0, vehicles_0 = self._encode_state_from_vehicles(raw_vehicles_0)
+            S_0, vehicles_0, valid_action_mask_0 = self._encode_state_from_vehicles(raw_vehicles_0)
             sim = self.raw_state_env.sim_snapshots[i]
 
             vehicle_ids_0 = {vehicle.id for vehicle in vehicles_0}
@@ -176,62 +205,68 @@ class MinimumEnv(py_environment.PyEnvironment):
             env_snapshot.prev_included_vehicles = deepcopy(vehicles_0)
             env_snapshot.raw_state_env.history.append([t_0, deepcopy(vehicles_0), ""])
             env_snapshot._state = S_0
+            env_snapshot._valid_action_mask = valid_action_mask_0
             env_snapshot.is_snapshot = True
 
             res.append((env_snapshot._state, env_snapshot))
 
+        profiler.count("MinimumEnv.snapshots", len(res))
         return res
 
+    def _get_trajectory_id(self, trajectory: Tuple[str]) -> int:
+        traj_id = self.trajectory_index.get(trajectory, None)
+        if traj_id is None:
+            # each row holds the encoded CZs followed by zero padding, so that
+            # the remaining part of a trajectory can be sliced at any position
+            row = np.zeros((1, self._trajectory_table.shape[1]), dtype=np.int32)
+            row[0, :len(trajectory)] = [self.cz_index[cz_id] for cz_id in trajectory]
+            traj_id = self._trajectory_table.shape[0]
+            self._trajectory_table = np.append(self._trajectory_table, row, axis=0)
+            self.trajectory_index[trajectory] = traj_id
+        return traj_id
+
+    @profiled("MinimumEnv._encode_state_from_vehicles")
     def _encode_state_from_vehicles(self, vehicles: Iterable[Vehicle]):
-        vehicles_near_intersection = []
-        for vehicle in vehicles:
-            if vehicle.state not in (VehicleState.LEFT, VehicleState.NOT_ARRIVED):
-                vehicles_near_intersection.append(vehicle)
-
-        def vehicle_priority_func(vehicle: Vehicle) -> int:
-            if 0 <= vehicle.idx_on_traj <= len(vehicle.trajectory) - 1:
-                return -1
-            if vehicle.state == VehicleState.READY:
-                return -1
-            if vehicle.idx_on_traj == -1 \
-                and vehicle.state in [VehicleState.READY, VehicleState.BLOCKED]:
-                num_pred_vehicles = 0
-                for other in vehicles:
-                    if other.src_lane_id == vehicle.src_lane_id \
-                        and other.idx_on_traj == -1 \
-                        and other.state in [VehicleState.READY, VehicleState.BLOCKED] \
-                        and other.earliest_arrival_time < vehicle.earliest_arrival_time:
-                        num_pred_vehicles += 1
-                return num_pred_vehicles
-            return 1000
-
-        vehicles_near_intersection.sort(key=vehicle_priority_func)
-
-        included_vehicles = []
-        for vehicle in vehicles_near_intersection:
-            included_vehicles.append(vehicle)
-            if len(included_vehicles) == self.max_vehicle_num:
-                break
-
-        vehicle_state_list = []
-        for vehicle in included_vehicles:
-            vehicle_state = np.zeros(sum(self.field_sizes), dtype=np.int32)
-
-            for i, cz_id in enumerate(vehicle.trajectory[max(vehicle.idx_on_traj, 0):]):
-                vehicle_state[i] = self.sorted_cz_ids.index(cz_id) + 1
-
-            vehicle_state[self.field_sizes[0]] = min(0, vehicle.idx_on_traj) + 2
-
-            if vehicle.state == VehicleState.READY:
-                vehicle_state[self.field_sizes[0] + 1] = 1
-
-            vehicle_state_list.append(vehicle_state)
-
-        indices = sorted(range(len(vehicle_state_list)), key=lambda i: vehicle_state_list[i].sum())
-        included_vehicles = [included_vehicles[i] for i in indices]
-        vehicle_state_list = [vehicle_state_list[i] for i in indices]
-
-        while len(vehicle_state_list) < self.max_vehicle_num:
-            vehicle_state_list.append(np.zeros(sum(self.field_sizes), dtype=np.int32))
-
-        return np.concatenate(vehicle_state_list), included_vehicles
+        vehicles = tuple(vehicles)
+        n = len(vehicles)
+        state = np.fromiter((vehicle.state.value for vehicle in vehicles), dtype=np.int64, count=n)
+        idx_on_traj = np.fromiter((vehicle.idx_on_traj for vehicle in vehicles), dtype=np.int64, count=n)
+        traj_len = np.fromiter((len(vehicle.trajectory) for vehicle in vehicles), dtype=np.int64, count=n)
+        src_lane = np.fromiter((self.src_lane_index[vehicle.src_lane_id] for vehicle in vehicles),
+                               dtype=np.int64, count=n)
+        arrival_time = np.fromiter((vehicle.earliest_arrival_time for vehicle in vehicles),
+                                   dtype=np.int64, count=n)
+
+        is_ready = state == VehicleState.READY.value
+        near_intersection = (state != VehicleState.LEFT.value) & (state != VehicleState.NOT_ARRIVED.value)
+        in_queue = (idx_on_traj == -1) & (is_ready | (state == VehicleState.BLOCKED.value))
+
+        # priority: vehicles in the intersection or ready to move first, then the queued
+        # vehicles by the number of queued vehicles arriving earlier from the same lane
+        lane_key_base = src_lane * (int(arrival_time.max(initial=0)) + 1)
+        sorted_keys = np.sort((lane_key_base + arrival_time)[in_queue])
+        num_pred_vehicles = np.searchsorted(sorted_keys, lane_key_base + arrival_time) \
+                            - np.searchsorted(sorted_keys, lane_key_base)
+        priority = np.full(n, 1000, dtype=np.int64)
+        priority[in_queue] = num_pred_vehicles[in_queue]
+        priority[((0 <= idx_on_traj) & (idx_on_traj < traj_len)) | is_ready] = -1
+
+        candidates = np.flatnonzero(near_intersection)
+        included = candidates[np.argsort(priority[candidates], kind="stable")][:self.max_vehicle_num]
+
+        rows = self._vehicle_buffer[:len(included)]
+        traj_ids = np.fromiter((self._get_trajectory_id(vehicles[i].trajectory) for i in included),
+                               dtype=np.int64, count=len(included))
+        traj_start = np.maximum(idx_on_traj[included], 0)
+        rows[:, :self.field_sizes[0]] = self._trajectory_table[
+            traj_ids[:, None], traj_start[:, None] + np.arange(self.field_sizes[0])]
+        rows[:, self.field_sizes[0]] = np.minimum(0, idx_on_traj[included]) + 2
+        rows[:, self.field_sizes[0] + 1] = is_ready[included]
+
+        order = np.argsort(rows.sum(axis=1), kind="stable")
+        res = np.zeros(self.state_size, dtype=np.int32)
+        vehicle_states = res.reshape(self.max_vehicle_num, -1)[:len(included)]
+        vehicle_states[:] = rows[order]
+        valid_action_mask = self._get_valid_action_masks(vehicle_states[None])[0]
+
+        return res, [vehicles[i] for i in included[order]], valid_action_mask
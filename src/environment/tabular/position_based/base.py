@@ -9,6 +9,7 @@ from gym import spaces
 import gym
 
 from simulation.intersection import Intersection
+from utility import BitsetDigraph
 
 
 class PositionBasedStateEnv(gym.Env):
@@ -116,30 +117,13 @@ class PositionBasedStateEnv(gym.Env):
 
     def _is_deadlock_raw_state(self, raw_state: int) -> bool:
         decoded_state: PositionBasedStateEnv.DecodedState = self._decode_raw_state(raw_state)
-        adj = {cz_id: [] for cz_id in self.sorted_cz_ids}
+        G = BitsetDigraph()
         for cz_id, cz_state in decoded_state.cz_state.items():
             next_pos = cz_state.next_position
             if next_pos and next_pos != "$" and cz_state.vehicle_state == "blocked":
-                adj[cz_id].append(next_pos)
-
-        color = {cz_id: "w" for cz_id in self.sorted_cz_ids}
-        def dfs(v: str):
-            color[v] = "g"
-            for u in adj[v]:
-                if color[u] == "w":
-                    if dfs(u):
-                        return True
-                elif color[u] == "g":
-                    return True
-            color[v] = "b"
-            return False
+                G.add_edge(cz_id, next_pos)
 
-        for cz_id in self.sorted_cz_ids:
-            if color[cz_id] == "w":
-                if dfs(cz_id):
-                    return True
-
-        return False
+        return G.has_cycle()
 
     def is_deadlock_state(self, state: int) -> bool:
         return self.deadlock_state_table[state]
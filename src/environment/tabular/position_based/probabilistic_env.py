@@ -4,10 +4,11 @@ import copy
 import math
 
 from tqdm import tqdm
+import numpy as np
 
 from simulation.intersection import Intersection
 from environment.tabular.position_based.base import PositionBasedStateEnv
-from utility import Digraph
+from utility import tarjan_scc
 
 
 class ProbabilisticEnv(PositionBasedStateEnv):
@@ -32,7 +33,8 @@ class ProbabilisticEnv(PositionBasedStateEnv):
         ]
 
         if self.enable_reachability_analysis:
-            self.reachable_states_without_op: List[Set[int]] = [None for s in range(self.state_space_size)]
+            self.scc_id: np.ndarray = np.zeros(0, dtype=np.int64)
+            self.scc_reachability: List[int] = []
             self.reachability_analysis()
 
     def get_higher_level_queue_size(self, queue_size: int):
@@ -285,36 +287,41 @@ class ProbabilisticEnv(PositionBasedStateEnv):
         return res
 
     def reachability_analysis(self) -> None:
-        state_transition_graph = Digraph()
         print("Conducting reachability analysis...")
+        indptr = np.zeros(self.state_space_size + 1, dtype=np.int64)
+        neighbors: List[int] = []
         for s in tqdm(range(self.state_space_size), desc="Building state transition graph", ascii=True, leave=False):
-            for _, next_s, _ in self.get_transitions(s, 0):
-                state_transition_graph.add_edge(s, next_s)
-        
-        print("Building condensation state transition graph...")
-        condensation_state_transition_graph = state_transition_graph.get_scc_graph()
+            neighbors.extend(next_s for _, next_s, _ in self.get_transitions(s, 0))
+            indptr[s + 1] = len(neighbors)
+        indices = np.array(neighbors, dtype=np.int64)
 
-        pbar = tqdm(desc="Calculating reachable states", total=self.state_space_size, leave=False, ascii=True)
-        def dfs(scc: Tuple) -> None:
-            if self.reachable_states_without_op[scc[0]] is not None:
-                return
-            self.reachable_states_without_op[scc[0]] = set(scc)
-            for child in condensation_state_transition_graph.get_neighbors(scc):
-                dfs(child)
-                self.reachable_states_without_op[scc[0]].update(self.reachable_states_without_op[child[0]])
-            for member in scc[1:]:
-                self.reachable_states_without_op[member] = self.reachable_states_without_op[scc[0]]
-            pbar.update(len(scc))
-
-        for scc in condensation_state_transition_graph.vertices:
-            dfs(scc)
-        
-        pbar.close()
+        print("Building condensation state transition graph...")
+        scc_id, num_scc = tarjan_scc(indptr, indices)
+        self.scc_id = scc_id
+
+        # SCC ids are in reverse topological order, so the successors of an SCC
+        # are always finished before it and its reachable set is one bitmask
+        # over the SCC ids that are not larger than its own
+        scc_id_list = scc_id.tolist()
+        scc_successors: List[Set[int]] = [set() for _ in range(num_scc)]
+        for s in range(self.state_space_size):
+            c = scc_id_list[s]
+            for next_s in neighbors[indptr[s]:indptr[s + 1]]:
+                if scc_id_list[next_s] != c:
+                    scc_successors[c].add(scc_id_list[next_s])
+
+        self.scc_reachability: List[int] = [0 for _ in range(num_scc)]
+        for c in tqdm(range(num_scc), desc="Calculating reachable states", leave=False, ascii=True):
+            reach = 1 << c
+            for child in scc_successors[c]:
+                reach |= self.scc_reachability[child]
+            self.scc_reachability[c] = reach
 
     def reachable(self, src_state: int, action: int, dst_state: int) -> bool:
         if not self.enable_reachability_analysis:
             raise Exception("ProbabilisticEnv.reachable: called without reachability analysis enabled")
+        dst_scc = int(self.scc_id[dst_state])
         for _, next_s, _ in self.get_transitions(src_state, action):
-            if dst_state in self.reachable_states_without_op[next_s]:
+            if self.scc_reachability[self.scc_id[next_s]] >> dst_scc & 1:
                 return True
         return False
@@ -5,6 +5,7 @@ from environment.tabular.vehicle_based.base import VehicleBasedStateEnv
 from environment.raw_state import RawStateSimulatorEnv
 from simulation.simulator import Simulator
 from simulation.vehicle import Vehicle, VehicleState
+from profiling import profiler, profiled
 
 
 class SimulatorEnv(VehicleBasedStateEnv):
@@ -62,6 +63,7 @@ class SimulatorEnv(VehicleBasedStateEnv):
 
         return next_state, delayed_time, terminal, info
 
+    @profiled("vehicle_based.SimulatorEnv.get_snapshots")
     def get_snapshots(self):
         res = []
         vehicle_ids_prev = set()
@@ -93,8 +95,10 @@ class SimulatorEnv(VehicleBasedStateEnv):
 
             res.append((S_0, env_snapshot))
 
+        profiler.count("vehicle_based.SimulatorEnv.snapshots", len(res))
         return res
 
+    @profiled("vehicle_based.SimulatorEnv._encode_state_from_vehicles")
     def _encode_state_from_vehicles(self, vehicles: Iterable[Vehicle]) -> Tuple:
         vehicles_near_intersection = []
         for vehicle in vehicles:
@@ -1,21 +1,26 @@
-from typing import Iterable, Union, Optional
+from typing import Dict, Iterable, Union, Optional, List
 from pathlib import Path
+import multiprocessing as mp
+import hashlib
 import random
 import pickle
+import json
+import csv
 
 from tqdm import tqdm
 import numpy as np
 import fire
 
+from CP import solve_by_CP_cached, DEFAULT_CP_CACHE_DIR
 from environment.tabular import position_based, vehicle_based
 from environment.func_approx import MinimumEnv
 from simulation import Simulator, Intersection
-from utility import read_intersection_from_json
-from CP import solve_by_CP
+from utility import read_intersection_from_json, SparseQtable
 import traffic_gen
 import policy
 
-from tf_agents.environments.tf_py_environment import TFPyEnvironment
+import tensorflow as tf
+from tf_agents.utils import nest_utils
 
 
 def evaluate(P: policy.Policy, env: Union[position_based.SimulatorEnv, vehicle_based.SimulatorEnv]):
@@ -84,50 +89,279 @@ def evaluate_tf(P, env, sim):
     return cumulative_reward / 10 / len(sim.vehicles)
 
 
-def batch_evaluate_tf(P, sim_gen, max_vehicle_num):
-    c_list = []
-    for sim in sim_gen:
-        env = TFPyEnvironment(MinimumEnv(sim, max_vehicle_num))
-        c = evaluate_tf(P, env, sim)
-        c_list.append(c)
-    return [c.numpy()[0] for c in c_list]
+def batch_evaluate_tf(P, sim_gen, max_vehicle_num, timeout_threshold: int = 200):
+    '''
+    run all traffic as one batch so that the policy is invoked once per step for
+    all unfinished episodes, and return the average cost of each traffic
+    '''
+    sims = list(sim_gen)
+    envs = []
+    for sim in sims:
+        env = MinimumEnv(sim, max_vehicle_num)
+        env.raw_state_env.snapshot = False
+        envs.append(env)
+
+    costs = [0.0 for _ in sims]
+    active = [i for i, sim in enumerate(sims) if len(sim.vehicles) > 0]
+    time_steps = {i: envs[i].reset() for i in active}
+    prev_observations = {i: time_steps[i].observation["observation"].copy() for i in active}
+    timeout_counters = {i: 0 for i in active}
+    while active:
+        batched_time_step = tf.nest.map_structure(
+            tf.convert_to_tensor,
+            nest_utils.stack_nested_arrays([time_steps[i] for i in active])
+        )
+        actions = P.action(batched_time_step).action.numpy()
+
+        next_active = []
+        for i, action in zip(active, actions):
+            time_step = envs[i].step(action)
+            time_steps[i] = time_step
+            costs[i] += float(time_step.reward)
+
+            if (time_step.observation["observation"] == prev_observations[i]).all():
+                timeout_counters[i] += 1
+            else:
+                timeout_counters[i] = 1
+                prev_observations[i] = time_step.observation["observation"].copy()
+
+            if timeout_counters[i] >= timeout_threshold:
+                print("TIMEOUT")
+                costs[i] -= int(1e9)
+            elif not time_step.is_last():
+                next_active.append(i)
+        active = next_active
+
+    return [c / 10 / len(sim.vehicles) if len(sim.vehicles) > 0 else 0 for c, sim in zip(costs, sims)]
+
+
+def evaluate_saved_policy(policy_dir, intersection: Intersection, data_dir, max_vehicle_num, step):
+    '''
+    evaluate a policy exported by PolicySaver, used to run validation in a separate process
+    '''
+    P = tf.saved_model.load(str(policy_dir))
+    sim_gen = traffic_gen.datadir_traffic_generator(intersection, data_dir)
+    avg_reward = batch_evaluate_tf(P, sim_gen, max_vehicle_num)
+    print(f"[VALID] STEP {step} | Validation Reward = {avg_reward}")
+
+
+def load_checkpoint_Q_table(env: vehicle_based.SimulatorEnv, checkpoint_path: Path):
+    '''
+    load Q.npz of a checkpoint trained with sparse_Q_table, otherwise the dense Q.npy
+    '''
+    if (checkpoint_path / "Q.npz").is_file():
+        Q = SparseQtable(env.action_space_size)
+        Q.load(checkpoint_path / "Q.npz")
+        return Q
+    return np.load(checkpoint_path / "Q.npy")
+
+
+def build_policies(env: vehicle_based.SimulatorEnv, checkpoint_path: Path):
+    # Modify this list to compare different policies
+    return [
+        ("iGreedy", policy.IGreedyPolicy(env)),
+        ("Q-learning", policy.QTablePolicy(env, load_checkpoint_Q_table(env, checkpoint_path))),
+    ]
+
+
+def traffic_hash(vehicle_dicts: List[Dict]) -> str:
+    content = sorted(vehicle_dicts, key=lambda d: d["id"])
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def CP_label(cp_params: Optional[Dict]) -> str:
+    '''
+    the CP results are only proven optimal without a time limit
+    '''
+    return "Optimal" if (cp_params or {}).get("time_limit") is None else "Best found"
+
+
+def format_average(costs: List[float]) -> str:
+    return f"{sum(costs) / len(costs)}" if len(costs) > 0 else "n/a"
+
+
+_worker_ctx = {}
+
+def _init_evaluation_worker(
+    intersection_file_path: str,
+    checkpoint_path: str,
+    disturbance_prob: Optional[float],
+    cp_cache_dir: str,
+    cp_params: Dict
+):
+    intersection: Intersection = read_intersection_from_json(intersection_file_path)
+    env = vehicle_based.SimulatorEnv(Simulator(intersection))
+    env.load_enc_dec_tables(Path(checkpoint_path) / "enc_dec_table.p")
+    env.reset(new_sim=Simulator(intersection))
+    _worker_ctx["intersection"] = intersection
+    _worker_ctx["env"] = env
+    _worker_ctx["policies"] = dict(build_policies(env, Path(checkpoint_path)))
+    _worker_ctx["disturbance_prob"] = disturbance_prob
+    _worker_ctx["cp_cache_dir"] = cp_cache_dir
+    _worker_ctx["cp_params"] = cp_params
+
+
+def _run_evaluation_task(task):
+    '''
+    task: (traffic name, vehicle dicts, policy name, seed); policy name "Optimal" solves the
+    traffic by CP, its cost is None when CP finds no solution within the time limit
+    '''
+    traffic_name, vehicle_dicts, pi_name, seed = task
+    random.seed(f"{seed}-{traffic_name}-{pi_name}")
+    np.random.seed(random.randrange(1 << 32))
+
+    sim = Simulator(_worker_ctx["intersection"], disturbance_prob=_worker_ctx["disturbance_prob"])
+    sim.add_vehicles(
+        [veh_dict["id"] for veh_dict in vehicle_dicts],
+        [veh_dict["earliest_arrival_time"] for veh_dict in vehicle_dicts],
+        [tuple(veh_dict["trajectory"]) for veh_dict in vehicle_dicts],
+        [veh_dict["src_lane_id"] for veh_dict in vehicle_dicts],
+        [veh_dict["dst_lane_id"] for veh_dict in vehicle_dicts],
+        [veh_dict["vertex_passing_time"] for veh_dict in vehicle_dicts]
+    )
+    env = _worker_ctx["env"]
+    env.reset(new_sim=sim)
+    if pi_name == "Optimal":
+        solution = solve_by_CP_cached(sim, _worker_ctx["cp_cache_dir"], **_worker_ctx["cp_params"])
+        return traffic_name, pi_name, None if solution is None else solution.objective, False
+    c, deadlock = evaluate(_worker_ctx["policies"][pi_name], env)
+    return traffic_name, pi_name, c, deadlock
+
+
+def parallel_evaluate(
+    intersection_file_path: str,
+    traffic_data_dir: str,
+    checkpoint_path: str,
+    policy_names: List[str],
+    output_file: str,
+    num_workers: int,
+    seed: int = 0,
+    disturbance_prob: Optional[float] = None,
+    cp_cache_dir: str = DEFAULT_CP_CACHE_DIR,
+    cp_params: Optional[Dict] = None
+):
+    '''
+    evaluate every (traffic, policy) pair in a process pool and stream the results to a CSV file;
+    traffic_data_dir is read as by traffic_gen.datadir_traffic_generator, every scenario of a .npz
+    file or dataset is a separate traffic; CP optima are solved once per distinct traffic content
+    '''
+    intersection: Intersection = read_intersection_from_json(intersection_file_path)
+    traffic = {
+        name: [vehicle.asdict() for vehicle in sim.vehicles]
+        for name, sim in traffic_gen.named_traffic_generator(intersection, traffic_data_dir)
+    }
+    traffic_hashes = {name: traffic_hash(vehicle_dicts) for name, vehicle_dicts in traffic.items()}
+
+    tasks = []
+    names_per_hash = {}
+    for name, vehicle_dicts in traffic.items():
+        if traffic_hashes[name] not in names_per_hash:
+            names_per_hash[traffic_hashes[name]] = []
+            tasks.append((name, vehicle_dicts, "Optimal", seed))
+        names_per_hash[traffic_hashes[name]].append(name)
+        for pi_name in policy_names:
+            tasks.append((name, vehicle_dicts, pi_name, seed))
+
+    cost = {pi_name: [] for pi_name in policy_names + ["Optimal"]}
+    deadlock_cnt = {pi_name: 0 for pi_name in policy_names + ["Optimal"]}
+    unsolved_cnt = 0
+    ctx = mp.get_context("spawn")
+    with open(output_file, "wt", encoding="utf-8", newline="") as f, ctx.Pool(
+        num_workers,
+        initializer=_init_evaluation_worker,
+        initargs=(intersection_file_path, checkpoint_path, disturbance_prob, cp_cache_dir, cp_params or {})
+    ) as pool:
+        writer = csv.DictWriter(f, fieldnames=["traffic", "traffic_hash", "policy", "cost", "deadlock"])
+        writer.writeheader()
+        for traffic_name, pi_name, c, deadlock in tqdm(
+            pool.imap_unordered(_run_evaluation_task, tasks), total=len(tasks)
+        ):
+            # identical traffic reuses the CP optimum
+            rows = [traffic_name]
+            if pi_name == "Optimal":
+                rows = names_per_hash[traffic_hashes[traffic_name]]
+            for row_name in rows:
+                writer.writerow({
+                    "traffic": row_name,
+                    "traffic_hash": traffic_hashes[row_name],
+                    "policy": CP_label(cp_params) if pi_name == "Optimal" else pi_name,
+                    "cost": c,
+                    "deadlock": deadlock
+                })
+                if c is None:
+                    unsolved_cnt += 1
+                elif deadlock:
+                    deadlock_cnt[pi_name] += 1
+                else:
+                    cost[pi_name].append(c)
+            f.flush()
+
+    print("=== Average ===")
+    for pi_name in policy_names + ["Optimal"]:
+        label = CP_label(cp_params) if pi_name == "Optimal" else pi_name
+        print(f"{label}: {format_average(cost[pi_name])}; {deadlock_cnt[pi_name]} / {len(cost[pi_name])}")
+    if unsolved_cnt > 0:
+        print(f"CP found no solution for {unsolved_cnt} traffic, they are left out of the CP average")
 
 
 def main(
     intersection_file_path: str,
     traffic_data_dir: str,
     seed: int = 0,
-    disturbance_prob: Optional[float] = None
+    disturbance_prob: Optional[float] = None,
+    num_workers: int = 0,
+    output_file: str = "evaluation.csv",
+    cp_cache_dir: str = DEFAULT_CP_CACHE_DIR,
+    cp_num_workers: int = 0,
+    cp_time_limit: Optional[float] = None,
+    cp_hint: Optional[str] = None
 ):
     random.seed(seed)
     np.random.seed(seed)
 
+    checkpoint_path = Path("checkpoints/Q_tabular_stream_2x2/")
     intersection: Intersection = read_intersection_from_json(
         intersection_file_path)
-    sim_gen: Iterable[Simulator] = traffic_gen.datadir_traffic_generator(
-        intersection, traffic_data_dir, disturbance_prob=disturbance_prob)
-
-    checkpoint_path = Path("checkpoints/Q_tabular_stream_2x2/")
     env = vehicle_based.SimulatorEnv(Simulator(intersection))
     env.load_enc_dec_tables(checkpoint_path / "enc_dec_table.p")
     
     env.reset(new_sim=Simulator(intersection))
 
-    # Modify this list to compare different policies
-    policies = [
-        ("iGreedy", policy.IGreedyPolicy(env)),
-        ("Q-learning", policy.QTablePolicy(env, np.load(checkpoint_path / "Q.npy"))),
-    ]
+    policies = build_policies(env, checkpoint_path)
+
+    cp_params = {"num_workers": cp_num_workers, "time_limit": cp_time_limit, "hint": cp_hint}
+    if num_workers > 0:
+        # the pool processes already use the cores, so each CP solve is single threaded by default
+        parallel_evaluate(
+            intersection_file_path,
+            traffic_data_dir,
+            str(checkpoint_path),
+            [pi_name for pi_name, _ in policies],
+            output_file,
+            num_workers,
+            seed=seed,
+            disturbance_prob=disturbance_prob,
+            cp_cache_dir=cp_cache_dir,
+            cp_params={**cp_params, "num_workers": cp_num_workers or 1}
+        )
+        return
+
+    sim_gen: Iterable[Simulator] = traffic_gen.datadir_traffic_generator(
+        intersection, traffic_data_dir, disturbance_prob=disturbance_prob)
 
     cost = [[] for _ in policies]
     cost.append([])
     deadlock_cnt = [0 for _ in policies]
     deadlock_cnt.append(0)
+    unsolved_cnt = 0
     pbar = tqdm()
     for sim in sim_gen:
         env.reset(new_sim=sim)
-        optimum = solve_by_CP(sim)
-        cost[-1].append(optimum)
+        solution = solve_by_CP_cached(sim, cp_cache_dir, **cp_params)
+        if solution is None:
+            unsolved_cnt += 1
+        else:
+            cost[-1].append(solution.objective)
         for i, (pi_name, pi) in enumerate(policies):
             c, deadlock = evaluate(pi, env)
             #print(pi_name, c)
@@ -141,11 +375,12 @@ def main(
 
         pbar.update(1)
 
-    policies.append(("Optimal", ""))
+    policies.append((CP_label(cp_params), ""))
     print("=== Average ===")
     for i, (pi_name, _) in enumerate(policies):
-        print(
-            f"{pi_name}: {sum(cost[i]) / len(cost[i])}; {deadlock_cnt[i]} / {len(cost[i])}")
+        print(f"{pi_name}: {format_average(cost[i])}; {deadlock_cnt[i]} / {len(cost[i])}")
+    if unsolved_cnt > 0:
+        print(f"CP found no solution for {unsolved_cnt} traffic, they are left out of the CP average")
 
 
 if __name__ == "__main__":
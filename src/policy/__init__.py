@@ -1,4 +1,4 @@
 from .base import Policy
 from .greedy import IGreedyPolicy
-from .value_function import QTablePolicy
+from .value_function import QTablePolicy, CompiledQTablePolicy, compile_decision_table
 from .misc import SingleCzPolicy, RGS
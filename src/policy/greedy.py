@@ -2,7 +2,7 @@ from typing import Dict, Set, Union, Tuple, Iterable
 import itertools
 import random
 
-from utility import Digraph
+from utility import ReachabilityIndex
 from simulation import Vehicle, VehicleState
 from environment import RawStateSimulatorEnv
 from environment.tabular.position_based import PositionBasedStateEnv
@@ -31,7 +31,7 @@ class IGreedyPolicy(Policy):
 
     def __decide_position_based(self, state: int) -> int:
         decoded_state = self.env.decode_state(state)
-        G = Digraph()
+        G = ReachabilityIndex()
 
         for cz_id, cz_state in decoded_state.cz_state.items():
             if cz_state.next_position not in ["", "$"]:
@@ -43,15 +43,10 @@ class IGreedyPolicy(Policy):
             if pos_state.vehicle_state == "waiting":
                 safe = True
                 if pos_state.next_position != "$":
+                    removed_edge = (pos, pos_state.next_position) \
+                        if isinstance(pos_state, PositionBasedStateEnv.CzState) else None
                     for next2pos in self.transitions_of_cz[pos_state.next_position]:
-                        G.add_edge(pos_state.next_position, next2pos)
-                        if isinstance(pos_state, PositionBasedStateEnv.CzState):
-                            G.remove_edge(pos, pos_state.next_position)
-                        cyclic = G.has_cycle()
-                        G.remove_edge(pos_state.next_position, next2pos)
-                        if isinstance(pos_state, PositionBasedStateEnv.CzState):
-                            G.add_edge(pos, pos_state.next_position)
-                        if cyclic:
+                        if G.creates_cycle(pos_state.next_position, next2pos, removed_edge):
                             safe = False
                             break
                 if safe:
@@ -65,7 +60,7 @@ class IGreedyPolicy(Policy):
 
     def __decide_vehicle_based(self, state: int) -> int:
         decoded_state: Tuple[VehicleBasedStateEnv.VehicleState] = self.env.decode_state(state)
-        G = Digraph()
+        G = ReachabilityIndex()
         for vehicle_state in decoded_state:
             if 0 <= vehicle_state.position <= len(vehicle_state.trajectory) - 2:
                 cur_cz = vehicle_state.trajectory[vehicle_state.position]
@@ -81,20 +76,15 @@ class IGreedyPolicy(Policy):
                     return i + 1
                 cz1 = vehicle_state.trajectory[vehicle_state.position + 1]
                 cz2 = vehicle_state.trajectory[vehicle_state.position + 2]
-                G.add_edge(cz1, cz2)
-                if vehicle_state.position > -1:
-                    G.remove_edge(vehicle_state.trajectory[vehicle_state.position], cz1)
-                cyclic = G.has_cycle()
-                G.remove_edge(cz1, cz2)
-                if vehicle_state.position > -1:
-                    G.add_edge(vehicle_state.trajectory[vehicle_state.position], cz1)
-                if not cyclic:
+                removed_edge = (vehicle_state.trajectory[vehicle_state.position], cz1) \
+                    if vehicle_state.position > -1 else None
+                if not G.creates_cycle(cz1, cz2, removed_edge):
                     return i + 1
 
         return 0
 
     def __decide_raw(self, state: Iterable[Vehicle]) -> int:
-        G = Digraph()
+        G = ReachabilityIndex()
         for vehicle in state:
             if 0 <= vehicle.idx_on_traj <= len(vehicle.trajectory) - 2:
                 cur_cz = vehicle.get_cur_cz()
@@ -107,14 +97,8 @@ class IGreedyPolicy(Policy):
                     return i + 1
                 cz1 = vehicle.trajectory[vehicle.idx_on_traj + 1]
                 cz2 = vehicle.trajectory[vehicle.idx_on_traj + 2]
-                G.add_edge(cz1, cz2)
-                if vehicle.idx_on_traj > -1:
-                    G.remove_edge(vehicle.get_cur_cz(), cz1)
-                cyclic = G.has_cycle()
-                G.remove_edge(cz1, cz2)
-                if vehicle.idx_on_traj > -1:
-                    G.add_edge(vehicle.get_cur_cz(), cz1)
-                if not cyclic:
+                removed_edge = (vehicle.get_cur_cz(), cz1) if vehicle.idx_on_traj > -1 else None
+                if not G.creates_cycle(cz1, cz2, removed_edge):
                     return i + 1
 
         return 0
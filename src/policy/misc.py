@@ -1,5 +1,5 @@
 from environment.tabular.vehicle_based import VehicleBasedStateEnv
-from utility import Digraph
+from utility import ReachabilityIndex
 
 from .base import Policy
 
@@ -11,7 +11,7 @@ class SingleCzPolicy(Policy):
 
     def decide(self, state: int) -> int:
         decoded_state = self.env.decode_state(state)
-        G = Digraph()
+        G = ReachabilityIndex()
         for vehicle_state in decoded_state:
             if 0 <= vehicle_state.position <= len(vehicle_state.trajectory) - 2:
                 cur_cz = vehicle_state.trajectory[vehicle_state.position]
@@ -27,14 +27,9 @@ class SingleCzPolicy(Policy):
                     return i + 1
                 cz1 = vehicle_state.trajectory[vehicle_state.position + 1]
                 cz2 = vehicle_state.trajectory[vehicle_state.position + 2]
-                G.add_edge(cz1, cz2)
-                if vehicle_state.position > -1:
-                    G.remove_edge(vehicle_state.trajectory[vehicle_state.position], cz1)
-                cyclic = G.has_cycle()
-                G.remove_edge(cz1, cz2)
-                if vehicle_state.position > -1:
-                    G.add_edge(vehicle_state.trajectory[vehicle_state.position], cz1)
-                if not cyclic:
+                removed_edge = (vehicle_state.trajectory[vehicle_state.position], cz1) \
+                    if vehicle_state.position > -1 else None
+                if not G.creates_cycle(cz1, cz2, removed_edge):
                     return i + 1
         
         if not available:
@@ -0,0 +1,149 @@
+from typing import Dict, List, Optional, Set, Tuple, Iterable
+
+from simulation import Simulator, Vehicle, VehicleState
+from simulation.tcg import TimingConflictGraph, Vertex, VertexState, Edge, EdgeType
+from environment import RawStateSimulatorEnv
+from CP import cp_model, build_CP_model, calculate_passing_time_sum_upper_bound
+
+from .base import Policy
+from .greedy import IGreedyPolicy
+
+
+class TCGWindow:
+    '''
+    The part of a TimingConflictGraph induced by a set of vehicles. It shares
+    the vertices and edges of the graph, so decided orderings stay frozen.
+    '''
+    def __init__(self, tcg: TimingConflictGraph, vehicles: Iterable[Vehicle]):
+        vehicle_ids: Set[str] = {vehicle.id for vehicle in vehicles}
+        self.V: List[Vertex] = [
+            tcg.get_vertex_by_vehicle_cz_pair(vehicle, cz_id)
+            for vehicle in vehicles
+            for cz_id in vehicle.trajectory + (f"${vehicle.id}",)
+        ]
+        self.E: List[Edge] = [
+            edge for vertex in self.V for edge in vertex.out_edges
+            if edge.v_to.vehicle.id in vehicle_ids
+        ]
+
+
+class RollingHorizonCPPolicy(Policy):
+    '''
+    Re-plan at every timestamp by solving the CP model over the vehicles in the
+    intersection and the next window_size vehicles to enter it, then move the
+    READY vehicles that the plan orders first on their next CZ. The decisions
+    fall back to IGreedy when no plan is found within time_limit seconds.
+    '''
+    def __init__(
+        self,
+        env: RawStateSimulatorEnv,
+        window_size: int = 8,
+        time_limit: float = 1.0,
+        num_workers: int = 0
+    ):
+        self.env: RawStateSimulatorEnv = env
+        self.window_size: int = window_size
+        self.time_limit: float = time_limit
+        self.num_workers: int = num_workers
+        self.fallback: IGreedyPolicy = IGreedyPolicy(env)
+
+        self.plan_sim: Optional[Simulator] = None
+        self.plan_timestamp: Optional[int] = None
+        self.planned_entering_times: Dict[Tuple[str, str], int] = {}
+        self.planned_orders: Dict[Tuple[int, int], bool] = {}   # (vertex id, vertex id) -> first before second
+        self.plan_found: bool = False
+
+    def decide(self, state: List[Vehicle]) -> int:
+        sim: Simulator = self.env.sim
+        if sim is not self.plan_sim or sim.timestamp != self.plan_timestamp:
+            self.plan_sim, self.plan_timestamp = sim, sim.timestamp
+            self.plan_found = self.replan(sim)
+        if not self.plan_found:
+            return self.fallback.decide(state)
+
+        best_action, best_entering_time = 0, None
+        for i, vehicle in enumerate(state):
+            if vehicle.state != VehicleState.READY:
+                continue
+            next_cz_id = vehicle.get_next_cz()
+            if next_cz_id == "$":
+                next_cz_id = f"${vehicle.id}"
+            entering_time = self.planned_entering_times.get((vehicle.id, next_cz_id), None)
+            if entering_time is None:
+                # outside of the window
+                continue
+            vertex = sim.TCG.get_vertex_by_vehicle_cz_pair(vehicle, next_cz_id)
+            if not self.is_planned_first(vertex):
+                continue
+            if best_entering_time is None or entering_time < best_entering_time:
+                best_action, best_entering_time = i + 1, entering_time
+
+        return best_action
+
+    def is_planned_first(self, vertex: Vertex) -> bool:
+        for edge in vertex.out_edges_by_type[EdgeType.TYPE_3]:
+            if not edge.decided:
+                key = (vertex.id, edge.v_to.id)
+                if key in self.planned_orders and not self.planned_orders[key]:
+                    return False
+        return True
+
+    def select_window(self, sim: Simulator) -> List[Vehicle]:
+        in_intersection = []
+        not_entered = []
+        for vehicle in sim.vehicles:
+            if vehicle.state == VehicleState.LEFT:
+                continue
+            if vehicle.idx_on_traj >= 0:
+                in_intersection.append(vehicle)
+            else:
+                not_entered.append(vehicle)
+        not_entered.sort(key=lambda vehicle: (vehicle.earliest_arrival_time, vehicle.id))
+        return in_intersection + not_entered[:self.window_size]
+
+    def replan(self, sim: Simulator) -> bool:
+        prev_entering_times = self.planned_entering_times
+        self.planned_entering_times, self.planned_orders = {}, {}
+        window = self.select_window(sim)
+        if len(window) == 0:
+            return True
+
+        tcg = TCGWindow(sim.TCG, window)
+        # the earliest entering times of the simulator account for the vehicles out of the window
+        lower_bounds = {vertex.id: max(sim.timestamp, vertex.earliest_entering_time or 0)
+                        for vertex in tcg.V if vertex.state == VertexState.NON_EXECUTED}
+        horizon = calculate_passing_time_sum_upper_bound(sim, tcg, window) \
+                  + max(lower_bounds.values(), default=max(sim.timestamp, 0))
+
+        model = cp_model.CpModel()
+        order_literals = {}
+        entering_time_vars = build_CP_model(model, tcg, horizon, timestamp=sim.timestamp,
+                                            order_literals=order_literals)
+        for vertex in tcg.V:
+            if vertex.id not in lower_bounds:
+                continue
+            model.Add(entering_time_vars[vertex.id] >= lower_bounds[vertex.id])
+            # warm start from the previous plan
+            prev_entering_time = prev_entering_times.get((vertex.vehicle.id, vertex.cz_id), None)
+            if prev_entering_time is not None:
+                model.AddHint(entering_time_vars[vertex.id], max(prev_entering_time, lower_bounds[vertex.id]))
+        model.Minimize(sum(
+            entering_time_vars[sim.TCG.get_vertex_by_vehicle_cz_pair(vehicle, f"${vehicle.id}").id]
+            for vehicle in window
+        ))
+
+        solver = cp_model.CpSolver()
+        if self.num_workers > 0:
+            solver.parameters.num_workers = self.num_workers
+        solver.parameters.max_time_in_seconds = self.time_limit
+        status = solver.Solve(model)
+        if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            return False
+
+        for vertex in tcg.V:
+            self.planned_entering_times[vertex.vehicle.id, vertex.cz_id] = solver.Value(entering_time_vars[vertex.id])
+        for (from_id, to_id), literal in order_literals.items():
+            first_before_second = solver.BooleanValue(literal)
+            self.planned_orders[from_id, to_id] = first_before_second
+            self.planned_orders[to_id, from_id] = not first_before_second
+        return True
@@ -1,6 +1,9 @@
+from typing import List, Optional
+
+from tqdm import tqdm
 import numpy as np
 
-from utility import Digraph
+from utility import ReachabilityIndex, DynamicQtable, SparseQtable
 
 from .base import Policy
 from .greedy import IGreedyPolicy
@@ -23,6 +26,63 @@ def worth_waiting(vehicles):
     return False
 
 
+def get_safe_effective_actions(env, state: int) -> Optional[List[int]]:
+    '''
+    Return the effective actions of the state which do not lead to a deadlock
+    and, unless it is the only choice, do not wait when waiting is useless.
+    Return None if there is no vehicle in the state.
+    '''
+    effective_actions = [a for a in range(env.action_space_size)
+        if env.is_effective_action_of_state(a, state)]
+
+    G = ReachabilityIndex()
+    decoded_state = env.decode_state(state)
+    if len(decoded_state) == 0:
+        return None
+
+    for vehicle_state in decoded_state:
+        if 0 <= vehicle_state.position <= len(vehicle_state.trajectory) - 2:
+            cur_cz = vehicle_state.trajectory[vehicle_state.position]
+            next_cz = vehicle_state.trajectory[vehicle_state.position + 1]
+            G.add_edge(cur_cz, next_cz)
+
+    for action in list(effective_actions):
+        if action == 0:
+            continue
+        vehicle_state = decoded_state[action - 1]
+        if vehicle_state.position >= len(vehicle_state.trajectory) - 2:
+            continue
+        cz1 = vehicle_state.trajectory[vehicle_state.position + 1]
+        cz2 = vehicle_state.trajectory[vehicle_state.position + 2]
+        removed_edge = (vehicle_state.trajectory[vehicle_state.position], cz1) \
+            if vehicle_state.position > -1 else None
+        if G.creates_cycle(cz1, cz2, removed_edge):
+            effective_actions.remove(action)
+
+    if 0 in effective_actions and len(effective_actions) > 1 and not worth_waiting(decoded_state):
+        effective_actions.remove(0)
+
+    return effective_actions
+
+
+def get_learned_Q_row(Q, state: int, effective_actions: List[int]) -> Optional[np.ndarray]:
+    '''
+    Return the Q row of the state without allocating it, or None if it has not been
+    learned: there is no row, or its effective actions all still hold the initial value
+    (as SparseQtable.load drops them). The rule is the same for every storage backend.
+    '''
+    if isinstance(Q, (SparseQtable, DynamicQtable)):
+        Q_state = Q.get_row(state)
+    else:
+        Q_state = Q[state] if state < len(Q) else None
+    if Q_state is None:
+        return None
+    initial_value = Q.default_value if isinstance(Q, SparseQtable) else 0.0
+    if (Q_state[effective_actions] == initial_value).all():
+        return None
+    return Q_state
+
+
 class QTablePolicy(Policy):
     def __init__(self, env, Q):
         self.env = env
@@ -40,41 +100,12 @@ class QTablePolicy(Policy):
         if state >= self.original_state_space_size:
             return self.igreedy.decide(state)
 
-        Q_state = self.Q[state]
-        effective_actions = [a for a in range(self.env.action_space_size)
-            if self.env.is_effective_action_of_state(a, state)]
-
-        G = Digraph()
-        decoded_state = self.env.decode_state(state)
-        if len(decoded_state) == 0:
+        effective_actions = get_safe_effective_actions(self.env, state)
+        if effective_actions is None:
             return 0
-
-        for vehicle_state in decoded_state:
-            if 0 <= vehicle_state.position <= len(vehicle_state.trajectory) - 2:
-                cur_cz = vehicle_state.trajectory[vehicle_state.position]
-                next_cz = vehicle_state.trajectory[vehicle_state.position + 1]
-                G.add_edge(cur_cz, next_cz)
-
-        for action in list(effective_actions):
-            if action == 0:
-                continue
-            vehicle_state = decoded_state[action - 1]
-            if vehicle_state.position >= len(vehicle_state.trajectory) - 2:
-                continue
-            cz1 = vehicle_state.trajectory[vehicle_state.position + 1]
-            cz2 = vehicle_state.trajectory[vehicle_state.position + 2]
-            G.add_edge(cz1, cz2)
-            if vehicle_state.position > -1:
-                G.remove_edge(vehicle_state.trajectory[vehicle_state.position], cz1)
-            cyclic = G.has_cycle()
-            G.remove_edge(cz1, cz2)
-            if vehicle_state.position > -1:
-                G.add_edge(vehicle_state.trajectory[vehicle_state.position], cz1)
-            if cyclic:
-                effective_actions.remove(action)
-
-        if 0 in effective_actions and len(effective_actions) > 1 and not worth_waiting(decoded_state):
-            effective_actions.remove(0)
+        Q_state = get_learned_Q_row(self.Q, state, effective_actions)
+        if Q_state is None:
+            return self.igreedy.decide(state)
 
         action = effective_actions[Q_state[effective_actions].argmin()]
 
@@ -94,3 +125,68 @@ class QTablePolicy(Policy):
         self.prev_state = state
         self.prev_action = action
         return action
+
+
+def compile_decision_table(env, Q, dtype=None) -> np.ndarray:
+    '''
+    Precompute the decisions of QTablePolicy for every state in the encoding table
+    of env as a (state space size, 2) table: column 0 is the action QTablePolicy
+    chooses and column 1 the best effective action other than waiting, which
+    CompiledQTablePolicy takes when its max waiting time is exceeded. States without
+    a learned Q row (see get_learned_Q_row) are marked with -1 in column 0, and
+    states without an action other than waiting with -1 in column 1.
+    '''
+    if dtype is None:
+        dtype = np.int8 if env.action_space_size <= np.iinfo(np.int8).max else np.int16
+    table = np.full((env.state_space_size, 2), -1, dtype=dtype)
+    for state in tqdm(range(env.state_space_size), desc="Compiling decision table", leave=False, ascii=True):
+        effective_actions = get_safe_effective_actions(env, state)
+        if effective_actions is None:
+            table[state, 0] = 0
+            continue
+        Q_state = get_learned_Q_row(Q, state, effective_actions)
+        if Q_state is None:
+            continue
+        table[state, 0] = effective_actions[Q_state[effective_actions].argmin()]
+        moving_actions = [a for a in effective_actions if a != 0]
+        if len(moving_actions) > 0:
+            table[state, 1] = moving_actions[Q_state[moving_actions].argmin()]
+    return table
+
+
+class CompiledQTablePolicy(Policy):
+    '''
+    Serve the decisions of a table built by compile_decision_table, falling
+    back to iGreedy for the states the table does not cover. As QTablePolicy,
+    it stops waiting on a state after max_waiting consecutive waits.
+    '''
+    def __init__(self, env, table: np.ndarray):
+        self.env = env
+        self.table: np.ndarray = table
+        self.igreedy = IGreedyPolicy(self.env)
+
+        self.prev_state: int = -1
+        self.waiting_counter: int = 0
+        self.max_waiting = 30
+
+    def decide(self, state: int) -> int:
+        action = -1
+        if state < self.table.shape[0]:
+            action = int(self.table[state, 0])
+
+        if action == 0:
+            if state == self.prev_state:
+                self.waiting_counter += 1
+            else:
+                self.waiting_counter = 1
+        else:
+            self.waiting_counter = 0
+
+        if action == 0 and self.waiting_counter > self.max_waiting:
+            print(f"[CompiledQTablePolicy] on state {state} max waiting time exceeded")
+            action = int(self.table[state, 1])
+        self.prev_state = state
+
+        if action < 0:
+            return self.igreedy.decide(state)
+        return action
@@ -0,0 +1,113 @@
+from typing import Callable, Dict, List, Optional
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import functools
+import json
+import time
+
+
+class Profiler:
+    '''
+    Opt-in call counts and cumulative times of the hot paths. When disabled, the
+    instrumented functions only pay for a flag check.
+    '''
+    def __init__(self):
+        self.enabled: bool = False
+        # name -> [number of calls, cumulative seconds]
+        self.episode_timers: Dict[str, List] = defaultdict(lambda: [0, 0.0])
+        self.episode_counters: Dict[str, int] = defaultdict(int)
+        self.total_timers: Dict[str, List] = defaultdict(lambda: [0, 0.0])
+        self.total_counters: Dict[str, int] = defaultdict(int)
+        self.num_episodes: int = 0
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        self.episode_timers.clear()
+        self.episode_counters.clear()
+        self.total_timers.clear()
+        self.total_counters.clear()
+        self.num_episodes = 0
+
+    def add_time(self, name: str, seconds: float) -> None:
+        timer = self.episode_timers[name]
+        timer[0] += 1
+        timer[1] += seconds
+
+    def count(self, name: str, n: int = 1) -> None:
+        if self.enabled:
+            self.episode_counters[name] += n
+
+    @contextmanager
+    def _timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def timer(self, name: str):
+        '''
+        context manager timing the block
+        '''
+        if not self.enabled:
+            return nullcontext()
+        return self._timer(name)
+
+    def end_episode(self, path: Optional[str] = None, **info) -> Dict:
+        '''
+        move the statistics of the current episode into the totals and return them;
+        they are appended to path as a JSON line together with info if path is given
+        '''
+        res = {
+            **info,
+            "timers": {name: {"calls": calls, "seconds": seconds}
+                       for name, (calls, seconds) in self.episode_timers.items()},
+            "counters": dict(self.episode_counters)
+        }
+        for name, (calls, seconds) in self.episode_timers.items():
+            self.total_timers[name][0] += calls
+            self.total_timers[name][1] += seconds
+        for name, n in self.episode_counters.items():
+            self.total_counters[name] += n
+        self.episode_timers.clear()
+        self.episode_counters.clear()
+        self.num_episodes += 1
+
+        if path is not None:
+            with open(path, "at", encoding="utf-8") as f:
+                f.write(json.dumps(res) + "\n")
+        return res
+
+    def summary(self) -> str:
+        lines = [f"[PROFILE] {self.num_episodes} episodes"]
+        for name, (calls, seconds) in sorted(self.total_timers.items(), key=lambda item: -item[1][1]):
+            lines.append(f"  {name}: {calls} calls, {seconds:.3f} s, {seconds / calls * 1e6:.1f} us/call")
+        for name, n in sorted(self.total_counters.items()):
+            lines.append(f"  {name}: {n}")
+        return "\n".join(lines)
+
+
+profiler = Profiler()
+
+
+def profiled(name: str) -> Callable:
+    '''
+    decorator accumulating the calls and the time of the function in the profiler under name
+    '''
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profiler.add_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
@@ -4,7 +4,7 @@ import matplotlib.pyplot as plt
 
 from traffic_gen import random_traffic_generator
 from utility import read_intersection_from_json
-from CP import solve_by_CP
+from CP import solve_by_CP_cached
 from policy import IGreedyPolicy
 from environment.tabular.vehicle_based import SimulatorEnv
 from evaluate import evaluate
@@ -27,10 +27,13 @@ for n in range(4, 15):
         num_iter = num_iter,
         max_vehicle_num = n,
         poisson_parameter_list = [0.5],
-        mode = "eval"
+        mode = "stream"
     ):
-        sim.run()
-        avg_opt += solve_by_CP(sim)
+        sim.start()
+        solution = solve_by_CP_cached(sim)
+        if solution is None:
+            raise Exception("[cmp_opt_greedy] CP found no solution")
+        avg_opt += solution.objective
 
         env.reset(new_sim=sim)
         avg_greedy += evaluate(igreedy, env)[0]
@@ -0,0 +1,41 @@
+from pathlib import Path
+
+import numpy as np
+import fire
+
+from simulation import Simulator
+from utility import read_intersection_from_json, SparseQtable
+from environment.tabular.vehicle_based import SimulatorEnv
+from policy import compile_decision_table
+
+
+def main(
+    intersection_file_path: str,
+    checkpoint_path: str,
+    Q_table_file: str = "Q.npy",
+    output_file: str = "decision_table.npy",
+    max_vehicle_num: int = 8,
+    max_vehicle_num_per_src_lane: int = 1
+):
+    checkpoint_path = Path(checkpoint_path)
+    intersection = read_intersection_from_json(intersection_file_path)
+    env = SimulatorEnv(
+        Simulator(intersection),
+        max_vehicle_num=max_vehicle_num,
+        max_vehicle_num_per_src_lane=max_vehicle_num_per_src_lane
+    )
+    env.load_enc_dec_tables(checkpoint_path / "enc_dec_table.p")
+
+    if Q_table_file.endswith(".npz"):
+        Q = SparseQtable(env.action_space_size)
+        Q.load(checkpoint_path / Q_table_file)
+    else:
+        Q = np.load(checkpoint_path / Q_table_file)
+
+    table = compile_decision_table(env, Q)
+    np.save(checkpoint_path / output_file, table)
+    print(f"{np.count_nonzero(table[:, 0] >= 0)} / {table.shape[0]} states compiled")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,27 @@
+from pathlib import Path
+
+import fire
+
+from simulation import Intersection, Simulator
+from utility import read_intersection_from_json
+from traffic_gen import dump_traffic_npz
+
+
+def main(intersection_file_path: str, data_dir: str, output_file: str = "traffic.npz"):
+    '''
+    convert a directory of JSON traffic files into a single .npz file,
+    the scenarios are named after the files
+    '''
+    intersection: Intersection = read_intersection_from_json(intersection_file_path)
+    traffic_files = sorted(f for f in Path(data_dir).iterdir() if f.suffix == ".json")
+    sims = []
+    for traffic_file in traffic_files:
+        sim = Simulator(intersection)
+        sim.load_traffic(traffic_file)
+        sims.append(sim)
+    num = dump_traffic_npz(sims, output_file, names=[f.stem for f in traffic_files])
+    print(f"packed {num} scenarios into {output_file}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
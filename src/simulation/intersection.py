@@ -1,7 +1,11 @@
-from typing import Tuple, Set, Dict, Iterable
-import copy
+from typing import Tuple, Set, Dict, Iterable, FrozenSet, Mapping, Optional, Any
+from types import MappingProxyType
 
 class Intersection:
+    '''
+    The properties are read-only views, they and the indices are built on first
+    access after a modification and shared by all readers.
+    '''
     def __init__(self) -> None:
         self.__conflict_zones: Set[str] = set()
         self.__transitions: Set[Tuple[str, str]] = set()
@@ -10,6 +14,13 @@ class Intersection:
         self.__src_lanes: Dict[str, Set[str]] = {}
         self.__dst_lanes: Dict[str, Set[str]] = {}
         self.__cz_coordinates: Dict[str, Tuple[float, float]] = {}
+        self.__views: Optional[Dict[str, Any]] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # mappingproxy objects cannot be pickled, the views are rebuilt on demand
+        state = self.__dict__.copy()
+        state["_Intersection__views"] = None
+        return state
 
     def add_conflict_zone(self, cz_id: str) -> None:
         '''
@@ -19,6 +30,7 @@ class Intersection:
             raise Exception("[Intersection.add_conflict_zone] invalid cz_id")
         self.__conflict_zones.add(cz_id)
         self.__adjacency_list[cz_id] = set()
+        self.__views = None
 
     def add_transition(self, from_cz_id: str, to_cz_id: str) -> None:
         '''
@@ -31,6 +43,7 @@ class Intersection:
             raise Exception(f"[Intersection.add_edge] vertex {to_cz_id} does not exist.")
         self.__transitions.add((from_cz_id, to_cz_id))
         self.__adjacency_list[from_cz_id].add(to_cz_id)
+        self.__views = None
 
     def add_trajectory(self, trajectory: Tuple[str]) -> None:
         '''
@@ -45,6 +58,7 @@ class Intersection:
         for i in range(len(trajectory) - 1):
             if (trajectory[i], trajectory[i+1]) not in self.__transitions:
                 self.__transitions.add((trajectory[i], trajectory[i+1]))
+        self.__views = None
 
     def add_src_lane(self, src_lane_id: str, associated_CZs: Iterable[str]) -> None:
         '''
@@ -55,6 +69,7 @@ class Intersection:
         if src_lane_id in self.__src_lanes:
             raise Exception(f"[Intersection.add_src_lane] src_lane_id {src_lane_id} already exists.")
         self.__src_lanes[src_lane_id] = set(associated_CZs)
+        self.__views = None
 
     def add_dst_lane(self, dst_lane_id: str, associated_CZs: Iterable[str]) -> None:
         '''
@@ -65,6 +80,7 @@ class Intersection:
         if dst_lane_id in self.__dst_lanes:
             raise Exception(f"[Intersection.add_dst_lane] dst_lane_id {dst_lane_id} already exists.")
         self.__dst_lanes[dst_lane_id] = set(associated_CZs)
+        self.__views = None
 
     def set_cz_coordinate(self, cz_id: str, x: float, y: float) -> None:
         '''
@@ -75,33 +91,80 @@ class Intersection:
             raise Exception(f"[Intersection.set_cz_coordinate] cz_id {cz_id} not in conflict zones")
         self.__cz_coordinates[cz_id] = (x, y)
 
+    def _get_views(self) -> Dict[str, Any]:
+        if self.__views is not None:
+            return self.__views
+
+        traj_dst_lane: Dict[Tuple[str], str] = {}
+        for traj in self.__trajectories:
+            dst_lane_id = next((dst_lane_id for dst_lane_id, czs in self.__dst_lanes.items()
+                                if traj[-1] in czs), None)
+            if dst_lane_id is not None:
+                traj_dst_lane[traj] = dst_lane_id
+
+        self.__views = {
+            "conflict_zones": frozenset(self.__conflict_zones),
+            "transitions": frozenset(self.__transitions),
+            "adjacency_list": MappingProxyType(
+                {cz_id: frozenset(czs) for cz_id, czs in self.__adjacency_list.items()}),
+            "trajectories": frozenset(self.__trajectories),
+            "src_lanes": MappingProxyType(
+                {lane_id: frozenset(czs) for lane_id, czs in self.__src_lanes.items()}),
+            "dst_lanes": MappingProxyType(
+                {lane_id: frozenset(czs) for lane_id, czs in self.__dst_lanes.items()}),
+            "cz_index": MappingProxyType(
+                {cz_id: i for i, cz_id in enumerate(sorted(self.__conflict_zones))}),
+            "src_lane_trajectories": MappingProxyType({
+                lane_id: tuple(sorted(traj for traj in self.__trajectories if traj[0] in czs))
+                for lane_id, czs in self.__src_lanes.items()
+            }),
+            "traj_dst_lane": MappingProxyType(traj_dst_lane)
+        }
+        return self.__views
+
     def get_traj_dst_lane(self, traj: Tuple[str]) -> str:
-        assert traj in self.__trajectories
-        for dst_lane_id, czs in self.__dst_lanes.items():
-            if traj[-1] in czs:
-                return dst_lane_id
-        assert False
+        traj_dst_lane = self._get_views()["traj_dst_lane"]
+        assert traj in traj_dst_lane
+        return traj_dst_lane[traj]
+
+    @property
+    def conflict_zones(self) -> FrozenSet[str]:
+        return self._get_views()["conflict_zones"]
+
+    @property
+    def transitions(self) -> FrozenSet[Tuple[str, str]]:
+        return self._get_views()["transitions"]
 
     @property
-    def conflict_zones(self) -> Set[str]:
-        return copy.deepcopy(self.__conflict_zones)
+    def adjacency_list(self) -> Mapping[str, FrozenSet[str]]:
+        return self._get_views()["adjacency_list"]
 
     @property
-    def transitions(self) -> Set[Tuple[str, str]]:
-        return copy.deepcopy(self.__transitions)
+    def trajectories(self) -> FrozenSet[Tuple[str]]:
+        return self._get_views()["trajectories"]
 
     @property
-    def adjacency_list(self) -> Dict[str, Set[str]]:
-        return copy.deepcopy(self.__adjacency_list)
+    def src_lanes(self) -> Mapping[str, FrozenSet[str]]:
+        return self._get_views()["src_lanes"]
 
     @property
-    def trajectories(self) -> Set[Tuple[str]]:
-        return copy.deepcopy(self.__trajectories)
+    def dst_lanes(self) -> Mapping[str, FrozenSet[str]]:
+        return self._get_views()["dst_lanes"]
 
     @property
-    def src_lanes(self) -> Dict[str, Set[str]]:
-        return copy.deepcopy(self.__src_lanes)
+    def cz_index(self) -> Mapping[str, int]:
+        '''
+        CZ id -> index of the CZ in the sorted CZ ids
+        '''
+        return self._get_views()["cz_index"]
+
+    @property
+    def src_lane_trajectories(self) -> Mapping[str, Tuple[Tuple[str], ...]]:
+        '''
+        source lane id -> sorted trajectories starting from the source lane
+        '''
+        return self._get_views()["src_lane_trajectories"]
 
     @property
-    def dst_lanes(self) -> Dict[str, Set[str]]:
-        return copy.deepcopy(self.__dst_lanes)
+    def traj_dst_lane(self) -> Mapping[Tuple[str], str]:
+        return self._get_views()["traj_dst_lane"]
@@ -1,9 +1,13 @@
-from typing import Optional, Tuple, List, Dict, Union, Set
+from typing import Optional, Tuple, List, Dict, Union, Set, Sequence, Iterable, Iterator
 import enum
 import json
 import random
 
-from .tcg import TimingConflictGraph, Vertex, VertexState, EdgeType
+import numpy as np
+
+from profiling import profiled
+
+from .tcg import TimingConflictGraph, Vertex, VertexState, Edge, EdgeType
 from .intersection import Intersection
 from .vehicle import Vehicle, VehicleState
 
@@ -37,6 +41,23 @@ class Simulator:
         self._executing_vertices: Set[Vertex] = set()
         self._non_executed_vertices: Set[Vertex] = set()
 
+        # The delayed time of a vehicle is constant + max(0, timestamp - clock_start), the clock
+        # runs while the vehicle waits at the source lane or stays in a CZ longer than needed.
+        # The cumulative delayed time is then _delay_offset + _num_running_delay_clocks * timestamp.
+        self._vehicle_delays: Dict[str, Tuple[int, Optional[int]]] = {}   # vehicle id -> (constant, clock_start)
+        self._pending_delay_clocks: Dict[int, int] = {}    # clock_start -> number of clocks
+        self._num_running_delay_clocks: int = 0
+        self._delay_offset: int = 0
+
+        # streaming mode
+        self._arrival_feed: Optional[Iterator[Dict]] = None
+        self._next_arrival: Optional[Dict] = None
+        self._arrival_lookahead: int = 0
+        self._retire_left_vehicles: bool = False
+        self._left_vehicle_ids: Set[str] = set()
+        self._retired_vehicle_num: int = 0
+        self._retired_delayed_time: int = 0
+
     @property
     def intersection(self) -> Intersection:
         return self._intersection
@@ -57,6 +78,30 @@ class Simulator:
     def TCG(self) -> TimingConflictGraph:
         return self._TCG
 
+    @property
+    def retired_vehicle_num(self) -> int:
+        return self._retired_vehicle_num
+
+    def set_arrival_feed(
+        self,
+        arrivals: Iterable[Dict],
+        lookahead: int = 0,
+        retire_left_vehicles: bool = True
+    ) -> None:
+        '''
+        Run the simulator in streaming mode. The vehicles of arrivals, dicts in the format of
+        Vehicle.asdict sorted by earliest_arrival_time, are added lookahead timestamps before they
+        arrive, and the simulator keeps running until arrivals is exhausted. The vehicles which
+        have left are removed once they cannot delay the others anymore; they still count in the
+        cumulative and total delayed time. A streaming simulator can neither be restarted nor copied.
+        '''
+        if self._status == SimulatorStatus.RUNNING:
+            raise Exception("[Simulator.set_arrival_feed] the simulator is running")
+        self._arrival_feed = iter(arrivals)
+        self._next_arrival = next(self._arrival_feed, None)
+        self._arrival_lookahead = lookahead
+        self._retire_left_vehicles = retire_left_vehicles
+
     def add_vehicle(
         self,
         _id: str,
@@ -66,8 +111,8 @@ class Simulator:
         dst_lane_id: str,
         vertex_passing_time: int = 10
     ):
-        if self._status == SimulatorStatus.RUNNING:
-            raise Exception("cannot add vehicle when the simulator is running")
+        if self._status == SimulatorStatus.RUNNING and arrival_time <= self._timestamp:
+            raise Exception("cannot add vehicle arriving before the next timestamp when the simulator is running")
         if _id in self._vehicles:
             raise Exception("_id has been used")
         if arrival_time < 0:
@@ -94,20 +139,150 @@ class Simulator:
             vertex_passing_time
         )
         self._vehicles[vehicle.id] = vehicle
+        self._set_vehicle_delay(vehicle.id, 0, arrival_time)
+        if self._status == SimulatorStatus.RUNNING:
+            self._add_to_TCG(vehicle)
+
+    def add_vehicles(
+        self,
+        ids: Sequence[str],
+        arrival_times: Sequence[int],
+        trajectories: Sequence[Tuple[str]],
+        src_lane_ids: Sequence[str],
+        dst_lane_ids: Sequence[str],
+        vertex_passing_times: Union[int, Sequence[int]] = 10
+    ) -> None:
+        '''
+        add the vehicles given column by column, the whole batch is validated before any vehicle
+        is added and every distinct (trajectory, source lane, destination lane) is checked once;
+        vehicles added while the simulator is running must arrive after the current timestamp
+        '''
+        num_vehicles = len(ids)
+        if isinstance(vertex_passing_times, (int, np.integer)):
+            vertex_passing_times = [vertex_passing_times] * num_vehicles
+        if any(len(column) != num_vehicles for column in
+               (arrival_times, trajectories, src_lane_ids, dst_lane_ids, vertex_passing_times)):
+            raise Exception("[Simulator.add_vehicles] columns of different lengths")
+        if num_vehicles == 0:
+            return
+
+        ids = [str(_id) for _id in ids]
+        trajectories = [tuple(trajectory) for trajectory in trajectories]
+        if len(set(ids)) != num_vehicles:
+            raise Exception("[Simulator.add_vehicles] duplicated ids")
+        used_ids = [_id for _id in ids if _id in self._vehicles]
+        if len(used_ids) > 0:
+            raise Exception(f"[Simulator.add_vehicles] ids have been used: {used_ids[:5]}")
+        arrival_times = np.asarray(arrival_times, dtype=np.int64)
+        vertex_passing_times = np.asarray(vertex_passing_times, dtype=np.int64)
+        if arrival_times.min() < 0:
+            raise Exception("[Simulator.add_vehicles] negative arrival_time")
+        if self._status == SimulatorStatus.RUNNING and arrival_times.min() <= self._timestamp:
+            raise Exception("[Simulator.add_vehicles] vehicles added when the simulator is running "
+                            "must arrive after the current timestamp")
+        if vertex_passing_times.min() < 0:
+            raise Exception("[Simulator.add_vehicles] negative vertex_passing_time")
+
+        src_lanes = self._intersection.src_lanes
+        dst_lanes = self._intersection.dst_lanes
+        for trajectory, src_lane_id, dst_lane_id in set(zip(trajectories, src_lane_ids, dst_lane_ids)):
+            if len(trajectory) == 0:
+                raise Exception("[Simulator.add_vehicles] empty trajectory")
+            if src_lane_id not in src_lanes:
+                raise Exception(f"[Simulator.add_vehicles] source lane {src_lane_id} not in intersection")
+            if dst_lane_id not in dst_lanes:
+                raise Exception(f"[Simulator.add_vehicles] destination lane {dst_lane_id} not in intersection")
+            if trajectory[0] not in src_lanes[src_lane_id]:
+                raise Exception(f"[Simulator.add_vehicles] the first CZ of {trajectory} does not belong to {src_lane_id}")
+            if trajectory[-1] not in dst_lanes[dst_lane_id]:
+                raise Exception(f"[Simulator.add_vehicles] the last CZ of {trajectory} does not belong to {dst_lane_id}")
+
+        for _id, arrival_time, trajectory, src_lane_id, dst_lane_id, vertex_passing_time in zip(
+            ids, arrival_times.tolist(), trajectories, src_lane_ids, dst_lane_ids, vertex_passing_times.tolist()
+        ):
+            self._vehicles[_id] = Vehicle(
+                _id,
+                arrival_time,
+                trajectory,
+                src_lane_id,
+                dst_lane_id,
+                vertex_passing_time
+            )
+            self._set_vehicle_delay(_id, 0, arrival_time)
+            if self._status == SimulatorStatus.RUNNING:
+                self._add_to_TCG(self._vehicles[_id])
+
+    def _add_to_TCG(self, vehicle: Vehicle) -> None:
+        '''
+        grow the TCG of the running simulation with a vehicle which has not arrived yet,
+        the earliest entering times of its vertices are computed at the next step
+        '''
+        vertices = self._TCG.add_vehicle(vehicle)
+        self._non_executed_vertices.update(vertices)
+        self._calculate_entering_time_wo_delay(vehicle)
 
     def remove_vehicle(self, vehicle_id: str) -> None:
         vehicle: Vehicle = self._vehicles[vehicle_id]
-        for cz_id in vehicle.trajectory:
-            v = self._TCG.get_vertex_by_vehicle_cz_pair(vehicle, cz_id)
-            self._TCG.remove_vertex(v)
+        self._TCG.remove_vehicle(vehicle)
         for vertex in list(self._non_executed_vertices):
             if vertex.vehicle.id == vehicle_id:
                 self._non_executed_vertices.remove(vertex)
         for vertex in list(self._executing_vertices):
             if vertex.vehicle.id == vehicle_id:
                 self._executing_vertices.remove(vertex)
+        self._clear_vehicle_delay(vehicle.id)
+        self._left_vehicle_ids.discard(vehicle.id)
         del self._vehicles[vehicle.id]
 
+    def _get_release_time(self, vehicle: Vehicle) -> int:
+        '''
+        the time after which a vehicle which has left constrains no one: neither the vehicles in the
+        TCG through its out-edges nor the vehicles added later through the Type-2 and Type-3 edges
+        they would get (their Type-4 edges are bounded by the term of the next vertex)
+        '''
+        max_waiting_time: int = max(Edge.default_waiting_time[EdgeType.TYPE_2],
+                                    Edge.default_waiting_time[EdgeType.TYPE_3])
+        res: int = self._timestamp
+        for cz_id in vehicle.trajectory + (f"${vehicle.id}",):
+            vertex = self._TCG.get_vertex_by_vehicle_cz_pair(vehicle, cz_id)
+            res = max(res, vertex.entering_time + vertex.passing_time + max_waiting_time)
+            for out_edge in vertex.out_edges:
+                res = max(res, vertex.entering_time + vertex.passing_time + out_edge.waiting_time)
+        return res
+
+    def _retire_vehicles(self) -> None:
+        for vehicle_id in list(self._left_vehicle_ids):
+            vehicle: Vehicle = self._vehicles[vehicle_id]
+            if self._get_release_time(vehicle) > self._timestamp:
+                continue
+            # the delay of the vehicle stays in the cumulative delayed time
+            constant, _ = self._vehicle_delays.pop(vehicle_id)
+            self._retired_delayed_time += constant
+            self._retired_vehicle_num += 1
+            self._left_vehicle_ids.remove(vehicle_id)
+            self._TCG.remove_vehicle(vehicle)
+            del self._vehicles[vehicle_id]
+
+    def _inject_arrivals(self, timestamp: int) -> None:
+        '''
+        add the vehicles of the arrival feed arriving until timestamp + lookahead
+        '''
+        vehicle_dicts = []
+        while self._next_arrival is not None \
+              and self._next_arrival["earliest_arrival_time"] <= timestamp + self._arrival_lookahead:
+            vehicle_dicts.append(self._next_arrival)
+            self._next_arrival = next(self._arrival_feed, None)
+        if len(vehicle_dicts) == 0:
+            return
+        self.add_vehicles(
+            [veh_dict["id"] for veh_dict in vehicle_dicts],
+            [veh_dict["earliest_arrival_time"] for veh_dict in vehicle_dicts],
+            [tuple(veh_dict["trajectory"]) for veh_dict in vehicle_dicts],
+            [veh_dict["src_lane_id"] for veh_dict in vehicle_dicts],
+            [veh_dict["dst_lane_id"] for veh_dict in vehicle_dicts],
+            [veh_dict.get("vertex_passing_time", 10) for veh_dict in vehicle_dicts]
+        )
+
     def dump_traffic(self, path) -> None:
         vehicle_dicts = []
         for veh in self._vehicles.values():
@@ -118,15 +293,14 @@ class Simulator:
     def load_traffic(self, path) -> None:
         with open(path, "rt", encoding="utf-8") as f:
             vehicle_dicts = json.load(f)
-        for veh_dict in vehicle_dicts:
-            self.add_vehicle(
-                veh_dict["id"],
-                veh_dict["earliest_arrival_time"],
-                tuple(veh_dict["trajectory"]),
-                veh_dict["src_lane_id"],
-                veh_dict["dst_lane_id"],
-                veh_dict["vertex_passing_time"]
-            )
+        self.add_vehicles(
+            [veh_dict["id"] for veh_dict in vehicle_dicts],
+            [veh_dict["earliest_arrival_time"] for veh_dict in vehicle_dicts],
+            [tuple(veh_dict["trajectory"]) for veh_dict in vehicle_dicts],
+            [veh_dict["src_lane_id"] for veh_dict in vehicle_dicts],
+            [veh_dict["dst_lane_id"] for veh_dict in vehicle_dicts],
+            [veh_dict["vertex_passing_time"] for veh_dict in vehicle_dicts]
+        )
 
     def print_TCG(self) -> None:
         self._TCG.print()
@@ -136,6 +310,8 @@ class Simulator:
         self.restart()
 
     def restart(self) -> None:
+        if self._arrival_feed is not None and self._timestamp >= 0:
+            raise Exception("[Simulator.restart] a streaming simulator cannot be restarted")
         self._status = SimulatorStatus.RUNNING
         self._timestamp = -1
         self._TCG.reset_vertices_state()
@@ -144,20 +320,28 @@ class Simulator:
         self._non_executed_vertices = {vertex for vertex in self._TCG.V}
         self._executing_vertices = set()
         self.calculate_entering_time_wo_delay()
+        self._vehicle_delays = {}
+        self._pending_delay_clocks = {}
+        self._num_running_delay_clocks = 0
+        self._delay_offset = 0
+        for vehicle in self._vehicles.values():
+            self._set_vehicle_delay(vehicle.id, 0, vehicle.earliest_arrival_time)
+        self._left_vehicle_ids = set()
+        self._retired_vehicle_num = 0
+        self._retired_delayed_time = 0
         self.step(None)
 
+    def _calculate_entering_time_wo_delay(self, vehicle: Vehicle) -> None:
+        lb: int = vehicle.earliest_arrival_time
+        vertex = self._TCG.get_vertex_by_vehicle_cz_pair(vehicle, vehicle.trajectory[0])
+        while vertex is not None:
+            vertex.entering_time_wo_delay = lb
+            lb += vertex.get_consumed_time()
+            vertex = vertex.next_vertex
+
     def calculate_entering_time_wo_delay(self) -> None:
         for vehicle in self._vehicles.values():
-            lb: int = vehicle.earliest_arrival_time
-            vertex = self._TCG.get_vertex_by_vehicle_cz_pair(vehicle, vehicle.trajectory[0])
-            while True:
-                vertex.entering_time_wo_delay = lb
-                try:
-                    type1_edge = next(edge for edge in vertex.out_edges if edge.type == EdgeType.TYPE_1)
-                except StopIteration:
-                    break
-                lb += vertex.passing_time + type1_edge.waiting_time
-                vertex = type1_edge.v_to
+            self._calculate_entering_time_wo_delay(vehicle)
 
     def _check_deadlock_dfs(self, vertex: Vertex, color: Dict[str, int]) -> bool:
         color[vertex.id] = 1
@@ -172,6 +356,7 @@ class Simulator:
         color[vertex.id] = 2
         return False
 
+    @profiled("Simulator.check_deadlock")
     def check_deadlock(self) -> bool:
         color = {v.id: 0 for v in self._TCG.V}
         for vertex in self._TCG.V:
@@ -180,24 +365,43 @@ class Simulator:
                     return True
         return False
 
+    def _clear_vehicle_delay(self, vehicle_id: str) -> None:
+        if vehicle_id not in self._vehicle_delays:
+            return
+        constant, clock_start = self._vehicle_delays.pop(vehicle_id)
+        self._delay_offset -= constant
+        if clock_start is None:
+            return
+        if clock_start < self._timestamp:
+            self._num_running_delay_clocks -= 1
+            self._delay_offset += clock_start
+        else:
+            self._pending_delay_clocks[clock_start] -= 1
+            if self._pending_delay_clocks[clock_start] == 0:
+                del self._pending_delay_clocks[clock_start]
+
+    def _set_vehicle_delay(self, vehicle_id: str, constant: int, clock_start: Optional[int]) -> None:
+        self._clear_vehicle_delay(vehicle_id)
+        self._vehicle_delays[vehicle_id] = (constant, clock_start)
+        self._delay_offset += constant
+        if clock_start is None:
+            return
+        if clock_start < self._timestamp:
+            self._num_running_delay_clocks += 1
+            self._delay_offset -= clock_start
+        else:
+            self._pending_delay_clocks[clock_start] = self._pending_delay_clocks.get(clock_start, 0) + 1
+
+    def _advance_timestamp(self) -> None:
+        self._timestamp += 1
+        # the clocks started at the previous timestamp begin to accumulate
+        clock_start = self._timestamp - 1
+        num_clocks = self._pending_delay_clocks.pop(clock_start, 0)
+        self._num_running_delay_clocks += num_clocks
+        self._delay_offset -= num_clocks * clock_start
+
     def get_cumulative_delayed_time(self) -> int:
-        res: int = 0
-        for vehicle in self._vehicles.values():
-            cur_cz: str = vehicle.get_cur_cz()
-            if cur_cz == "^":
-                res += max(0, self._timestamp - vehicle.earliest_arrival_time)
-            elif cur_cz == "$":
-                last_vertex = self._TCG.get_vertex_by_vehicle_cz_pair(vehicle, f"${vehicle.id}")
-                res += last_vertex.entering_time - last_vertex.entering_time_wo_delay
-            else:
-                cur_vertex = self._TCG.get_vertex_by_vehicle_cz_pair(vehicle, cur_cz)
-                type1_edge = next(edge for edge in cur_vertex.out_edges
-                                  if edge.type == EdgeType.TYPE_1)
-                res += cur_vertex.entering_time - cur_vertex.entering_time_wo_delay
-                real_lb: int = cur_vertex.entering_time + cur_vertex.passing_time + type1_edge.waiting_time
-                if self._timestamp > real_lb:
-                    res += self._timestamp - real_lb
-        return res
+        return self._delay_offset + self._num_running_delay_clocks * self._timestamp
 
     def get_total_delayed_time(self) -> int:
         res: int = 0
@@ -213,7 +417,7 @@ class Simulator:
             last_vertex: Vertex = self._TCG.get_vertex_by_vehicle_cz_pair(
                 vehicle, f"${vehicle.id}")
             res += last_vertex.entering_time - zero_delay
-        return res
+        return res + self._retired_delayed_time
 
     def _compute_earliest_entering_time(self, vertex: Vertex) -> None:
         res: int = self._timestamp
@@ -235,6 +439,7 @@ class Simulator:
 
         vertex.earliest_entering_time = res
 
+    @profiled("Simulator._update_all_earliest_entering_time")
     def _update_all_earliest_entering_time(self) -> None:
         if self.check_deadlock():
             raise DeadlockException()
@@ -252,8 +457,9 @@ class Simulator:
                 res[vertex.vehicle.id] = vertex
         return res
 
+    @profiled("Simulator.step")
     def step(self, moved_vehicle_id: Optional[str]) -> None:
-        if len(self._non_executed_vertices) == 0:
+        if len(self._non_executed_vertices) == 0 and self._next_arrival is None:
             self._status = SimulatorStatus.TERMINATED
             return
 
@@ -271,13 +477,26 @@ class Simulator:
             self._executing_vertices.add(vertex_to_be_executed)
 
             # Update vehicle information
-            vertex_to_be_executed.vehicle.move_to_next_cz()
-            vertex_to_be_executed.vehicle.set_state(VehicleState.MOVING)
+            vehicle: Vehicle = vertex_to_be_executed.vehicle
+            vehicle.move_to_next_cz()
+            vehicle.set_state(VehicleState.MOVING)
+
+            # the delay is frozen in the new vertex until the vehicle could have left it
+            clock_start: Optional[int] = None
+            if vehicle.get_cur_cz() != "$":
+                clock_start = vertex_to_be_executed.entering_time + vertex_to_be_executed.get_consumed_time()
+            self._set_vehicle_delay(
+                vehicle.id,
+                vertex_to_be_executed.entering_time - vertex_to_be_executed.entering_time_wo_delay,
+                clock_start
+            )
 
         # If there is no vehicle moved or there is no more vehicles can be moved
         if vertex_to_be_executed is None or len(executable_vertices) == 1:
             # move to the next time step
-            self._timestamp += 1
+            if self._arrival_feed is not None:
+                self._inject_arrivals(self._timestamp + 1)
+            self._advance_timestamp()
 
         # finish executing
         for vertex in list(self._executing_vertices):
@@ -287,6 +506,11 @@ class Simulator:
                 vertex.vehicle.set_state(VehicleState.BLOCKED)
                 if vertex.vehicle.get_cur_cz() == "$":
                     vertex.vehicle.set_state(VehicleState.LEFT)
+                    if self._retire_left_vehicles:
+                        self._left_vehicle_ids.add(vertex.vehicle.id)
+
+        if len(self._left_vehicle_ids) > 0:
+            self._retire_vehicles()
 
         try:
             self._update_all_earliest_entering_time()
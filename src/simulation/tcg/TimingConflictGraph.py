@@ -1,5 +1,6 @@
-from typing import Iterable, Set, Dict, Tuple, Optional
+from typing import Iterable, Set, Dict, Tuple, Optional, List
 
+from profiling import profiled
 from simulation.intersection import Intersection
 from simulation.vehicle import Vehicle
 
@@ -20,6 +21,10 @@ class TimingConflictGraph:
         self._intersection: Intersection = intersection
         self._V: Dict[Tuple[str, str], Vertex] = {}   # (vehicle id, cz id) -> Vertex
         self._E: Dict[Tuple[int, int], Edge] = {}     # (src vertex id, dst vertex id) -> Edge
+        self._cz_vertices: Dict[str, Set[Vertex]] = {}
+        # ids are never reused, since vehicles can be added after others are removed
+        self._next_vertex_id: int = 0
+        self._next_edge_id: int = 0
 
         self.build_graph()
 
@@ -34,6 +39,9 @@ class TimingConflictGraph:
     def build_graph(self) -> None:
         self._V: Dict[Tuple[str, str], Vertex] = {}
         self._E: Dict[Tuple[int, int], Edge] = {}
+        self._cz_vertices = {}
+        self._next_vertex_id = 0
+        self._next_edge_id = 0
 
         for vehicle in self._vehicles:
             for cz_id in vehicle.trajectory:
@@ -59,7 +67,8 @@ class TimingConflictGraph:
         for src_lane_id in self._intersection.src_lanes:
             vehicles_from_this_src_lane = [veh for veh in self._vehicles
                                            if veh.src_lane_id == src_lane_id]
-            vehicles_from_this_src_lane.sort(key=lambda veh: veh.earliest_arrival_time)
+            # vehicles arriving at the same time are ordered by id, not by the set order
+            vehicles_from_this_src_lane.sort(key=lambda veh: (veh.earliest_arrival_time, veh.id))
             for idx, vehicle in enumerate(vehicles_from_this_src_lane[:-1]):
                 for j, cz_id in enumerate(vehicle.trajectory):
                     for later_vehicle in vehicles_from_this_src_lane[idx + 1:]:
@@ -74,22 +83,82 @@ class TimingConflictGraph:
         # Add type-3 edges
         self.add_undecided_type3_edges()
 
+    def add_vehicle(self, vehicle: Vehicle) -> List[Vertex]:
+        '''
+        Add the vertices and edges of a vehicle to the graph during a simulation and return the
+        new vertices. The vehicle must not have arrived, the orderings with the vertices which
+        have started executing are decided as start_execute does.
+        '''
+        if vehicle in self._vehicles:
+            raise Exception(f"[TimingConflictGraph.add_vehicle] vehicle {vehicle.id} already in the graph")
+        self._vehicles.add(vehicle)
+        for cz_id in vehicle.trajectory:
+            self._add_vertex(vehicle, cz_id)
+        self._add_vertex(vehicle, f"${vehicle.id}", passing_time=0)
+        new_vertices = [self.get_vertex_by_vehicle_cz_pair(vehicle, cz_id)
+                        for cz_id in vehicle.trajectory + (f"${vehicle.id}",)]
+
+        # Add type-1 edges
+        for v_from, v_to in zip(new_vertices[:-2], new_vertices[1:-1]):
+            self._add_edge_by_vtx(v_from, v_to, EdgeType.TYPE_1)
+        self._add_edge_by_vtx(new_vertices[-2], new_vertices[-1], EdgeType.TYPE_1, waiting_time=0)
+
+        # Add type-2 edges, ordered by the arrival times as in build_graph
+        for other in self._vehicles:
+            if other.id == vehicle.id or other.src_lane_id != vehicle.src_lane_id:
+                continue
+            first, later = (other, vehicle) \
+                           if (other.earliest_arrival_time, other.id) < (vehicle.earliest_arrival_time, vehicle.id) \
+                           else (vehicle, other)
+            for j, cz_id in enumerate(first.trajectory):
+                if cz_id in later.trajectory:
+                    first_v = self.get_vertex_by_vehicle_cz_pair(first, cz_id)
+                    later_v = self.get_vertex_by_vehicle_cz_pair(later, cz_id)
+                    self._add_edge_by_vtx(first_v, later_v, EdgeType.TYPE_2)
+                    if j != len(first.trajectory) - 1:
+                        self.add_type4_edge(first_v, later_v)
+
+        # Add type-3 edges
+        for v in new_vertices[:-1]:
+            for u in list(self._cz_vertices[v.cz_id]):
+                if not self.type3_edge_condition(u, v):
+                    continue
+                if u.state == VertexState.NON_EXECUTED:
+                    self._add_edge_by_vtx(u, v, EdgeType.TYPE_3, decided=False)
+                    self._add_edge_by_vtx(v, u, EdgeType.TYPE_3, decided=False)
+                    continue
+                self._add_edge_by_vtx(u, v, EdgeType.TYPE_3, decided=True)
+                next_u = u.next_vertex
+                if next_u is not None:
+                    type3_edge: Edge = self.get_edge_by_vertex_pair(u, v)
+                    self._add_edge_by_vtx(
+                        next_u, v, EdgeType.TYPE_4,
+                        waiting_time=type3_edge.waiting_time - u.next_edge.waiting_time - next_u.passing_time
+                    )
+        return new_vertices
+
+    def remove_vehicle(self, vehicle: Vehicle) -> None:
+        for cz_id in vehicle.trajectory + (f"${vehicle.id}",):
+            self.remove_vertex(self.get_vertex_by_vehicle_cz_pair(vehicle, cz_id))
+        self._vehicles.discard(vehicle)
+
     @staticmethod
     def type3_edge_condition(v1: Vertex, v2: Vertex) -> bool:
         return v1.vehicle.id != v2.vehicle.id and v1.cz_id == v2.cz_id \
                and v1.vehicle.src_lane_id != v2.vehicle.src_lane_id
 
     def add_undecided_type3_edges(self) -> None:
+        # only vertices on the same CZ can conflict, visited in the order of self._V
+        cz_vertices = {cz_id: sorted(vertices, key=lambda v: v.id) for cz_id, vertices in self._cz_vertices.items()}
         for v1 in self._V.values():
-            for v2 in self._V.values():
+            for v2 in cz_vertices[v1.cz_id]:
                 if self.type3_edge_condition(v1, v2):
                     self._add_edge_by_vtx(v1, v2, EdgeType.TYPE_3, decided=False)
                     self._add_edge_by_vtx(v2, v1, EdgeType.TYPE_3, decided=False)
     
     def add_type4_edge(self, v_first: Vertex, v_second: Vertex) -> None:
-        try:
-            type1_edge: Edge = next(e for e in v_first.out_edges if e.type == EdgeType.TYPE_1)
-        except StopIteration:
+        type1_edge: Optional[Edge] = v_first.next_edge
+        if type1_edge is None:
             return
 
         type3_edge: Edge = self.get_edge_by_vertex_pair(v_first, v_second)
@@ -111,20 +180,17 @@ class TimingConflictGraph:
                     print(f"({in_e.v_from.vehicle.id}, {in_e.v_from.cz_id}) ", end="")
                 print("}")
 
+    @profiled("TimingConflictGraph.start_execute")
     def start_execute(self, v: Vertex):
         key = (v.vehicle.id, v.cz_id)
         if key not in self._V or id(self._V[key]) != id(v):
             raise Exception("supplied vertex does not belongs to this graph")
 
-        next_v = None
-        w_e_to_next_v = 0
-        for out_edge in v.out_edges:
-            if out_edge.type == EdgeType.TYPE_1:
-                next_v = out_edge.v_to
-                w_e_to_next_v = out_edge.waiting_time
+        next_v = v.next_vertex
+        w_e_to_next_v = 0 if v.next_edge is None else v.next_edge.waiting_time
 
-        for out_edge in v.out_edges:
-            if out_edge.type == EdgeType.TYPE_3 and not out_edge.decided:
+        for out_edge in v.out_edges_by_type[EdgeType.TYPE_3]:
+            if not out_edge.decided:
                 disjunctive_edge = self._E[(out_edge.v_to.id, out_edge.v_from.id)]
                 self._remove_edge(disjunctive_edge)
                 out_edge.decided = True
@@ -161,14 +227,17 @@ class TimingConflictGraph:
 
     def remove_vertex(self, v: Vertex) -> None:
         for in_e in v.in_edges:
-            in_e.v_from.out_edges.remove(in_e)
+            in_e.v_from.remove_out_edge(in_e)
             del self._E[(in_e.v_from.id, in_e.v_to.id)]
 
         for out_e in v.out_edges:
-            out_e.v_to.in_edges.remove(out_e)
+            out_e.v_to.remove_in_edge(out_e)
             del self._E[(out_e.v_from.id, out_e.v_to.id)]
 
         del self._V[(v.vehicle.id, v.cz_id)]
+        self._cz_vertices[v.cz_id].discard(v)
+        if len(self._cz_vertices[v.cz_id]) == 0:
+            del self._cz_vertices[v.cz_id]
 
     def get_vertex_by_vehicle_cz_pair(self, vehicle: Vehicle, cz_id: str) -> Vertex:
         return self._V[(vehicle.id, cz_id)]
@@ -178,8 +247,10 @@ class TimingConflictGraph:
 
     def _add_vertex(self, vehicle: Vehicle, cz_id: str, passing_time: Optional[int] = None) -> None:
         if (vehicle.id, cz_id) not in self._V:
-            v = Vertex(len(self._V), vehicle, cz_id, passing_time=passing_time)
+            v = Vertex(self._next_vertex_id, vehicle, cz_id, passing_time=passing_time)
+            self._next_vertex_id += 1
             self._V[(vehicle.id, cz_id)] = v
+            self._cz_vertices.setdefault(cz_id, set()).add(v)
 
     def _add_edge_by_idx(
         self,
@@ -207,8 +278,9 @@ class TimingConflictGraph:
         if (v_from.id, v_to.id) in self._E:
             return
 
-        edge = Edge(len(self._E), v_from, v_to, edge_type,
+        edge = Edge(self._next_edge_id, v_from, v_to, edge_type,
                     waiting_time=waiting_time, decided=decided)
+        self._next_edge_id += 1
         self._E[(v_from.id, v_to.id)] = edge
         v_from.add_out_edge(edge)
         v_to.add_in_edge(edge)
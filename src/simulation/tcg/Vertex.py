@@ -1,5 +1,5 @@
 import enum
-from typing import Set, Union, Optional
+from typing import Dict, Set, Union, Optional
 
 from simulation.tcg.Edge import Edge, EdgeType
 from simulation.vehicle import Vehicle
@@ -27,6 +27,11 @@ class Vertex:
 
         self.out_edges: Set[Edge] = set()
         self.in_edges: Set[Edge] = set()
+        self.out_edges_by_type: Dict[EdgeType, Set[Edge]] = {edge_type: set() for edge_type in EdgeType}
+        self.in_edges_by_type: Dict[EdgeType, Set[Edge]] = {edge_type: set() for edge_type in EdgeType}
+        # the Type-1 edges to the next and from the previous vertex on the trajectory
+        self.next_edge: Optional[Edge] = None
+        self.prev_edge: Optional[Edge] = None
         self.entering_time: int = 0
         if passing_time is None:
             self.passing_time: int = vehicle.vertex_passing_time
@@ -37,23 +42,42 @@ class Vertex:
         self.entering_time_wo_delay: int = 0
         self.state: VertexState = VertexState.NON_EXECUTED
 
+    @property
+    def next_vertex(self) -> Optional["Vertex"]:
+        return None if self.next_edge is None else self.next_edge.v_to
+
+    @property
+    def prev_vertex(self) -> Optional["Vertex"]:
+        return None if self.prev_edge is None else self.prev_edge.v_from
+
     def get_consumed_time(self) -> int:
-        for out_e in self.out_edges:
-            if out_e.type == EdgeType.TYPE_1:
-                return self.passing_time + out_e.waiting_time
-        return self.passing_time
+        if self.next_edge is None:
+            return self.passing_time
+        return self.passing_time + self.next_edge.waiting_time
 
     def add_out_edge(self, edge: Edge) -> None:
         self.out_edges.add(edge)
+        self.out_edges_by_type[edge.type].add(edge)
+        if edge.type == EdgeType.TYPE_1:
+            self.next_edge = edge
 
     def add_in_edge(self, edge: Edge) -> None:
         self.in_edges.add(edge)
+        self.in_edges_by_type[edge.type].add(edge)
+        if edge.type == EdgeType.TYPE_1:
+            self.prev_edge = edge
 
     def remove_out_edge(self, edge: Edge) -> None:
         self.out_edges.remove(edge)
+        self.out_edges_by_type[edge.type].remove(edge)
+        if edge is self.next_edge:
+            self.next_edge = None
 
     def remove_in_edge(self, edge: Edge) -> None:
         self.in_edges.remove(edge)
+        self.in_edges_by_type[edge.type].remove(edge)
+        if edge is self.prev_edge:
+            self.prev_edge = None
 
     def __hash__(self) -> int:
         return hash(self.id)
@@ -1,22 +1,20 @@
+import json
 import random
-from typing import Dict, List, Optional, Set
+import hashlib
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 from pathlib import Path
 import fire
+import numpy as np
 
 from simulation import Intersection, Simulator
 from utility import read_intersection_from_json
 
-def get_src_traj_dict(intersection: Intersection):
-    traj_per_src = {}
-    src_lanes: Dict[str, Set[str]] = intersection.src_lanes
-    for src_lane_id in src_lanes:
-        traj_per_src[src_lane_id] = {}
-    for traj in intersection.trajectories:
-        for src_lane_id, associated_czs in src_lanes.items():
-            if traj[0] in associated_czs:
-                dst_lane_id = intersection.get_traj_dst_lane(traj)
-                traj_per_src[src_lane_id][traj] = dst_lane_id
-    return traj_per_src
+def get_src_traj_dict(intersection: Intersection) -> Dict[str, Dict[Tuple[str], str]]:
+    traj_dst_lane = intersection.traj_dst_lane
+    return {
+        src_lane_id: {traj: traj_dst_lane[traj] for traj in trajs}
+        for src_lane_id, trajs in intersection.src_lane_trajectories.items()
+    }
 
 def add_single_batch_random_traffic(
     sim: Simulator,
@@ -45,24 +43,190 @@ def add_random_traffic(sim: Simulator, max_time=300, max_vehicle_num=8, p=0.05):
                 sim.add_vehicle(f"vehicle-{veh_num}", t, traj, src_lane_id, dst_lane_id, vertex_passing_time=random.randint(7, 13))
                 veh_num += 1
 
+ARRIVAL_PROCESSES = ("bernoulli", "poisson", "burst")
+
+def check_arrival_process(arrival_process: str, mean_burst_size: float) -> None:
+    if arrival_process not in ARRIVAL_PROCESSES:
+        raise Exception(f"[check_arrival_process] unknown arrival process: {arrival_process}")
+    if arrival_process == "burst" and not mean_burst_size >= 1:
+        raise Exception(f"[check_arrival_process] mean_burst_size must be at least 1, got {mean_burst_size}")
+
+def _sample_arrivals(
+    intersection: Intersection,
+    num_scenarios: int,
+    max_vehicle_num: int,
+    max_time: int,
+    p: Union[float, Sequence[float]],
+    arrival_process: str,
+    rate_profile: Optional[Sequence[float]],
+    mean_burst_size: float,
+    rng: np.random.Generator
+) -> Tuple[List[int], List[int], List[Tuple[str]], List[str], List[str], List[int]]:
+    '''
+    return the scenario offsets and the arrival times, trajectories, source lanes,
+    destination lanes and passing times of the vehicles of all scenarios
+    '''
+    check_arrival_process(arrival_process, mean_burst_size)
+    src_lane_ids = list(intersection.src_lanes)
+    src_lane_trajs = intersection.src_lane_trajectories
+    trajs = [traj for src_lane_id in src_lane_ids for traj in src_lane_trajs[src_lane_id]]
+    traj_counts = np.array([len(src_lane_trajs[src_lane_id]) for src_lane_id in src_lane_ids])
+    traj_offsets = np.cumsum(traj_counts) - traj_counts
+    dst_lane_ids = [intersection.get_traj_dst_lane(traj) for traj in trajs]
+    num_lanes = len(src_lane_ids)
+
+    p = np.broadcast_to(np.asarray(p, dtype=np.float64), (num_scenarios,))[:, None, None]
+    if rate_profile is not None:
+        rate_profile = np.asarray(rate_profile, dtype=np.float64)
+        p = p * np.interp(np.arange(max_time), np.linspace(0, max_time - 1, len(rate_profile)),
+                          rate_profile)[None, :, None]
+    shape = (num_scenarios, max_time, num_lanes)
+    if arrival_process == "bernoulli":
+        counts = (rng.random(shape) < p).astype(np.int64)
+    elif arrival_process == "poisson":
+        counts = rng.poisson(np.broadcast_to(p, shape))
+    else:
+        bursts = rng.random(shape) < p / mean_burst_size
+        counts = np.where(bursts, 1 + rng.poisson(mean_burst_size - 1, shape), 0)
+    counts[:, :, traj_counts == 0] = 0
+
+    # keep the first max_vehicle_num arrivals of every scenario in (timestamp, source lane) order
+    counts = counts.reshape(num_scenarios, -1)
+    cumulative_counts = np.cumsum(counts, axis=1)
+    counts = np.minimum(cumulative_counts, max_vehicle_num) \
+             - np.minimum(cumulative_counts - counts, max_vehicle_num)
+    cells = np.repeat(np.arange(counts.size), counts.ravel())
+    arrival_times = (cells // num_lanes) % max_time
+    lane_idx = cells % num_lanes
+    traj_idx = traj_offsets[lane_idx] + (rng.random(len(cells)) * traj_counts[lane_idx]).astype(np.int64)
+    passing_times = rng.integers(7, 14, len(cells))
+
+    scenario_offsets = np.concatenate(([0], np.cumsum(counts.sum(axis=1)))).tolist()
+    traj_idx = traj_idx.tolist()
+    return (
+        scenario_offsets,
+        arrival_times.tolist(),
+        [trajs[j] for j in traj_idx],
+        [src_lane_ids[j] for j in lane_idx.tolist()],
+        [dst_lane_ids[j] for j in traj_idx],
+        passing_times.tolist()
+    )
+
+def sample_random_traffic(
+    intersection: Intersection,
+    num_scenarios: int = 1,
+    max_vehicle_num: int = 8,
+    max_time: int = 300,
+    p: Union[float, Sequence[float]] = 0.05,
+    arrival_process: str = "bernoulli",
+    rate_profile: Optional[Sequence[float]] = None,
+    mean_burst_size: float = 3.0,
+    rng: Optional[np.random.Generator] = None,
+    disturbance_prob: Optional[float] = None
+) -> List[Simulator]:
+    '''
+    vectorized counterpart of add_random_traffic, the arrivals of every source lane at every
+    timestamp of num_scenarios scenarios are drawn at once
+    p: the expected number of arrivals per source lane and timestamp, a single value or one per scenario
+    arrival_process: "bernoulli" (at most one arrival), "poisson" or "burst" (bursts of
+                     1 + Poisson(mean_burst_size - 1) vehicles arriving together)
+    rate_profile: multipliers of p spread evenly over [0, max_time) and linearly interpolated,
+                  e.g. [0.5, 2, 0.5] for a peak in the middle
+    '''
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+    offsets, arrival_times, trajs, src_lane_ids, dst_lane_ids, passing_times = _sample_arrivals(
+        intersection, num_scenarios, max_vehicle_num, max_time, p,
+        arrival_process, rate_profile, mean_burst_size, rng)
+    sims = []
+    for i in range(num_scenarios):
+        begin, end = offsets[i], offsets[i+1]
+        sim = Simulator(intersection, disturbance_prob=disturbance_prob)
+        sim.add_vehicles(
+            [f"vehicle-{j}" for j in range(end - begin)],
+            arrival_times[begin:end],
+            trajs[begin:end],
+            src_lane_ids[begin:end],
+            dst_lane_ids[begin:end],
+            passing_times[begin:end]
+        )
+        sims.append(sim)
+    return sims
+
+def random_arrival_stream(
+    intersection: Intersection,
+    p: float = 0.05,
+    arrival_process: str = "bernoulli",
+    rate_profile: Optional[Sequence[float]] = None,
+    mean_burst_size: float = 3.0,
+    max_vehicle_num: Optional[int] = None,
+    chunk_time: int = 1000,
+    rng: Optional[np.random.Generator] = None
+) -> Iterator[Dict]:
+    '''
+    an endless (or max_vehicle_num long) stream of random arrivals sorted by arrival time for
+    Simulator.set_arrival_feed, drawn chunk_time timestamps at a time; rate_profile repeats
+    every chunk_time timestamps, see sample_random_traffic for the other arguments
+    '''
+    check_arrival_process(arrival_process, mean_burst_size)
+    max_rate = p * (1 if rate_profile is None else max(rate_profile, default=0))
+    if not max_rate > 0 or all(len(trajs) == 0 for trajs in intersection.src_lane_trajectories.values()):
+        raise Exception("[random_arrival_stream] the arrival rate is zero, the stream would never yield")
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+    veh_num = 0
+    chunk_start = 0
+    while max_vehicle_num is None or veh_num < max_vehicle_num:
+        remaining = np.iinfo(np.int64).max if max_vehicle_num is None else max_vehicle_num - veh_num
+        _, arrival_times, trajs, src_lane_ids, dst_lane_ids, passing_times = _sample_arrivals(
+            intersection, 1, remaining, chunk_time, p, arrival_process, rate_profile, mean_burst_size, rng)
+        for arrival_time, traj, src_lane_id, dst_lane_id, passing_time in zip(
+            arrival_times, trajs, src_lane_ids, dst_lane_ids, passing_times
+        ):
+            yield {
+                "id": f"vehicle-{veh_num}",
+                "earliest_arrival_time": chunk_start + arrival_time,
+                "trajectory": traj,
+                "src_lane_id": src_lane_id,
+                "dst_lane_id": dst_lane_id,
+                "vertex_passing_time": passing_time
+            }
+            veh_num += 1
+        chunk_start += chunk_time
+
 def random_traffic_generator(
     intersection: Intersection,
     num_iter: int = 10000,
     max_vehicle_num: int = 8,
     poisson_parameter_list = [0.5],
     mode: str = "stream",
-    disturbance_prob: Optional[float] = None
+    disturbance_prob: Optional[float] = None,
+    batch_size: int = 64,
+    rng: Optional[np.random.Generator] = None
 ):
+    '''
+    the "stream" traffic is sampled by sample_random_traffic batch_size scenarios at a time,
+    rng defaults to a generator seeded from the random module
+    '''
+    if mode == "stream":
+        if rng is None:
+            rng = np.random.default_rng(random.getrandbits(64))
+        i = 0
+        while num_iter <= 0 or i < num_iter:
+            num_scenarios = batch_size if num_iter <= 0 else min(batch_size, num_iter - i)
+            p = rng.choice(poisson_parameter_list, size=num_scenarios) / 10
+            yield from sample_random_traffic(intersection, num_scenarios, max_vehicle_num=max_vehicle_num,
+                                             max_time=300, p=p, rng=rng, disturbance_prob=disturbance_prob)
+            i += num_scenarios
+        return
+
     cond = lambda _: True
     if num_iter > 0:
         cond = lambda i: i < num_iter
     i = 0
     while cond(i):
         sim = Simulator(intersection, disturbance_prob=disturbance_prob)
-        if mode == "stream":
-            add_random_traffic(sim, max_vehicle_num=max_vehicle_num, max_time=300,
-                                p=random.choice(poisson_parameter_list) / 10)
-        elif mode == "batch":
+        if mode == "batch":
             add_single_batch_random_traffic(sim, max_vehicle_num=max_vehicle_num,
                                 p=random.choice(poisson_parameter_list) / 10)
         else:
@@ -70,14 +234,133 @@ def random_traffic_generator(
         i += 1
         yield sim
 
-def datadir_traffic_generator(intersection: Intersection, data_dir, disturbance_prob: Optional[float] = None):
+TRAFFIC_NPZ_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+
+
+def dump_traffic_npz(sims: Iterable[Simulator], path, names: Optional[Sequence[str]] = None) -> int:
+    '''
+    write the traffic of many simulators into a single columnar .npz file: the vehicles of all
+    scenarios are concatenated and scenario_offsets delimits them, trajectories and lanes are
+    stored once in tables and referred to by index; return the number of scenarios
+    '''
+    traj_table: Dict[Tuple[str], int] = {}
+    lane_table: Dict[str, int] = {}
+    scenario_offsets = [0]
+    ids, arrival_times, passing_times, traj_idx, src_lane_idx, dst_lane_idx = [], [], [], [], [], []
+    for sim in sims:
+        for vehicle in sim.vehicles:
+            ids.append(vehicle.id)
+            arrival_times.append(vehicle.earliest_arrival_time)
+            passing_times.append(vehicle.vertex_passing_time)
+            traj_idx.append(traj_table.setdefault(vehicle.trajectory, len(traj_table)))
+            src_lane_idx.append(lane_table.setdefault(vehicle.src_lane_id, len(lane_table)))
+            dst_lane_idx.append(lane_table.setdefault(vehicle.dst_lane_id, len(lane_table)))
+        scenario_offsets.append(len(ids))
+
+    num_scenarios = len(scenario_offsets) - 1
+    if names is None:
+        names = [str(i) for i in range(num_scenarios)]
+    if len(names) != num_scenarios:
+        raise Exception("[dump_traffic_npz] the number of names does not match the number of scenarios")
+    trajs = list(traj_table)
+    np.savez_compressed(
+        path,
+        version=np.array(TRAFFIC_NPZ_VERSION),
+        scenario_names=np.array(names, dtype=str),
+        scenario_offsets=np.array(scenario_offsets, dtype=np.int64),
+        vehicle_ids=np.array(ids, dtype=str),
+        arrival_times=np.array(arrival_times, dtype=np.int64),
+        vertex_passing_times=np.array(passing_times, dtype=np.int64),
+        traj_idx=np.array(traj_idx, dtype=np.int32),
+        src_lane_idx=np.array(src_lane_idx, dtype=np.int32),
+        dst_lane_idx=np.array(dst_lane_idx, dtype=np.int32),
+        traj_table_czs=np.array([cz_id for traj in trajs for cz_id in traj], dtype=str),
+        traj_table_offsets=np.cumsum([0] + [len(traj) for traj in trajs]).astype(np.int64),
+        lane_table=np.array(list(lane_table), dtype=str)
+    )
+    return num_scenarios
+
+
+def load_traffic_npz(
+    intersection: Intersection,
+    path,
+    disturbance_prob: Optional[float] = None
+) -> Iterator[Tuple[str, Simulator]]:
+    '''
+    read a file written by dump_traffic_npz at once and yield (scenario name, simulator) pairs
+    '''
+    with np.load(path, allow_pickle=False) as data:
+        if int(data["version"]) != TRAFFIC_NPZ_VERSION:
+            raise Exception(f"[load_traffic_npz] unsupported version {int(data['version'])}")
+        columns = {key: data[key].tolist() for key in data.files if key != "version"}
+
+    czs, traj_offsets = columns["traj_table_czs"], columns["traj_table_offsets"]
+    trajs = [tuple(czs[traj_offsets[i]:traj_offsets[i+1]]) for i in range(len(traj_offsets) - 1)]
+    lanes = columns["lane_table"]
+    offsets = columns["scenario_offsets"]
+    for i, name in enumerate(columns["scenario_names"]):
+        begin, end = offsets[i], offsets[i+1]
+        sim = Simulator(intersection, disturbance_prob=disturbance_prob)
+        sim.add_vehicles(
+            columns["vehicle_ids"][begin:end],
+            columns["arrival_times"][begin:end],
+            [trajs[j] for j in columns["traj_idx"][begin:end]],
+            [lanes[j] for j in columns["src_lane_idx"][begin:end]],
+            [lanes[j] for j in columns["dst_lane_idx"][begin:end]],
+            columns["vertex_passing_times"][begin:end]
+        )
+        yield name, sim
+
+
+def named_traffic_generator(
+    intersection: Intersection,
+    data_dir,
+    disturbance_prob: Optional[float] = None
+) -> Iterator[Tuple[str, Simulator]]:
+    '''
+    yield (name, simulator) pairs of the traffic in data_dir (see datadir_traffic_generator),
+    the name of a JSON traffic is its path and the one of a scenario packed in a .npz file
+    is "<path>#<scenario name>"
+    '''
+    def load_npz(path: Path):
+        for name, sim in load_traffic_npz(intersection, path, disturbance_prob=disturbance_prob):
+            yield f"{path}#{name}", sim
+
     data_dir = Path(data_dir)
+    if data_dir.is_file() and data_dir.suffix == ".npz":
+        yield from load_npz(data_dir)
+        return
     if not data_dir.exists() or not data_dir.is_dir():
         raise Exception("data_dir is not a directory")
 
-    for traffic_file in data_dir.iterdir():
-        sim = Simulator(intersection, disturbance_prob=disturbance_prob)
-        sim.load_traffic(traffic_file)
+    manifest_file = data_dir / MANIFEST_FILE
+    if manifest_file.exists():
+        with open(manifest_file, "rt", encoding="utf-8") as f:
+            manifest = json.load(f)
+        for shard in manifest["shards"]:
+            shard_file = data_dir / shard["file"]
+            with open(shard_file, "rb") as f:
+                if hashlib.sha256(f.read()).hexdigest() != shard["sha256"]:
+                    raise Exception(f"[named_traffic_generator] {shard_file} does not match the sha256 in the manifest")
+            yield from load_npz(shard_file)
+        return
+
+    for traffic_file in sorted(data_dir.iterdir()):
+        if traffic_file.suffix == ".npz":
+            yield from load_npz(traffic_file)
+        elif traffic_file.suffix == ".json":
+            sim = Simulator(intersection, disturbance_prob=disturbance_prob)
+            sim.load_traffic(traffic_file)
+            yield str(traffic_file), sim
+
+def datadir_traffic_generator(intersection: Intersection, data_dir, disturbance_prob: Optional[float] = None):
+    '''
+    data_dir is a directory of JSON traffic files and .npz files, a single .npz file, or a
+    dataset directory written by dataset_gen whose shards are read in the order of its manifest
+    and checked against the sha256 recorded there
+    '''
+    for _, sim in named_traffic_generator(intersection, data_dir, disturbance_prob=disturbance_prob):
         yield sim
 
 def main(
@@ -87,8 +370,12 @@ def main(
     num: int = 10,
     max_vehicle_num: int = 4,
     poisson_parameter_list: List = [0.1, 0.3, 0.5],
-    mode: str = "stream"
+    mode: str = "stream",
+    output_format: str = "json"
 ):
+    '''
+    output_format: "json" writes one file per scenario, "npz" writes all of them into traffic.npz
+    '''
     random.seed(seed)
     intersection: Intersection = read_intersection_from_json(intersection_file_path)
     data_dir = Path(output_dir)
@@ -96,8 +383,13 @@ def main(
         data_dir.mkdir(parents=True)
 
     gen = random_traffic_generator(intersection, num_iter=num, max_vehicle_num=max_vehicle_num, poisson_parameter_list=poisson_parameter_list, mode=mode)
-    for i, sim in enumerate(gen):
-        sim.dump_traffic(data_dir / f"{i}.json")
+    if output_format == "npz":
+        dump_traffic_npz(gen, data_dir / "traffic.npz")
+    elif output_format == "json":
+        for i, sim in enumerate(gen):
+            sim.dump_traffic(data_dir / f"{i}.json")
+    else:
+        raise Exception(f"unknown output format: {output_format}")
 
 
 if __name__ == "__main__":
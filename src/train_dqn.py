@@ -1,10 +1,27 @@
+from functools import partial
+
+from tf_agents.system import system_multiprocessing as multiprocessing
+
 from utility import read_intersection_from_json
 from simulation import Simulator
 from environment.func_approx import MinimumEnv, AutoGenTrafficWrapperEnv
 from training.dqn import DQNTrainer
+from training.dqn.config import config
+
+
+def make_env(intersection_file_path: str, max_vehicle_num: int, num_workers: int = 0, queue_size: int = 256):
+    intersection = read_intersection_from_json(intersection_file_path)
+    sim = Simulator(intersection)
+    return AutoGenTrafficWrapperEnv(MinimumEnv(sim, max_vehicle_num), num_workers=num_workers, queue_size=queue_size)
+
+def main(_):
+    env_fn = partial(make_env, "../intersection_configs/2x2.json", 8,
+                     num_workers=config.snapshot_workers, queue_size=config.snapshot_queue_size)
+    trainer = DQNTrainer(env_fn(), env_fn=env_fn)
+    try:
+        trainer.fit()
+    finally:
+        trainer.close()
 
-intersection = read_intersection_from_json("../intersection_configs/2x2.json")
-sim = Simulator(intersection)
-env = AutoGenTrafficWrapperEnv(MinimumEnv(sim, 8))
-trainer = DQNTrainer(env)
-trainer.fit()
+if __name__ == "__main__":
+    multiprocessing.handle_main(main)
@@ -30,12 +30,22 @@ class config:
     initial_collect_steps = 1000
     replay_buffer_max_length = 100000
     collect_steps_per_iteration = 10
+    num_parallel_envs = 1
+    # background processes generating the snapshot environments of every AutoGenTrafficWrapperEnv,
+    # so that the driver never waits for a rollout; 0 generates them on the driver thread
+    snapshot_workers = 2
+    snapshot_queue_size = 256
 
     # loggings
     log_iterval = 200
+    # time the hot paths of the simulator and the environments; only the environments
+    # in the training process are profiled, not the ones in parallel or worker processes
+    profile = False
+    profile_file = None     # per-iteration statistics are appended as JSON lines
     ckpt_interval = 2000
     ckpt_kept_num = 5
 
     # validation
     valid_data_dir = "../testdata/test-2x2-s/"
     valid_interval = 1000
+    async_validation = False
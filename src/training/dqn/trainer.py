@@ -1,19 +1,23 @@
 import tensorflow as tf
 import numpy as np
 import os
+import multiprocessing as mp
 import reverb
 from datetime import datetime
+from typing import Callable, Optional
 
 from tf_agents.typing.types import TensorSpec
 from tf_agents.environments.py_environment import PyEnvironment
 from tf_agents.environments.tf_environment import TFEnvironment
 from tf_agents.environments.tf_py_environment import TFPyEnvironment
+from tf_agents.environments.parallel_py_environment import ParallelPyEnvironment
 from tf_agents.networks.q_network import QNetwork
 from tf_agents.agents import TFAgent
 from tf_agents.agents.dqn.dqn_agent import DqnAgent, DdqnAgent
 from tf_agents.policies.random_tf_policy import RandomTFPolicy
 from tf_agents.policies.py_tf_eager_policy import PyTFEagerPolicy
 from tf_agents.policies.q_policy import QPolicy
+from tf_agents.policies.policy_saver import PolicySaver
 from tf_agents.replay_buffers import reverb_replay_buffer, reverb_utils
 from tf_agents.drivers import py_driver
 from tf_agents.metrics import tf_metrics
@@ -24,8 +28,9 @@ from tf_agents.specs import tensor_spec
 from training.dqn.config import config
 
 from environment.func_approx import AutoGenTrafficWrapperEnv
-from evaluate import batch_evaluate_tf
+from evaluate import batch_evaluate_tf, evaluate_saved_policy
 from traffic_gen import datadir_traffic_generator
+from profiling import profiler
 
 
 def observation_and_action_constraint_splitter(observation):
@@ -47,12 +52,37 @@ def compute_avg_return(environment, policy, num_episodes=10):
     avg_return = total_return / num_episodes
     return avg_return.numpy()[0]
 
+class BatchedTrajectoryObserver(object):
+    '''
+    Split the batched trajectories of parallel environments and
+    pass the trajectory of each environment to its own observer
+    '''
+    def __init__(self, observers):
+        self.observers = observers
+
+    def __call__(self, trajectory):
+        for i, observer in enumerate(self.observers):
+            observer(tf.nest.map_structure(lambda t: t[i], trajectory))
+
+    def flush(self):
+        for observer in self.observers:
+            observer.flush()
+
+    def reset(self, write_cached_steps=True):
+        for observer in self.observers:
+            observer.reset(write_cached_steps=write_cached_steps)
+
 class DQNTrainer(object):
 
     def __init__(
         self,
         env: PyEnvironment,
+        env_fn: Optional[Callable[[], PyEnvironment]] = None
     ) -> None:
+        '''
+        env_fn: constructor of the training environment; required when
+                config.num_parallel_envs > 1 to run the copies in subprocesses
+        '''
         # model name
         now = datetime.now()
         time = now.strftime("%m-%d")
@@ -66,7 +96,17 @@ class DQNTrainer(object):
             self.observation_decoder = env.decode_state
 
         # environment
-        self.train_py_env: PyEnvironment = env
+        self.num_parallel_envs: int = config.num_parallel_envs
+        if self.num_parallel_envs > 1:
+            if env_fn is None:
+                raise Exception("[DQNTrainer] env_fn is required when config.num_parallel_envs > 1")
+            self.train_py_env: PyEnvironment = ParallelPyEnvironment(
+                [env_fn] * self.num_parallel_envs,
+                start_serially=False
+            )
+        else:
+            self.train_py_env: PyEnvironment = env
+        self.py_env: PyEnvironment = env
         self.train_env: TFEnvironment = TFPyEnvironment(env)
         self.eval_env: TFEnvironment = TFPyEnvironment(env)
 
@@ -114,6 +154,13 @@ class DQNTrainer(object):
         self.collect_driver = self.configure_collect_driver()
         self.initial_driver.run(self.train_py_env.reset())
 
+        # validation
+        self.valid_sims = None
+        self.valid_process = None
+        self.valid_policy_saver = None
+        if config.async_validation:
+            self.valid_policy_saver = PolicySaver(self.configure_eval_policy(), batch_size=None)
+
         # checkpointer
         self.train_checkpointer = self.configure_checkpointer()
         self.train_checkpointer.initialize_or_restore()
@@ -209,19 +256,26 @@ class DQNTrainer(object):
             local_server=reverb_server
         )
 
-        rb_observer = reverb_utils.ReverbAddTrajectoryObserver(
-            replay_buffer.py_client,
-            table_name,
-            sequence_length=2
-        )
-        return replay_buffer, rb_observer
+        # each environment needs its own writer so that its consecutive steps form the sequences
+        rb_observers = [
+            reverb_utils.ReverbAddTrajectoryObserver(
+                replay_buffer.py_client,
+                table_name,
+                sequence_length=2
+            )
+            for _ in range(self.num_parallel_envs)
+        ]
+        if self.num_parallel_envs > 1:
+            return replay_buffer, BatchedTrajectoryObserver(rb_observers)
+        return replay_buffer, rb_observers[0]
 
     def configure_initial_driver(self) -> py_driver.PyDriver:
         return py_driver.PyDriver(
             env=self.train_py_env,
             policy=PyTFEagerPolicy(
                 self.random_policy, 
-                use_tf_function=True
+                use_tf_function=True,
+                batch_time_steps=not self.train_py_env.batched
             ),
             observers=[self.rb_observer],
             max_steps=config.initial_collect_steps
@@ -232,7 +286,8 @@ class DQNTrainer(object):
             env=self.train_py_env,
             policy=PyTFEagerPolicy(
                 self.collect_policy,
-                use_tf_function=True
+                use_tf_function=True,
+                batch_time_steps=not self.train_py_env.batched
             ),
             observers=[self.rb_observer],
             max_steps=config.collect_steps_per_iteration
@@ -252,6 +307,8 @@ class DQNTrainer(object):
         # reset environment
         time_step = self.train_py_env.reset()
         tot_loss = 0
+        if config.profile:
+            profiler.enable()
 
         # training loop
         for _ in range(config.num_iterations):
@@ -265,20 +322,54 @@ class DQNTrainer(object):
             tot_loss += train_loss
 
             step = self.agent.train_step_counter.numpy()
+            if config.profile:
+                profiler.end_episode(config.profile_file, step=int(step))
 
             if step % config.log_iterval == 0:
                 print(f'[LOG] STEP {step} | LOSS {tot_loss / config.log_iterval:.5f}')
                 tot_loss = 0
+                if config.profile:
+                    print(profiler.summary())
 
             if step % config.valid_interval == 0:
                 # avg_return = compute_avg_return(self.eval_env, self.agent.policy)
                 # print(f'[VALID] Average Reward: {avg_return:.5f}')
-                sim_gen = datadir_traffic_generator(self.intersection, config.valid_data_dir)
-                avg_reward = batch_evaluate_tf(self.configure_eval_policy(), sim_gen, self.max_vehicle_num)
-                print(f"Validation Reward = {avg_reward}")
+                self.validate(step)
 
             if step % config.ckpt_interval == 0:
                 self.train_checkpointer.save(step)
 
             # for train_metric in self.train_metrics:
             #     train_metric.tf_summaries(step_metrics=self.train_metrics[:2])
+
+        if self.valid_process is not None:
+            self.valid_process.join()
+
+    def close(self) -> None:
+        '''
+        stop the training environments, including their background workers
+        '''
+        self.train_py_env.close()
+        if self.py_env is not self.train_py_env:
+            self.py_env.close()
+
+    def validate(self, step) -> None:
+        if not config.async_validation:
+            if self.valid_sims is None:
+                self.valid_sims = list(datadir_traffic_generator(self.intersection, config.valid_data_dir))
+            avg_reward = batch_evaluate_tf(self.configure_eval_policy(), self.valid_sims, self.max_vehicle_num)
+            print(f"Validation Reward = {avg_reward}")
+            return
+
+        # export the current policy and evaluate it in a separate process;
+        # at most one validation runs at a time
+        if self.valid_process is not None:
+            self.valid_process.join()
+        policy_dir = os.path.join(self.model_root, 'valid_policy')
+        self.valid_policy_saver.save(policy_dir)
+        self.valid_process = mp.get_context("spawn").Process(
+            target=evaluate_saved_policy,
+            args=(policy_dir, self.intersection, config.valid_data_dir, self.max_vehicle_num, step),
+            daemon=True
+        )
+        self.valid_process.start()
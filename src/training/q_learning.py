@@ -1,4 +1,4 @@
-from typing import Any, Iterable, Dict, Optional, List
+from typing import Any, Iterable, Dict, Optional, List, Union
 from pathlib import Path
 from collections import defaultdict
 import os
@@ -12,30 +12,38 @@ import numpy as np
 import fire
 
 from simulation import Simulator, Intersection
-from utility import read_intersection_from_json, DynamicQtable, FileLock
+from utility import read_intersection_from_json, DynamicQtable, SparseQtable, FileLock
 from evaluate import batch_evaluate
 from policy import QTablePolicy
 from scripts.calc_state_space import construct_state_space
+from profiling import profiler
 import traffic_gen
 import environment
 
 
-def load_Q_table(env, path):
-    table = DynamicQtable(env.action_space_size, init_state_num=1<<20)
+def load_Q_table(env, path, sparse: bool = False):
+    if sparse:
+        table = SparseQtable(
+            env.action_space_size,
+            effective_actions_fn=lambda s: [a for a in range(env.action_space_size)
+                                            if env.is_effective_action_of_state(a, s)]
+        )
+    else:
+        table = DynamicQtable(env.action_space_size, init_state_num=1<<20)
     if os.path.exists(path):
         with FileLock(path, "shared"):
             table.load(path)
     return table
 
 
-def save_Q_table(Q: DynamicQtable, path):
+def save_Q_table(Q: Union[DynamicQtable, SparseQtable], path):
     with FileLock(path, "exclusive"):
         Q.save(path)
 
 
 def train_Q(
     env: environment.tabular.vehicle_based.SimulatorEnv,
-    Q: DynamicQtable,
+    Q: Union[DynamicQtable, SparseQtable],
     seen_state: Optional[Dict] = None,
     alpha: float = 0.1,
     gamma: float = 0.9,
@@ -89,7 +97,7 @@ def train_Q(
 
 def synthesize(
     env,
-    Q: DynamicQtable,
+    Q: Union[DynamicQtable, SparseQtable],
     seen_state: Optional[Dict] = None,
     alpha: float = 0.1,
     gamma: float = 0.9,
@@ -138,16 +146,27 @@ def Q_learning(
     gamma: float = 0.99,
     epsilon: float = 0.1,
     traj_file_list: List[str] = [],
-    deadlock_cost: int = int(1e9)
+    deadlock_cost: int = int(1e9),
+    sparse_Q_table: bool = False,
+    profile: bool = False,
+    profile_file: Optional[str] = None
 ):
+    '''
+    profile: time the hot paths of the simulator and the environment, the statistics are
+             printed at every checkpoint and appended to profile_file after every epoch
+    '''
     # create simulator and environment
     sim = next(simulator_generator)
 
+    if profile:
+        profiler.enable()
+
+    Q_table_suffix: str = ".npz" if sparse_Q_table else ".npy"
     enc_dec_table_path: Path = checkpoint_path / "enc_dec_table.p"
-    Q_table_path: Path = checkpoint_path / "Q.npy"
+    Q_table_path: Path = checkpoint_path / f"Q{Q_table_suffix}"
     seen_path: Path = checkpoint_path / "seen.p"
 
-    best_Q_table_path: Path = checkpoint_path / "Q.best.npy"
+    best_Q_table_path: Path = checkpoint_path / f"Q.best{Q_table_suffix}"
 
     env = environment.tabular.vehicle_based.SimulatorEnv(sim, 
             max_vehicle_num=max_vehicle_num, max_vehicle_num_per_src_lane=max_vehicle_num_per_src_lane,
@@ -167,7 +186,7 @@ def Q_learning(
         env.save_enc_dec_tables(enc_dec_table_path)
         print(f"state space constructed: size = {len(env.decoding_table)}")
 
-    Q = load_Q_table(env, Q_table_path)
+    Q = load_Q_table(env, Q_table_path, sparse=sparse_Q_table)
     seen_state = defaultdict(int)
     if seen_path.is_file():
         with open(seen_path, "rb") as f:
@@ -185,6 +204,8 @@ def Q_learning(
         pbar.set_description(
             f"epoch = {epoch}: {len(seen_state)} / {len(env.decoding_table)} states explored")
         train_Q(env, Q, seen_state, alpha=alpha, gamma=gamma, epsilon=epsilon)
+        if profile:
+            profiler.end_episode(profile_file, epoch=epoch)
 
         if (epoch + 1) % epoch_per_traffic == 0:
             try:
@@ -198,6 +219,8 @@ def Q_learning(
             pbar.set_description("Saving...")
             save_Q_table(Q, Q_table_path)
             pickle.dump(seen_state, open(seen_path, "wb"))
+            if profile:
+                print(profiler.summary())
 
             if eval_data_dir is not None:
                 performance = evaluate(env, Q)
@@ -208,10 +231,13 @@ def Q_learning(
 
         epoch += 1
 
+    if profile:
+        print(profiler.summary())
+
 
 def explore_Q(
     env: environment.tabular.vehicle_based.SimulatorEnv,
-    Q: DynamicQtable,
+    Q: Union[DynamicQtable, SparseQtable],
     trajectories_record_file: Optional[Path] = None,
     epsilon: float = 0.2,
 ):
@@ -266,13 +292,15 @@ def exploration_only(
     epoch_per_traffic: int = 10,
     epoch_per_checkpoint: int = 10000,
     trajectories_record_file: Optional[Path] = None,
-    deadlock_cost: int = int(1e9)
+    deadlock_cost: int = int(1e9),
+    sparse_Q_table: bool = False
 ):
     # create simulator and environment
     sim = next(simulator_generator)
 
+    Q_table_suffix: str = ".npz" if sparse_Q_table else ".npy"
     enc_dec_table_path: Path = checkpoint_path / "enc_dec_table.p"
-    Q_table_path: Path = checkpoint_path / "Q.npy"
+    Q_table_path: Path = checkpoint_path / f"Q{Q_table_suffix}"
 
     env = environment.tabular.vehicle_based.SimulatorEnv(sim, 
             max_vehicle_num=max_vehicle_num, max_vehicle_num_per_src_lane=max_vehicle_num_per_src_lane,
@@ -281,7 +309,7 @@ def exploration_only(
     if enc_dec_table_path.is_file():
         env.load_enc_dec_tables(enc_dec_table_path)
 
-    Q = load_Q_table(env, Q_table_path)
+    Q = load_Q_table(env, Q_table_path, sparse=sparse_Q_table)
 
     epoch = 0
     pbar = tqdm()
@@ -298,6 +326,6 @@ def exploration_only(
 
         if (epoch + 1) % epoch_per_checkpoint == 0:
             pbar.set_description("Saving...")
-            load_Q_table(env, Q_table_path)
+            load_Q_table(env, Q_table_path, sparse=sparse_Q_table)
 
         epoch += 1
@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import Dict, Any, Set, List, Tuple
+from typing import Dict, Any, Set, List, Tuple, Iterable, Optional, Callable
 import json
 import fcntl
 import os
@@ -35,6 +35,14 @@ class DynamicQtable:
         else:
             raise Exception("[DynamicQtable] unsupported indices")
 
+    def get_row(self, row_index: int) -> Optional[np.ndarray]:
+        '''
+        return the row without growing the table, or None if it has not been allocated
+        '''
+        if row_index >= self.__arr.shape[0]:
+            return None
+        return self.__arr[row_index]
+
     def access_row(self, row_index: int):
         while row_index >= self.__arr.shape[0]:
             self.__arr = np.append(self.__arr, np.zeros((self.__arr.shape[0], self.__arr.shape[1])), axis=0)
@@ -47,6 +55,99 @@ class DynamicQtable:
         self.__arr = np.load(path)   
 
 
+class SparseQtable:
+    '''
+    Q table that only keeps the rows of the states which have been accessed.
+    Rows are allocated on first access, filled with default_value, and the
+    actions not returned by effective_actions_fn (if given) are set to np.inf.
+    It supports the same indexing as DynamicQtable.
+    '''
+    def __init__(
+        self,
+        action_num: int,
+        default_value: float = 0.0,
+        effective_actions_fn: Optional[Callable[[int], Iterable[int]]] = None,
+        init_state_num: int = 1<<10
+    ):
+        self.action_num: int = action_num
+        self.default_value: float = default_value
+        self.effective_actions_fn = effective_actions_fn
+        self.__row_of_state: Dict[int, int] = {}
+        self.__arr = np.zeros((init_state_num, action_num))
+
+    def __getitem__(self, items):
+        if type(items) is int:
+            return self.access_row(items)
+        elif type(items) is tuple:
+            assert all([type(i) is int for i in items])
+            assert len(items) <= 2
+            return self.access_row(items[0])[items[1]]
+        else:
+            raise Exception("[SparseQtable] unsupported indices")
+
+    def __setitem__(self, items, values):
+        if type(items) is int:
+            np.copyto(self.access_row(items), values)
+        elif type(items) is tuple:
+            assert all([type(i) is int for i in items])
+            assert len(items) <= 2
+            np.put(self.access_row(items[0]), items[1], values)
+        else:
+            raise Exception("[SparseQtable] unsupported indices")
+
+    def __contains__(self, state: int) -> bool:
+        return state in self.__row_of_state
+
+    def __len__(self) -> int:
+        return len(self.__row_of_state)
+
+    def get_row(self, state: int) -> Optional[np.ndarray]:
+        '''
+        return the row of the state without allocating it, or None if it has never been accessed
+        '''
+        row_index = self.__row_of_state.get(state, None)
+        if row_index is None:
+            return None
+        return self.__arr[row_index]
+
+    def access_row(self, state: int):
+        row_index = self.__row_of_state.get(state, None)
+        if row_index is None:
+            row_index = len(self.__row_of_state)
+            if row_index >= self.__arr.shape[0]:
+                self.__arr = np.append(self.__arr, np.zeros_like(self.__arr), axis=0)
+            row = self.__arr[row_index]
+            row.fill(self.default_value)
+            if self.effective_actions_fn is not None:
+                invalid = np.ones(self.action_num, dtype=np.bool_)
+                invalid[list(self.effective_actions_fn(state))] = False
+                row[invalid] = np.inf
+            self.__row_of_state[state] = row_index
+        return self.__arr[row_index]
+
+    def save(self, path):
+        states = np.fromiter(self.__row_of_state.keys(), dtype=np.int64, count=len(self))
+        with open(path, "wb") as f:
+            np.savez_compressed(f, states=states, values=self.__arr[:len(self)])
+
+    def load(self, path):
+        '''
+        Load a table written by save(), or a dense table written by
+        DynamicQtable.save(), in which case all-default rows are dropped.
+        '''
+        data = np.load(path)
+        if isinstance(data, np.ndarray):
+            states = np.flatnonzero((data != self.default_value).any(axis=1))
+            values = data[states]
+        else:
+            with data:
+                states, values = data["states"], data["values"]
+        self.__row_of_state = {int(s): i for i, s in enumerate(states)}
+        self.__arr = np.array(values, dtype=np.float64).reshape(-1, self.action_num)
+        if self.__arr.shape[0] == 0:
+            self.__arr = np.zeros((1, self.action_num))
+
+
 class Digraph:
     def __init__(self):
         self.name_to_idx: Dict[Any, int] = {}
@@ -88,74 +189,343 @@ class Digraph:
         if src_idx is not None and dst_idx is not None:
             self.adj[src_idx].remove(dst_idx)
 
-    def has_cycle(self) -> bool:
-        color: List[int] = [0 for _ in self.adj]
-        
-        def dfs(v: int) -> bool:
-            color[v] = 1
-            for u in self.adj[v]:
-                if color[u] == 0:
-                    if dfs(u):
-                        return True
-                elif color[u] == 1:
-                    return True
-            color[v] = 2
-            return False
+    def to_csr(self) -> Tuple[np.ndarray, np.ndarray]:
+        indptr = np.zeros(len(self.adj) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(neighbors) for neighbors in self.adj])
+        indices = np.fromiter((u for neighbors in self.adj for u in neighbors),
+                              dtype=np.int64, count=int(indptr[-1]))
+        return indptr, indices
 
-        for v in range(len(self.adj)):
-            if color[v] == 0:
-                if dfs(v):
-                    return True
-        
-        return False
+    def has_cycle(self) -> bool:
+        scc_id, num_scc = tarjan_scc(*self.to_csr())
+        if num_scc < len(self.adj):
+            return True
+        return any(v in neighbors for v, neighbors in enumerate(self.adj))
 
     def get_scc_graph(self) -> Digraph:
-        adj_rev: List[Set] = [set() for _ in self.adj]
-        for src, neighbors in enumerate(self.adj):
-            for u in neighbors:
-                adj_rev[u].add(src)
-        
-        visited: List = [False for _ in self.adj]
-        order: List = []
-        def dfs1(v: int) -> None:
-            visited[v] = True
-            for u in self.adj[v]:
-                if not visited[u]:
-                    dfs1(u)
-            order.append(v)
-        
-        for v in range(len(self.adj)):
-            if not visited[v]:
-                dfs1(v)
-        
-        visited = [False for _ in self.adj]
-        def dfs2(v: int, component: List) -> None:
-            visited[v] = True
-            component.append(v)
-            for u in adj_rev[v]:
-                if not visited[u]:
-                    dfs2(u, component)
+        scc_id, num_scc = tarjan_scc(*self.to_csr())
+        scc_id = scc_id.tolist()
+        members: List[List[int]] = [[] for _ in range(num_scc)]
+        for v, c in enumerate(scc_id):
+            members[c].append(v)
+        components = [tuple(sorted([self.idx_to_name[i] for i in m])) for m in members]
+
+        # SCC ids are in reverse topological order
+        scc_graph = type(self)()
+        for c in range(num_scc - 1, -1, -1):
+            scc_graph.add_vertex(components[c])
+
+        for c in range(num_scc - 1, -1, -1):
+            for member in members[c]:
+                for u in self.adj[member]:
+                    if scc_id[u] != c:
+                        scc_graph.add_edge(components[c], components[scc_id[u]])
+
+        return scc_graph
+
+
+def tarjan_scc(indptr: np.ndarray, indices: np.ndarray) -> Tuple[np.ndarray, int]:
+    '''
+    Iterative Tarjan's algorithm on a graph given in CSR form, i.e. the
+    neighbors of vertex v are indices[indptr[v]:indptr[v+1]].
+    Return the SCC id of every vertex and the number of SCCs. SCC ids are
+    assigned in reverse topological order: every edge goes from a vertex to
+    one whose SCC id is smaller or equal.
+    '''
+    n = len(indptr) - 1
+    indptr = np.asarray(indptr).tolist()
+    indices = np.asarray(indices).tolist()
+
+    index: List[int] = [-1] * n
+    low: List[int] = [0] * n
+    on_stack: List[bool] = [False] * n
+    scc_id: List[int] = [-1] * n
+    stack: List[int] = []
+    counter = 0
+    num_scc = 0
+
+    for root in range(n):
+        if index[root] != -1:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        call_stack: List[List[int]] = [[root, indptr[root]]]
+
+        while call_stack:
+            frame = call_stack[-1]
+            v, pos = frame
+            end = indptr[v + 1]
+            descended = False
+            while pos < end:
+                u = indices[pos]
+                pos += 1
+                if index[u] == -1:
+                    frame[1] = pos
+                    index[u] = low[u] = counter
+                    counter += 1
+                    stack.append(u)
+                    on_stack[u] = True
+                    call_stack.append([u, indptr[u]])
+                    descended = True
+                    break
+                if on_stack[u] and index[u] < low[v]:
+                    low[v] = index[u]
+            if descended:
+                continue
+
+            call_stack.pop()
+            if low[v] == index[v]:
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = False
+                    scc_id[w] = num_scc
+                    if w == v:
+                        break
+                num_scc += 1
+            if call_stack:
+                parent = call_stack[-1][0]
+                if low[v] < low[parent]:
+                    low[parent] = low[v]
+
+    return np.array(scc_id, dtype=np.int64), num_scc
+
+
+class BitsetDigraph:
+    '''
+    Drop-in replacement of Digraph for small graphs (at most a few dozen
+    vertices, such as the CZ graphs built by the policies). The adjacency of
+    every vertex is an integer bitmask; parallel edges are tracked by a
+    counter so that add_edge/remove_edge keep the multigraph semantics of
+    Digraph in O(1).
+    '''
+    def __init__(self):
+        self.name_to_idx: Dict[Any, int] = {}
+        self.idx_to_name: Dict[int, Any] = {}
+        self.adj: List[int] = []
+        self.edge_count: Dict[Tuple[int, int], int] = {}
+
+    @property
+    def vertices(self) -> List:
+        return list(self.name_to_idx.keys())
+
+    @staticmethod
+    def _iter_bits(mask: int) -> Iterable[int]:
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def get_neighbors(self, v: Any) -> List:
+        v_idx = self.name_to_idx[v]
+        res = []
+        for u_idx in self._iter_bits(self.adj[v_idx]):
+            res.extend([self.idx_to_name[u_idx]] * self.edge_count[v_idx, u_idx])
+        return res
+
+    def print(self) -> None:
+        for i, neighbors in enumerate(self.adj):
+            print(self.idx_to_name[i], end=": ")
+            for u in self._iter_bits(neighbors):
+                print(self.idx_to_name[u], end=" ")
+            print()
+
+    def add_vertex(self, v: Any) -> int:
+        idx = self.name_to_idx.get(v, None)
+        if idx is None:
+            idx = len(self.adj)
+            self.name_to_idx[v] = idx
+            self.idx_to_name[idx] = v
+            self.adj.append(0)
+        return idx
+
+    def add_edge(self, src: Any, dst: Any) -> None:
+        src_idx = self.add_vertex(src)
+        dst_idx = self.add_vertex(dst)
+        key = (src_idx, dst_idx)
+        self.edge_count[key] = self.edge_count.get(key, 0) + 1
+        self.adj[src_idx] |= 1 << dst_idx
+
+    def remove_edge(self, src: Any, dst: Any) -> None:
+        src_idx = self.name_to_idx.get(src, None)
+        dst_idx = self.name_to_idx.get(dst, None)
+        if src_idx is not None and dst_idx is not None:
+            key = (src_idx, dst_idx)
+            count = self.edge_count.get(key, 0)
+            if count == 0:
+                raise ValueError(f"[BitsetDigraph.remove_edge] edge ({src}, {dst}) does not exist")
+            if count == 1:
+                del self.edge_count[key]
+                self.adj[src_idx] &= ~(1 << dst_idx)
+            else:
+                self.edge_count[key] = count - 1
 
+    def has_cycle(self) -> bool:
+        # repeatedly peel off all vertices without out-going edges into the remaining set
+        remaining = (1 << len(self.adj)) - 1
+        while remaining:
+            sinks = 0
+            for v in self._iter_bits(remaining):
+                if self.adj[v] & remaining == 0:
+                    sinks |= 1 << v
+            if sinks == 0:
+                return True
+            remaining &= ~sinks
+        return False
+
+    def transitive_closure(self) -> List[int]:
+        '''
+        Return, for every vertex index, the bitmask of vertices reachable from
+        it by a path of length >= 1.
+        '''
+        reach = list(self.adj)
+        for k in range(len(reach)):
+            k_bit = 1 << k
+            reach_k = reach[k]
+            for i in range(len(reach)):
+                if reach[i] & k_bit:
+                    reach[i] |= reach_k
+        return reach
+
+    def get_scc_graph(self) -> BitsetDigraph:
+        reach = self.transitive_closure()
+        n = len(self.adj)
+        home: List[int] = [-1 for _ in range(n)]
+        components: List[int] = []
+        for v in range(n):
+            if home[v] != -1:
+                continue
+            members = 1 << v
+            for u in self._iter_bits(reach[v]):
+                if reach[u] & (1 << v):
+                    members |= 1 << u
+            for u in self._iter_bits(members):
+                home[u] = len(components)
+            components.append(members)
+
+        # a component reaching another one has a strictly larger closure,
+        # so sorting by closure size yields a topological order
+        def closure_size(members: int) -> int:
+            return bin(reach[members.bit_length() - 1] | members).count("1")
+        order = sorted(range(len(components)), key=lambda c: -closure_size(components[c]))
+
+        names = [tuple(sorted(self.idx_to_name[u] for u in self._iter_bits(components[c])))
+                 for c in range(len(components))]
         scc_graph = type(self)()
-        home: Dict[Any, Tuple] = {}
-        for v in order[::-1]:
-            if not visited[v]:
-                component_idx = []
-                dfs2(v, component_idx)
-                component = tuple(sorted([self.idx_to_name[i] for i in component_idx]))
-                scc_graph.add_vertex(component)
-                for member in component_idx:
-                    home[member] = component
-        
-        for component in scc_graph.vertices:
-            for member in component:
-                for u in self.adj[self.name_to_idx[member]]:
-                    if component != home[u]:
-                        scc_graph.add_edge(component, home[u])
-        
+        for c in order:
+            scc_graph.add_vertex(names[c])
+        for c in order:
+            out = 0
+            for member in self._iter_bits(components[c]):
+                out |= self.adj[member]
+            out &= ~components[c]
+            targets = set(home[u] for u in self._iter_bits(out))
+            for t in targets:
+                scc_graph.add_edge(names[c], names[t])
+
         return scc_graph
 
 
+class ReachabilityIndex:
+    '''
+    Transitive closure of a small dependency graph (e.g. the CZ graph built
+    by the policies) stored as one reachability bitmask per vertex, so that
+    "would adding this edge create a cycle" becomes a single bitwise AND.
+    '''
+    def __init__(self, edges: Iterable[Tuple[Any, Any]] = ()):
+        self.name_to_idx: Dict[Any, int] = {}
+        self.edge_count: Dict[Tuple[int, int], int] = {}
+        self.reach: List[int] = []  # vertices reachable by a path of length >= 1
+        self.pred: List[int] = []   # direct predecessors
+        self.cyclic: bool = False
+        for src, dst in edges:
+            self.add_edge(src, dst)
+
+    def add_vertex(self, v: Any) -> int:
+        idx = self.name_to_idx.get(v, None)
+        if idx is None:
+            idx = len(self.reach)
+            self.name_to_idx[v] = idx
+            self.reach.append(0)
+            self.pred.append(0)
+        return idx
+
+    def add_edge(self, src: Any, dst: Any) -> None:
+        src_idx = self.add_vertex(src)
+        dst_idx = self.add_vertex(dst)
+        key = (src_idx, dst_idx)
+        self.edge_count[key] = self.edge_count.get(key, 0) + 1
+        self.pred[dst_idx] |= 1 << src_idx
+
+        src_bit = 1 << src_idx
+        new_reach = (1 << dst_idx) | self.reach[dst_idx]
+        for i, r in enumerate(self.reach):
+            if i == src_idx or r & src_bit:
+                self.reach[i] = r | new_reach
+        self.cyclic = self.cyclic or bool(new_reach & src_bit)
+
+    def reaches(self, src: Any, dst: Any) -> bool:
+        src_idx = self.name_to_idx.get(src, None)
+        dst_idx = self.name_to_idx.get(dst, None)
+        if src_idx is None or dst_idx is None:
+            return False
+        return bool(self.reach[src_idx] & (1 << dst_idx))
+
+    def creates_cycle(
+        self,
+        src: Any,
+        dst: Any,
+        removed_edge: Optional[Tuple[Any, Any]] = None
+    ) -> bool:
+        '''
+        Return whether the graph would contain a cycle after adding the edge
+        src -> dst and removing one copy of removed_edge, which must end at src
+        (the vehicle leaving its current CZ for src). The graph itself is not
+        modified.
+        '''
+        if src == dst:
+            return True
+        src_idx = self.name_to_idx.get(src, None)
+        dst_idx = self.name_to_idx.get(dst, None)
+
+        removed_idx = None
+        if removed_edge is not None:
+            if removed_edge[1] != src:
+                raise Exception("[ReachabilityIndex.creates_cycle] removed edge must end at src")
+            key = (self.name_to_idx.get(removed_edge[0], -1), src_idx)
+            if self.edge_count.get(key, 0) == 1:
+                removed_idx = key[0]
+
+        if self.cyclic:
+            if removed_idx is None:
+                return True
+            G = BitsetDigraph()
+            for edge in self.edges():
+                if edge != removed_edge:
+                    G.add_edge(*edge)
+            if G.has_cycle():
+                return True
+
+        if src_idx is None or dst_idx is None:
+            return False
+
+        # dst reaches src without the removed edge iff dst reaches (or is) one
+        # of the remaining predecessors of src; a path that sneaks through the
+        # removed edge implies a cycle through src, which is handled above.
+        pred = self.pred[src_idx]
+        if removed_idx is not None:
+            pred &= ~(1 << removed_idx)
+        return bool((self.reach[dst_idx] | (1 << dst_idx)) & pred)
+
+    def edges(self) -> List[Tuple[Any, Any]]:
+        idx_to_name = {idx: name for name, idx in self.name_to_idx.items()}
+        res = []
+        for (src_idx, dst_idx), count in self.edge_count.items():
+            res.extend([(idx_to_name[src_idx], idx_to_name[dst_idx])] * count)
+        return res
+
+
 def read_intersection_from_json(file_path):
     fp = open(file_path, "r")
     cfg = json.load(fp)